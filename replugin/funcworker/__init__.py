@@ -20,45 +20,245 @@ from time import sleep
 
 from reworker.worker import Worker
 
+from replugin.funcworker.checkscripts import CheckScripts
+from replugin.funcworker.clientpool import ClientPool
+from replugin.funcworker.commandindex import CommandIndex
+from replugin.funcworker.dispatch import Outbox, StepExecutor
+from replugin.funcworker.inventory import MinionInventory
+from replugin.funcworker.metrics import MetricsServer, WorkerMetrics
+from replugin.funcworker.parsers import ParserRegistry
+from replugin.funcworker.payload import ResultPayload
+from replugin.funcworker.polling import Deadline, JobTracker, PollPolicy
+from replugin.funcworker.progress import ProgressReporter
+from replugin.funcworker.timing import StageTimer, clock
+
 import func.overlord.client as fc
 
 from func.minion.codes import FuncException
+from func.utils import is_error
 import func.CommonErrors
-import traceback
+import functools
+import threading
+import json
 import sys
 import re
+import Queue
 
 
-BLACKLIST = re.compile('[;|&$><#]+')
+BLACKLIST = re.compile('[;|&$><#]')
 
 
 def block_bad_chars(items):
     """
-    Hack to block obvious shell stuff.
+    Hack to block obvious shell stuff. Strings nested in lists, tuples
+    and dicts are checked too, numbers and other values can not carry
+    shell syntax and pass.
     """
-    for item in items:
-        if BLACKLIST.findall(item):
-            raise TypeError('An unsafe char was attempted. Not executing.')
+    search = BLACKLIST.search
+    pending = [items]
+    while pending:
+        item = pending.pop()
+        if isinstance(item, basestring):
+            # search stops at the first unsafe char
+            if search(item) is not None:
+                raise TypeError(
+                    'An unsafe char was attempted. Not executing.')
+        elif isinstance(item, (list, tuple, set, frozenset)):
+            pending.extend(item)
+        elif isinstance(item, dict):
+            pending.extend(item.keys())
+            pending.extend(item.values())
     return items
 
 
-def expand_globs(globs, app_logger):
+def lookup_glob(glob, app_logger, client_pool=None):
+    """
+    Look up the minions matching a single host glob. Returns a tuple of
+    (minions, unmatched) where unmatched is the name func could not
+    match, or None. Clients come from `client_pool` when given.
+    """
+    app_logger.debug("Expanding glob (looking up host): %s" % (
+        glob))
+    try:
+        if client_pool is None:
+            return (fc.Client(glob).list_minions(), None)
+        c = client_pool.acquire([glob])
+        minions = c.list_minions()
+        client_pool.release(c, [glob])
+        return (minions, None)
+    except func.CommonErrors.Func_Client_Exception as e:
+        # Sure would be helpful if this exception told you exactly
+        # WHICH names bombed... buuuuut what can you do?
+        return ([], e.value.split("\"")[1])
+
+
+def expand_globs(globs, app_logger, max_workers=8, inventory=None,
+                 client_pool=None, deadline=None):
+    """
+    Resolve host globs to the minions they match. Up to `max_workers`
+    globs are looked up at the same time, the results are merged in the
+    order the globs were given. If a MinionInventory is given globs are
+    matched against it instead of asking the overlord each time, else
+    the overlord is asked with clients from `client_pool`. Lookups not
+    done by the given Deadline raise FuncWorkerTimeout.
+
+    Returns a tuple of (found_hosts, missing_hosts).
+    """
+    if deadline is None:
+        deadline = Deadline()
+    if inventory is not None:
+        lookup_one = inventory.lookup
+    else:
+        lookup_one = functools.partial(lookup_glob, client_pool=client_pool)
+
+    lookups = [None] * len(globs)
+    errors = []
+    pending = Queue.Queue()
+    for index, glob in enumerate(globs):
+        pending.put((index, glob))
+
+    def lookup():
+        while not errors and not deadline.expired():
+            try:
+                (index, glob) = pending.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                lookups[index] = lookup_one(glob, app_logger)
+            except Exception:
+                errors.append(sys.exc_info())
+
+    threads = []
+    workers = min(max_workers, len(globs))
+    if deadline.seconds is None:
+        # The calling thread takes its share of the lookups too
+        workers -= 1
+    for x in range(workers):
+        thread = threading.Thread(target=lookup)
+        # Lookups hanging past the deadline are left behind
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+    if deadline.seconds is None:
+        lookup()
+    for thread in threads:
+        thread.join(deadline.remaining())
+    if errors:
+        raise errors[0][0], errors[0][1], errors[0][2]
+    if None in lookups:
+        raise FuncWorkerTimeout(
+            'Timed out after %s seconds looking up hosts.' % (
+                deadline.seconds))
+
+    # Keep the first occurrence of every host. The sets make the
+    # membership checks constant time for fleets of many thousands.
     found_hosts = []
-    missing_hosts = set()
-    for h in globs:
-        app_logger.debug("Expanding glob (looking up host): %s" % (
-            h))
+    found_set = set()
+    missing_hosts = []
+    missing_set = set()
+    for (minions, unmatched) in lookups:
+        for host in minions:
+            if host not in found_set:
+                found_set.add(host)
+                found_hosts.append(host)
+        if unmatched is not None and unmatched not in missing_set:
+            missing_set.add(unmatched)
+            missing_hosts.append(unmatched)
+    return (found_hosts, missing_hosts)
+
+
+def normalize_result(result):
+    """
+    Coerce the result func returned for a single host into a list of
+    [return code, stdout, stderr].
+    """
+    # FIXME: This forces non command output into a command
+    #        output like structure. It's a hack.
+    # If this wasn't a system command the results may
+    # be a string ...
+    # ... or a list of strings
+    if type(result) in (str, int):
+        return [0, str(result), '']
+    elif is_error(result):
+        # func reports minion side failures as
+        # [REMOTE_ERROR, exception type, message, traceback]
+        return [1, '', ", ".join([str(x) for x in result[1:]])]
+    elif type(result[0]) == str:
+        return [0, ", ".join(result), '']
+    return result
+
+
+def evaluate_host_results(results, return_codes, expected_hosts=[],
+                          process=normalize_result):
+    """
+    Normalize every host's result from an async func job with
+    `process` and check each return code against `return_codes`.
+
+    Hosts listed in `expected_hosts` which are missing from `results`
+    are treated as failures.
+
+    Returns a tuple of (host_results, succeeded_hosts, failed_hosts).
+    """
+    host_results = {}
+    for host, result in results.items():
+        host_results[host] = process(result)
+    for host in expected_hosts:
+        if host not in host_results:
+            host_results[host] = [None, '', 'No result returned by host']
+
+    succeeded = []
+    failed = []
+    for host in sorted(host_results.keys()):
         try:
-            c = fc.Client(h)
-            new_hosts = filter(lambda h: h not in found_hosts,
-                               c.list_minions())
-            found_hosts.extend(new_hosts)
-        except func.CommonErrors.Func_Client_Exception as e:
-            # Sure would be helpful if this exception told you exactly
-            # WHICH names bombed... buuuuut what can you do?
-            unmatched = e.value.split("\"")[1]
-            missing_hosts.add(unmatched)
-    return (found_hosts, list(missing_hosts))
+            success = host_results[host][0] in return_codes
+        except TypeError:
+            # Not a return code at all, such as the first row of a
+            # list of lists. It can not be a success either.
+            success = False
+        if success:
+            succeeded.append(host)
+        else:
+            failed.append(host)
+    return (host_results, succeeded, failed)
+
+
+def parse_max_failures(max_failures, host_count):
+    """
+    Turn a step's max_failures, a count of hosts or a percentage of
+    `host_count` such as "25%", into the number of hosts allowed to
+    fail.
+    """
+    try:
+        if isinstance(max_failures, basestring) and \
+                max_failures.strip().endswith('%'):
+            percent = float(max_failures.strip()[:-1])
+            if not 0 <= percent <= 100:
+                raise ValueError(percent)
+            return int(host_count * percent / 100)
+        count = int(max_failures)
+        if count < 0:
+            raise ValueError(count)
+        return count
+    except (TypeError, ValueError):
+        raise FuncWorkerError(
+            'max_failures must be a number of hosts or a percentage '
+            'between 0%% and 100%%, not %s' % max_failures)
+
+
+def parse_timeout(timeout):
+    """
+    Returns a step's timeout as float seconds, or None if it has none.
+    """
+    if timeout is None:
+        return None
+    try:
+        timeout = float(timeout)
+    except (TypeError, ValueError):
+        timeout = 0
+    if timeout <= 0:
+        raise FuncWorkerError(
+            'timeout must be a number of seconds above 0.')
+    return timeout
 
 
 class FuncWorkerError(Exception):
@@ -68,6 +268,13 @@ class FuncWorkerError(Exception):
     pass
 
 
+class FuncWorkerTimeout(FuncWorkerError):
+    """
+    Raised when a step runs past its timeout.
+    """
+    pass
+
+
 class FuncWorker(Worker):
     """
     Simple worker which executes remote func calls.
@@ -75,6 +282,105 @@ class FuncWorker(Worker):
     # The subcommands for the following commands must be downcased
     # before attempting to make the actual func module method calls.
     downcase_subcommands = ['command', 'service', 'yumcmd']
+    # Seconds between sends of the replies queued by step threads
+    outbox_interval = 0.05
+
+    def __init__(self, *args, **kwargs):
+        Worker.__init__(self, *args, **kwargs)
+        # Checked once here so a broken config fails at startup
+        self._commands = CommandIndex(self._config)
+        # All in-flight func jobs are polled by one shared tracker
+        self._job_tracker = JobTracker(
+            self.app_logger,
+            float(self._config.get('job_poll_interval', 0.25)))
+        # Warm func clients are reused by steps against the same hosts
+        self._client_pool = ClientPool(
+            int(self._config.get('client_pool_size', 32)))
+        # Optionally cache the overlord's minion list for glob lookups
+        self._inventory = None
+        minion_cache_ttl = float(self._config.get('minion_cache_ttl', 0))
+        if minion_cache_ttl > 0:
+            self._inventory = MinionInventory(
+                minion_cache_ttl,
+                lambda glob, app_logger: lookup_glob(
+                    glob, app_logger, self._client_pool))
+        # Steps run on a pool of threads. Their replies and
+        # notifications wait in the outbox for the I/O loop.
+        self._executor = StepExecutor(
+            self.app_logger, int(self._config.get('max_in_flight', 1)))
+        self._outbox = Outbox()
+        self._draining = False
+        # Special parameter parsers are found once, not per message
+        self._parsers = ParserRegistry(self.app_logger)
+        self._parsers.discover(
+            self._commands.commands, 'replugin.funcworker',
+            self._config.get('parser_modules', {}))
+        # Big outputs are capped, and optionally compressed or chunked
+        self._payload = ResultPayload(
+            int(self._config.get('max_output_bytes', 1048576)),
+            bool(self._config.get('compress_results', False)),
+            int(self._config.get('result_chunk_bytes', 0)))
+        # Throughput and latency, optionally served for Prometheus
+        self._metrics = WorkerMetrics(
+            self._executor.in_flight, self._client_pool.stats,
+            self._inventory and self._inventory.stats)
+        self._metrics_server = None
+        if self._config.get('metrics_port') is not None:
+            self._metrics_server = MetricsServer(
+                self._metrics, int(self._config['metrics_port']),
+                self._config.get('metrics_address', '127.0.0.1'))
+            self._metrics_server.start()
+
+    def _on_channel_open(self, channel):
+        """
+        Limits the messages the broker hands out before they are acked
+        to the number of steps that can run at once.
+        """
+        # Steps are acked once they start, so messages waiting for a
+        # free step thread stay with the broker.
+        channel.basic_qos(prefetch_count=self._executor.max_in_flight)
+        Worker._on_channel_open(self, channel)
+
+    def ack(self, *args, **kwargs):
+        """
+        Acks a message, handing it to the I/O loop when called from a
+        step thread.
+        """
+        if not self._outbox.on_io_thread():
+            self._outbox.put(Worker.ack, self, *args, **kwargs)
+        else:
+            Worker.ack(self, *args, **kwargs)
+
+    def send(self, *args, **kwargs):
+        """
+        Sends a message, handing it to the I/O loop when called from a
+        step thread.
+        """
+        if not self._outbox.on_io_thread():
+            self._outbox.put(Worker.send, self, *args, **kwargs)
+        else:
+            Worker.send(self, *args, **kwargs)
+
+    def notify(self, *args, **kwargs):
+        """
+        Sends a notification, handing it to the I/O loop when called
+        from a step thread.
+        """
+        if not self._outbox.on_io_thread():
+            self._outbox.put(Worker.notify, self, *args, **kwargs)
+        else:
+            Worker.notify(self, *args, **kwargs)
+
+    def _drain_outbox(self):
+        """
+        Publishes everything step threads queued, then schedules itself
+        again on the connection's I/O loop.
+        """
+        try:
+            self._outbox.drain()
+        finally:
+            self._connection.add_timeout(
+                self.outbox_interval, self._drain_outbox)
 
     def process(self, channel, basic_deliver, properties, body, output):
         """Executes remote func calls when requested. Only configured
@@ -91,14 +397,55 @@ class FuncWorker(Worker):
                     from check scripts
            * check_scripts: list of check scripts to execute which
                             verify success
+           * batch_size: run on this many hosts at a time
+           * max_failures: number (or percentage, like "10%") of hosts
+                           which may fail before the step stops
+           * timeout: seconds the whole step may take
+           * steps: list of command parameters (each with its own
+                    command and subcommand) to run in order on hosts
+           * raw_output: reply with the plain output even if the
+                         command's parser module can sum it up
         """
-        # Ack the original message
-        self.ack(basic_deliver)
         corr_id = str(properties.correlation_id)
         # Notify we are starting
         self.send(
             properties.reply_to, corr_id, {'status': 'started'}, exchange='')
 
+        # process is called on the connection's I/O thread. The step
+        # itself runs on a step thread so waiting on func jobs never
+        # blocks the I/O loop (and with it the broker heartbeats).
+        self._outbox.io_thread = threading.current_thread()
+        if not self._draining:
+            self._draining = True
+            self._drain_outbox()
+        self.app_logger.debug(
+            'Queueing step %s. Steps in flight: %s/%s' % (
+                corr_id, self._executor.in_flight(),
+                self._executor.max_in_flight))
+        self._executor.submit(
+            self._run_delivery, basic_deliver, properties, corr_id, body,
+            output, StageTimer())
+
+    def _run_delivery(self, basic_deliver, *args):
+        """
+        Acks a message once a step thread picked it up, then runs its
+        step with _run_step.
+        """
+        # Ack the original message. Steps change hosts, so they must
+        # not run twice, and long steps would outlast the broker's ack
+        # timeout.
+        self.ack(basic_deliver)
+        self._run_step(*args)
+
+    def _run_step(self, properties, corr_id, body, output, timer=None):
+        """
+        Runs the func call requested in `body`, or each of its `steps`,
+        and replies with the final state. The time spent in each stage
+        is added to `timer`, which started when the step was queued.
+        """
+        timer = timer or StageTimer()
+        timer.add('queued', timer.elapsed())
+        labels = ('unknown', 'unknown')
         try:
             try:
                 params = body['parameters']
@@ -106,187 +453,35 @@ class FuncWorker(Worker):
                 raise FuncWorkerError(
                     'Params dictionary not passed to FuncWorker.'
                     ' Nothing to do!')
-            # First verify it's a command we should be working with
-            if params['command'] not in self._config.keys():
-                raise FuncWorkerError(
-                    'This worker only handles: %s' % self._config.keys())
+            labels = self._metric_labels(params)
 
-            command_cfg = self._config[params['command']]
+            if 'steps' in params:
+                self._run_pipeline(
+                    properties, corr_id, params, output, timer)
+                return
 
-            # Next verify there is a subcommand
-            if params['subcommand'] not in command_cfg.keys():
-                raise FuncWorkerError(
-                    'Requested subcommand for %s is not supported '
-                    'by this worker' % params['command'])
+            with timer.stage('parse'):
+                (command_cfg, target_params,
+                 timeout) = self._prepare(params)
+            deadline = Deadline(timeout)
 
-            # Then check we have hosts to use
-            if 'hosts' not in params.keys() or type(params['hosts']) != list:
-                raise FuncWorkerError(
-                    'This worker requires hosts to be a list of hosts.')
-
-            # Find out if we have special return codes
-            try:
-                return_codes = self._config['return_codes'][params['subcommand']]
-            except KeyError, ke:
-                # Else fall back to 0 being the only success code
-                self.app_logger.debug('No special return codes set.')
-                return_codes = [0]
-
-            # Get tries/check_scripts or set defaults
-            _tries = int(params.get('tries', 1))
-            _check_scripts = params.get('check_scripts', [])
-
-            # Parse the given parameters. Possibly invoke a
-            # specialized sub-parser for special-snowflake methods.
-            (_update_params, target_params) = self.parse_params(
-                params, command_cfg)
-            params.update(_update_params)
-
-            if params['command'] in self.downcase_subcommands:
-                params['subcommand'] = params['subcommand'].lower()
-
-            try:
-                output.info('Executing func command ...')
-                target_hosts = ";".join(params['hosts'])
-
-                (found, missing) = expand_globs(
-                    params['hosts'], self.app_logger)
-
-                self.app_logger.debug("Found hosts: %s" % (
-                    found))
-                if missing:
-                    self.app_logger.warning("Missing hosts: %s" % (
-                        missing))
-
-                if len(missing) > 0:
-                    raise FuncWorkerError(
-                        'Hosts not discoverable: %s' % (str(missing)))
-
-                self.app_logger.info('Executing %s.%s(%s) on %s' % (
-                    params['command'], params['subcommand'],
-                    target_params, target_hosts))
-
-                # TODO: what if we're calling multiple hosts at once?
-                #
-                # In the future, we basically need to loop over
-                # target_hosts -- submitting each job and recording
-                # the job_id -- then loop over the job ID's until each
-                # job_status is JOB_ID_FINISHED (or failed)
-                client = fc.Client(target_hosts, async=True)
-                # Func syntax can be kind of weird, as all modules
-                # ("COMMAND") appear as attributes of the `client`
-                # object ..
-                target_callable = getattr(
-                    # First get the client.COMMAND attribute
-                    getattr(client, params['command']),
-                    # Next get the client.COMMAND.SUBCOMMAND method
-                    params['subcommand'])
-                target_callable_repr = "%s.%s" % (
-                    params['command'],
-                    params['subcommand'])
-                for attempt_count in range(_tries):
-                    self.app_logger.info("In the for loop (over _tries)")
-                    output.debug(
-                        'Invoking func method: "%s" with args: "%s"' % (
-                            str(target_callable_repr),
-                            str(target_params)))
-                    # Call the fc.Client.COMMAND.SUBCOMMAND
-                    # method with the collected parameters
-                    job_id = target_callable(*target_params)
-                    self.app_logger.debug("Ran job, id is: %s. "
-                                          "Polling for results now" % job_id)
-                    (status, results) = (None, None)
-                    while status != func.jobthing.JOB_ID_FINISHED:
-                        (status, results) = client.job_status(job_id)
-                        self.app_logger.info(
-                            "Waiting for JOB_ID_FINISHED. Status: %s" % status)
-                        sleep(3)
-
-                    # TODO: what if we're calling multiple hosts at once?
-                    #
-                    # For async jobs, func will return a dictionary for
-                    # the result. Each key in the dict is a hostname, the
-                    # value is a list of [return code, stdout, stderr]
-                    results = results[params['hosts'][0]]
-                    self.app_logger.debug("Raw results: %s" % str(results))
-
-                    # success set to False if anything returns non 0
-                    success = True
-                    # called is a nice repr of the command
-                    called = '%s.%s(*%s)' % (
-                        params['command'], params['subcommand'], target_params)
-                    output.debug("Raw response: %s" % (
-                        str(results)))
-
-                    # FIXME: This forces non command output into a command
-                    #        output like structure. It's a hack.
-                    # If this wasn't a system command the results may
-                    # be a string ...
-                    # ... or a list of strings
-                    if type(results) in (str, int):
-                        results = [0, str(results), '']
-                    elif type(results[0]) == str:
-                        results = [0, ", ".join(results), '']
-
-                    # item 0 = return code
-                    # item 1 = stdout
-                    # item 2 = stderr
-                    if results[0] not in return_codes:
-                        success = False
-                        output.info(
-                            '%s returned %s for command %s which is not a '
-                            'success return code (%s)' % (
-                                target_hosts, results[0], called, return_codes))
-
-                    if success and len(_check_scripts):
-                        # Execute all check scripts.
-                        current_script_count = 0
-                        check_scripts_passed = False
-                        for check_script in _check_scripts:
-                            output.info('Executing check_script %s.' % (
-                                check_script))
-                            check_result = client.command.run(check_script)
-                            output.info(
-                                '%s returned %s for check_script '
-                                '%s on attempt %s' % (
-                                    target_hosts, check_result[0],
-                                    check_script, attempt_count))
-
-                            # check script isn't happy, try again
-                            if check_result[0] != 0:
-                                output.info(
-                                    'Waiting a few seconds and trying again.')
-                                # Sleep for a short period before trying again
-                                success = False
-                                sleep(2)
-                                break
-                            # We get here if it returned a 0 ..
-                            elif current_script_count == len(_check_scripts):
-                                # since it's the last script
-                                # and they all passed
-                                check_scripts_passed = True
-
-                        # If all the check scripts passed then break the loop
-                        if check_scripts_passed:
-                            output.info('All check scripts passed!')
-                            break
-                    elif success:
-                        # Nothing to test with ...
-                        break
-            except FuncException, fex:
-                raise FuncWorkerError(str(fex))
+            output.info('Executing func command ...')
+            with timer.stage('lookup'):
+                found = self._find_hosts(params['hosts'], deadline)
+            progress = self._progress_reporter(properties, corr_id, found)
+            (success, result, called) = self._execute(
+                params, command_cfg, target_params, found, deadline,
+                progress, output, timer)
 
             # Notify the final state based on the return code
             if success:
-                self.app_logger.info('Success for %s.%s(%s) on %s' % (
-                    params['command'], params['subcommand'],
-                    target_params, target_hosts))
-                self.send(
-                    properties.reply_to,
-                    corr_id,
-                    {'status': 'completed', 'data': results},
-                    exchange=''
-                )
+                self.app_logger.info('Success for %s on %s' % (
+                    called, ";".join(found)))
+                reply = {'status': 'completed'}
+                reply.update(result)
+                reply['timings'] = self._step_done(
+                    corr_id, 'completed', timer, labels)
+                self._send_result(properties, corr_id, reply)
                 # Notify on result. Not required but nice to do.
                 self.notify(
                     'FuncWorker Executed Successfully',
@@ -295,54 +490,617 @@ class FuncWorker(Worker):
                     'completed',
                     corr_id)
             else:
-                raise FuncWorkerError(
+                err = FuncWorkerError(
                     'FuncWorker failed trying to execute %s. See logs.' % (
                         called))
+                err.hosts = result['hosts']
+                err.check_scripts = result.get('check_scripts')
+                raise err
         except FuncWorkerError, fwe:
-            # If a FuncWorkerError happens send a failure, notify and log
-            # the info for review.
-            self.app_logger.error('Failure: %s' % fwe)
-
-            self.send(
-                properties.reply_to,
-                corr_id,
-                {'status': 'failed', 'data': str(fwe)},
-                exchange=''
-            )
-            self.notify(
-                'FuncWorker Failed',
-                str(fwe),
-                'failed',
-                corr_id)
-            output.error(str(fwe))
+            self._step_failed(properties, corr_id, fwe, output, timer, labels)
+        except Exception, ex:
+            self._step_failed(
+                properties, corr_id, self._unexpected_error(corr_id, ex),
+                output, timer, labels)
+
+    def _step_failed(self, properties, corr_id, fwe, output, timer, labels):
+        """
+        Replies, notifies and logs that the step `corr_id` failed with
+        the FuncWorkerError `fwe`.
+        """
+        # If a FuncWorkerError happens send a failure, notify and log
+        # the info for review.
+        self.app_logger.error('Failure: %s' % fwe)
+
+        reply = {'status': 'failed', 'data': str(fwe)}
+        if isinstance(fwe, FuncWorkerTimeout):
+            reply['timed_out'] = True
+        if getattr(fwe, 'hosts', None):
+            reply['hosts'] = fwe.hosts
+        if getattr(fwe, 'check_scripts', None):
+            reply['check_scripts'] = fwe.check_scripts
+        if getattr(fwe, 'steps', None):
+            reply['steps'] = fwe.steps
+        reply['timings'] = self._step_done(
+            corr_id, 'failed', timer, labels)
+        self.send(
+            properties.reply_to,
+            corr_id,
+            reply,
+            exchange=''
+        )
+        self.notify(
+            'FuncWorker Failed',
+            str(fwe),
+            'failed',
+            corr_id)
+        output.error(str(fwe))
+
+    def _unexpected_error(self, corr_id, error):
+        """
+        Logs `error`, raised while running the step `corr_id` by
+        something other than the worker's own checks (a parser, a
+        result processor, ...). Returns it as a FuncWorkerError so the
+        step still fails like any other.
+        """
+        self.app_logger.exception(
+            'Unexpected error running step %s' % corr_id)
+        return FuncWorkerError('%s: %s' % (error.__class__.__name__, error))
+
+    def _run_pipeline(self, properties, corr_id, params, output, timer):
+        """
+        Runs every entry of `params['steps']` in order, stopping at the
+        first one which fails. A step runs on its own `hosts`, or else
+        on the hosts of `params`, as its parser leaves them (nagios
+        steps go to the nagios server, for one). Each distinct list of
+        hosts is looked up once and func clients are shared by the
+        steps. Replies once with the results of each step. The stages
+        of all steps are timed together by `timer`.
+        """
+        steps = params['steps']
+        if type(steps) != list or not steps or not all(
+                [type(step) == dict for step in steps]):
+            raise FuncWorkerError(
+                'steps must be a list of command parameters.')
+        if 'hosts' not in params.keys() or type(params['hosts']) != list:
+            raise FuncWorkerError(
+                'This worker requires hosts to be a list of hosts.')
+        deadline = Deadline(parse_timeout(params.get('timeout')))
+
+        # Check every step before anything runs
+        prepared = []
+        with timer.stage('parse'):
+            for step in steps:
+                step_params = dict(step)
+                step_params.setdefault('hosts', params['hosts'])
+                prepared.append(
+                    (step_params,) + self._prepare(step_params))
+
+        output.info('Executing %s func commands ...' % len(prepared))
+        # host list -> hosts found, every step's hosts found up front
+        found = {}
+        with timer.stage('lookup'):
+            for (step_params, command_cfg, target_params,
+                 timeout) in prepared:
+                hosts = tuple(step_params['hosts'])
+                if hosts not in found:
+                    found[hosts] = self._find_hosts(list(hosts), deadline)
+
+        results = []
+        called = []
+        ran = []
+        for (step_params, command_cfg, target_params,
+             timeout) in prepared:
+            step_found = found[tuple(step_params['hosts'])]
+            result = {
+                'command': command_cfg.command,
+                'subcommand': command_cfg.subcommand,
+            }
+            results.append(result)
+            try:
+                (success, step_result, step_called) = self._execute(
+                    step_params, command_cfg, target_params, step_found,
+                    deadline.within(timeout),
+                    self._progress_reporter(properties, corr_id, step_found),
+                    output, timer)
+            except Exception, fwe:
+                if not isinstance(fwe, FuncWorkerError):
+                    fwe = self._unexpected_error(corr_id, fwe)
+                result.update({'status': 'failed', 'data': str(fwe)})
+                if isinstance(fwe, FuncWorkerTimeout):
+                    result['timed_out'] = True
+                fwe.steps = self._skip_steps(results, prepared)
+                raise fwe
+            result['status'] = success and 'completed' or 'failed'
+            result.update(step_result)
+            called.append(step_called)
+            ran.append('%s on %s' % (step_called, ";".join(step_found)))
+            if not success:
+                err = FuncWorkerError(
+                    'FuncWorker failed trying to execute %s (step %s of '
+                    '%s). See logs.' % (
+                        step_called, len(results), len(prepared)))
+                err.steps = self._skip_steps(results, prepared)
+                raise err
+
+        self.app_logger.info('Success for %s' % ", ".join(ran))
+        self._send_result(properties, corr_id, {
+            'status': 'completed',
+            'data': results,
+            'timings': self._step_done(
+                corr_id, 'completed', timer, ('pipeline', '')),
+        })
+        self.notify(
+            'FuncWorker Executed Successfully',
+            'FuncWorker successfully executed %s. See logs.' % (
+                ", ".join(called)),
+            'completed',
+            corr_id)
+
+    def _send_result(self, properties, corr_id, reply):
+        """
+        Sends the final `reply` of a step. Its data and results are
+        compressed or sent ahead in chunks as configured, together as
+        one object. The reply then names the encoding and the number
+        of chunks.
+        """
+        payload = dict([(key, reply[key]) for key in ('data', 'results')
+                        if key in reply])
+        (encoding, bodies) = self._payload.encode(payload)
+        if encoding is not None:
+            for key in payload:
+                del reply[key]
+            reply['encoding'] = encoding
+            if len(bodies) > 1:
+                for index, body in enumerate(bodies):
+                    self.send(
+                        properties.reply_to,
+                        corr_id,
+                        {'status': 'chunk', 'data': body,
+                         'chunk': index + 1, 'chunks': len(bodies)},
+                        exchange=''
+                    )
+                reply['chunks'] = len(bodies)
+            else:
+                reply['data'] = bodies[0]
+        self.send(
+            properties.reply_to,
+            corr_id,
+            reply,
+            exchange=''
+        )
+
+    def _metric_labels(self, params):
+        """
+        Returns the (command, subcommand) metric labels of a step. Only
+        configured ones are used so bad requests can not add labels.
+        """
+        if 'steps' in params:
+            return ('pipeline', '')
+        try:
+            command_cfg = self._commands.lookup(
+                params.get('command'), params.get('subcommand'))
+        except KeyError:
+            return ('unknown', 'unknown')
+        return (command_cfg.command, command_cfg.subcommand)
+
+    def _step_done(self, corr_id, status, timer, labels):
+        """
+        Counts the step `corr_id` as done with `status`, logs its stage
+        timings as one JSON line and returns them for the reply.
+        `labels` are the step's (command, subcommand) metric labels.
+        """
+        timings = timer.summary()
+        self._metrics.steps.inc(labels + (status,))
+        self._metrics.step_seconds.observe(timings['total'], labels)
+        self.app_logger.info('Step timings: %s' % json.dumps({
+            'correlation_id': corr_id,
+            'status': status,
+            'timings': timings,
+        }, sort_keys=True))
+        return timings
+
+    def _skip_steps(self, results, prepared):
+        """
+        Returns `results` followed by an entry for every step of
+        `prepared` which did not get to run.
+        """
+        for (step_params, command_cfg, target_params,
+             timeout) in prepared[len(results):]:
+            results.append({
+                'command': command_cfg.command,
+                'subcommand': command_cfg.subcommand,
+                'status': 'skipped',
+            })
+        return results
+
+    def _prepare(self, params):
+        """
+        Validates the command `params` ask for and parses them. Returns
+        a tuple of (command_cfg, target_params, timeout).
+        """
+        # First verify it's a command we should be working with
+        if params.get('command') not in self._commands:
+            raise FuncWorkerError(
+                'This worker only handles: %s' % (
+                    list(self._commands.commands)))
+
+        # Next verify there is a subcommand
+        try:
+            command_cfg = self._commands.lookup(
+                params['command'], params.get('subcommand'))
+        except KeyError:
+            raise FuncWorkerError(
+                'Requested subcommand for %s is not supported '
+                'by this worker' % params['command'])
+
+        # Then check we have hosts to use
+        if 'hosts' not in params.keys() or type(params['hosts']) != list:
+            raise FuncWorkerError(
+                'This worker requires hosts to be a list of hosts.')
+
+        # The step has to be done by its deadline. The conf may
+        # set a default timeout per command.
+        timeout = parse_timeout(params.get('timeout', command_cfg.timeout))
+
+        # Parse the given parameters. Possibly invoke a
+        # specialized sub-parser for special-snowflake methods.
+        (_update_params, target_params) = self.parse_params(
+            params, command_cfg)
+        params.update(_update_params)
+
+        if params['command'] in self.downcase_subcommands:
+            params['subcommand'] = params['subcommand'].lower()
+        return (command_cfg, target_params, timeout)
+
+    def _find_hosts(self, hosts, deadline):
+        """
+        Resolves the host globs in `hosts`. Returns the list of hosts
+        found, raises FuncWorkerError unless every glob matched.
+        """
+        start = clock()
+        try:
+            (found, missing) = expand_globs(
+                hosts, self.app_logger,
+                int(self._config.get('glob_workers', 8)),
+                self._inventory, self._client_pool, deadline)
+        except FuncException, fex:
+            raise FuncWorkerError(str(fex))
+        finally:
+            self._metrics.lookup_seconds.observe(clock() - start)
+
+        self.app_logger.debug("Found hosts: %s" % (
+            found))
+        if missing:
+            self.app_logger.warning("Missing hosts: %s" % (
+                missing))
+            self._metrics.missing_hosts.inc(amount=len(missing))
+
+        if len(missing) > 0:
+            raise FuncWorkerError(
+                'Hosts not discoverable: %s' % (str(missing)))
+        if not found:
+            raise FuncWorkerError(
+                'No hosts matched: %s' % (str(hosts)))
+        return found
+
+    def _progress_reporter(self, properties, corr_id, found):
+        """
+        Returns a ProgressReporter replying to the step's reply_to.
+        """
+        return ProgressReporter(
+            lambda message: self.send(
+                properties.reply_to, corr_id, message, exchange=''),
+            float(self._config.get('progress_interval', 5)),
+            len(found))
+
+    def _execute(self, params, command_cfg, target_params, found, deadline,
+                 progress, output, timer):
+        """
+        Runs the func call described by `params` on the `found` hosts.
+        Returns a tuple of (success, result, called) where result holds
+        the reply's data, hosts and check_scripts entries and called is
+        a nice repr of the command.
+        """
+        # Return codes and polling come from the config
+        return_codes = command_cfg.return_codes
+        poll_policy = command_cfg.poll_policy
+        self.app_logger.debug('Using %s' % poll_policy)
+
+        # Get tries/check_scripts or set defaults
+        _tries = int(params.get('tries', 1))
+        _check_scripts = CheckScripts(params.get('check_scripts', []))
+
+        # Parser modules may sum up the output of each host
+        process = None
+        if not params.get('raw_output', False):
+            process = self._parsers.result_processor(
+                command_cfg.command, command_cfg.subcommand)
+        process = process or normalize_result
+
+        # Run on exactly the hosts resolved above so func does
+        # not expand the globs a second time.
+        target_hosts = ";".join(found)
+        # called is a nice repr of the command
+        called = '%s.%s(*%s)' % (
+            params['command'], params['subcommand'], target_params)
+
+        self.app_logger.info('Executing %s.%s(%s) on %s' % (
+            params['command'], params['subcommand'],
+            target_params, target_hosts))
+
+        # Large host lists may run in waves of batch_size hosts.
+        # Waves stop once more than failure_budget hosts failed.
+        failure_budget = parse_max_failures(
+            params.get('max_failures', 0), len(found))
+        try:
+            batch_size = int(params.get('batch_size', len(found)))
+        except (TypeError, ValueError):
+            batch_size = 0
+        if batch_size < 1:
+            raise FuncWorkerError(
+                'batch_size must be a number of at least 1.')
+        waves = [found[index:index + batch_size]
+                 for index in range(0, len(found), batch_size)]
+
+        host_results = {}
+        succeeded_hosts = []
+        failed_hosts = []
+        skipped_hosts = []
+        try:
+            for wave_count, wave in enumerate(waves):
+                if len(failed_hosts) > failure_budget:
+                    skipped_hosts.extend(wave)
+                    continue
+                if len(waves) > 1:
+                    output.info('Running wave %s of %s on %s hosts.' % (
+                        wave_count + 1, len(waves), len(wave)))
+                if wave_count:
+                    _check_scripts.next_wave()
+                (wave_results, wave_succeeded,
+                 wave_failed) = self._run_wave(
+                     params, target_params, wave, return_codes,
+                     poll_policy, _tries, _check_scripts, output,
+                     deadline, progress, timer, process)
+                host_results.update(wave_results)
+                succeeded_hosts.extend(wave_succeeded)
+                failed_hosts.extend(wave_failed)
+                if wave_count + 1 < len(waves):
+                    progress.update(wave_succeeded, wave_failed)
+        except FuncException, fex:
+            raise FuncWorkerError(str(fex))
+
+        if skipped_hosts:
+            output.info(
+                '%s hosts failed, more than the %s allowed. '
+                'Skipped %s hosts.' % (
+                    len(failed_hosts), failure_budget,
+                    len(skipped_hosts)))
+        # success set to False if too many hosts failed
+        success = (
+            len(failed_hosts) <= failure_budget and not skipped_hosts)
+
+        host_summary = {
+            'succeeded': sorted(succeeded_hosts),
+            'failed': sorted(failed_hosts),
+        }
+        if skipped_hosts:
+            host_summary['skipped'] = skipped_hosts
+        # results always holds [rc, stdout, stderr] by host. A single
+        # host also keeps the plain list as data, like replies did
+        # before steps ran on more than one host.
+        result = {
+            'results': host_results,
+            'hosts': host_summary,
+        }
+        if len(host_results) == 1:
+            result['data'] = host_results.values()[0]
+        check_summary = _check_scripts.summary()
+        if check_summary:
+            result['check_scripts'] = check_summary
+        return (success, result, called)
+
+    def _run_wave(self, params, target_params, hosts, return_codes,
+                  poll_policy, tries, check_scripts, output, deadline,
+                  progress, timer, process=normalize_result):
+        """
+        Runs the func call on `hosts` until it and the check scripts
+        succeed on every host or `tries` runs out. Returns a tuple of
+        (host_results, succeeded_hosts, failed_hosts), every host's
+        result turned into [rc, data, stderr] by `process`. Raises
+        FuncWorkerTimeout once `deadline` passed. Hosts whose results
+        arrive while the job runs are handed to `progress`, the stages
+        are timed by `timer`.
+        """
+        # func fans the job out to every matched minion and
+        # reports back a result per host.
+        with timer.stage('client'):
+            client = self._client_pool.acquire(hosts, async_mode=True)
+        # Func syntax can be kind of weird, as all modules
+        # ("COMMAND") appear as attributes of the `client`
+        # object ..
+        target_callable = getattr(
+            # First get the client.COMMAND attribute
+            getattr(client, params['command']),
+            # Next get the client.COMMAND.SUBCOMMAND method
+            params['subcommand'])
+        target_callable_repr = "%s.%s" % (
+            params['command'],
+            params['subcommand'])
+        # called is a nice repr of the command
+        called = '%s.%s(*%s)' % (
+            params['command'], params['subcommand'], target_params)
+        (host_results, succeeded_hosts, failed_hosts) = ({}, [], list(hosts))
+
+        def report_progress(partial_results):
+            (partial, succeeded, failed) = evaluate_host_results(
+                partial_results, return_codes)
+            progress.update(succeeded, failed)
+
+        for attempt_count in range(tries):
+            self.app_logger.info("In the for loop (over _tries)")
+            if attempt_count:
+                self._metrics.retries.inc()
+            if deadline.expired():
+                raise FuncWorkerTimeout(
+                    'Timed out after %s seconds before running %s.' % (
+                        deadline.seconds, called))
+            output.debug(
+                'Invoking func method: "%s" with args: "%s"' % (
+                    str(target_callable_repr),
+                    str(target_params)))
+            # Call the fc.Client.COMMAND.SUBCOMMAND
+            # method with the collected parameters
+            with timer.stage('submit'):
+                job_id = target_callable(*target_params)
+            self.app_logger.debug("Ran job, id is: %s. "
+                                  "Polling for results now" % job_id)
+            job = self._job_tracker.register(
+                client, job_id, poll_policy, progress=report_progress)
+            with timer.stage('poll'):
+                finished = job.wait(deadline.remaining())
+            if not finished:
+                # func can not cancel a job, stop waiting on it instead
+                self._job_tracker.abandon(job)
+                raise FuncWorkerTimeout(
+                    'Timed out after %s seconds waiting for %s.' % (
+                        deadline.seconds, called))
+            results = job.result()
+            self._metrics.job_polls.observe(job.polls)
+
+            # For async jobs, func will return a dictionary for
+            # the result. Each key in the dict is a hostname, the
+            # value is a list of [return code, stdout, stderr]
+            with timer.stage('results'):
+                (host_results, succeeded_hosts,
+                 failed_hosts) = evaluate_host_results(
+                     results, return_codes, hosts, process)
+                # Cut huge outputs before they reach the logs or reply
+                self._payload.cap_results(host_results)
+            del results
+            # Thousands of hosts would make for huge log lines, only a
+            # bounded summary is logged
+            summary = self._payload.summarize(host_results)
+            self.app_logger.debug("Raw results: %s", summary)
+            output.debug("Raw response: %s" % summary)
+
+            # item 0 = return code
+            # item 1 = stdout
+            # item 2 = stderr
+            for host in failed_hosts:
+                output.info(
+                    '%s returned %s for command %s which is not a '
+                    'success return code (%s)' % (
+                        host, host_results[host][0], called,
+                        sorted(return_codes)))
+
+            if failed_hosts:
+                continue
+            if not len(check_scripts):
+                # Nothing to test with ...
+                break
+
+            # Execute the check scripts which have not passed yet.
+            with timer.stage('check_scripts'):
+                self._run_check_scripts(
+                    client, check_scripts, hosts, output, attempt_count,
+                    deadline)
+
+            # If all the check scripts passed then break the loop
+            if check_scripts.all_passed():
+                output.info('All check scripts passed!')
+                break
+
+            # check script isn't happy, try again
+            output.info(
+                'Waiting a few seconds and trying again.')
+            # Sleep for a short period before trying again
+            with timer.stage('retry_sleep'):
+                sleep(deadline.clamp(2))
+        else:
+            if not failed_hosts:
+                # The command worked but a check script never passed
+                failed_hosts = sorted(set(
+                    host for check in check_scripts.pending()
+                    for host in check.failed_hosts))
+                succeeded_hosts = [
+                    host for host in succeeded_hosts
+                    if host not in failed_hosts]
+
+        # Only clients which did not raise are reused
+        self._client_pool.release(client, hosts, async_mode=True)
+        self.app_logger.debug(
+            'Client pool: %s' % self._client_pool.stats())
+        return (host_results, succeeded_hosts, failed_hosts)
+
+    def _run_check_scripts(self, client, check_scripts, hosts, output,
+                           attempt_count, deadline):
+        """
+        Runs every check script which has not passed yet as an async
+        func job on all `hosts` at once. Stops at the first script found
+        failing on any host, the rest are abandoned and stay pending.
+        Raises FuncWorkerTimeout once `deadline` passed.
+        """
+        done = Queue.Queue()
+        jobs = {}
+        for check in check_scripts.pending():
+            output.info('Executing check_script %s.' % (
+                check.script))
+            check.start()
+            job_id = client.command.run(check.script)
+            job = self._job_tracker.register(
+                client, job_id, PollPolicy(), done)
+            jobs[job] = check
+
+        try:
+            while jobs:
+                try:
+                    job = done.get(True, deadline.remaining())
+                except Queue.Empty:
+                    raise FuncWorkerTimeout(
+                        'Timed out after %s seconds waiting for '
+                        'check scripts.' % deadline.seconds)
+                check = jobs.pop(job)
+                (check_results, passed, failed) = evaluate_host_results(
+                    job.result(), [0], hosts)
+                check.finish(failed)
+                for host in failed:
+                    output.info(
+                        '%s returned %s for check_script '
+                        '%s on attempt %s' % (
+                            host, check_results[host][0],
+                            check.script, attempt_count))
+                if failed:
+                    return
+                output.info(
+                    'check_script %s passed on %s hosts in %.2fs '
+                    'on attempt %s' % (
+                        check.script, len(passed), check.timings[-1],
+                        attempt_count))
+        finally:
+            for job in jobs:
+                self._job_tracker.abandon(job)
 
     def parse_params(self, params, command_cfg):
         """Parse the parameters and return a tuple of updated_parameters and
 target_parameters (an array of parameters to pass to our target func
-module method).
+module method). `command_cfg` is the subcommand's entry of the
+CommandIndex.
         """
         _update_params = {}
         # Now verify we have what we need (and make our target_params too)
         try:
             # Special attention for those extra-special func modules...
-            self.app_logger.debug("Looking to see if there is a special "
-                                  "parameter parser for this worker")
-            func_module = __import__("replugin.funcworker.%s" %
-                                     params['command'],
-                                     globals(),
-                                     locals())
-            func_worker = getattr(func_module, 'funcworker')
-            module_handler = getattr(func_worker, params['command'])
-
-            (_update_params,
-             target_params) = module_handler.parse_target_params(
-                 params, self.app_logger)
-            params.update(_update_params)
-        except ImportError:
-            # This module requires no special handling.
-            self.app_logger.debug("No special parameter parser required "
-                                  "for this subcommand")
-            pass
+            parser = self._parsers.lookup(
+                params['command'], params['subcommand'])
+            if parser is not None:
+                (_update_params,
+                 target_params) = parser(params, self.app_logger)
+                params.update(_update_params)
+            else:
+                # This module requires no special handling.
+                self.app_logger.debug("No special parameter parser "
+                                      "required for this subcommand")
         except ValueError, e:
             self.app_logger.error("Could not find parser or failed to parse specified "
                                   "subcommand: %s" % params['subcommand'])
@@ -354,35 +1112,27 @@ module method).
             raise FuncWorkerError(
                 'Requested subcommand for %s is not supported '
                 '(no parameter parser could be found)' % params['subcommand'])
-        except Exception, e:  # pragma: no cover
-            self.app_logger.error("Unknown exception raised: %s" % (
-                e))
-            _type, value, tb = sys.exc_info()
-            self.app_logger.error("Printing full traceback:")
-            traceback.print_exc()
-            # pdb.post_mortem(tb)
-            raise e
-        finally:
-            # TODO: Refactor this into a generalized parameter
-            # parser like the unique parsers (above)
-            if 'method_target_host' not in params:
-                self.app_logger.debug("No special parser discovered, "
-                                      "falling back to general parameter "
-                                      "parser")
-                target_params = []
-                required_params = command_cfg[params['subcommand']]
-
-                for required in required_params:
-                    if required not in params.keys():
-                        raise FuncWorkerError(
-                            'Command %s.%s requires the following params: %s. '
-                            '%s was missing.' % (
-                                params['command'],
-                                params['subcommand'],
-                                command_cfg[params['subcommand']],
-                                required))
-                    else:
-                        target_params.append(params[required])
+
+        # TODO: Refactor this into a generalized parameter
+        # parser like the unique parsers (above)
+        if 'method_target_host' not in params:
+            self.app_logger.debug("No special parser discovered, "
+                                  "falling back to general parameter "
+                                  "parser")
+            target_params = []
+            required_params = command_cfg.required
+
+            for required in required_params:
+                if required not in params.keys():
+                    raise FuncWorkerError(
+                        'Command %s.%s requires the following params: %s. '
+                        '%s was missing.' % (
+                            params['command'],
+                            params['subcommand'],
+                            list(required_params),
+                            required))
+                else:
+                    target_params.append(params[required])
 
         return (_update_params, target_params)
 
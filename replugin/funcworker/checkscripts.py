@@ -0,0 +1,113 @@
+# Copyright (C) 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+State of a step's check scripts across tries.
+"""
+
+from replugin.funcworker.timing import clock
+
+
+class CheckScript(object):
+    """
+    One check script and the outcome of its runs so far.
+    """
+
+    def __init__(self, script):
+        self.script = script
+        self.passed = False
+        self.failed_hosts = []
+        # Hosts of earlier waves the script never passed on
+        self.given_up_hosts = []
+        # Seconds each finished run took
+        self.timings = []
+        self._started = None
+
+    def start(self):
+        """
+        Mark the script as submitted.
+        """
+        self._started = clock()
+
+    def finish(self, failed_hosts):
+        """
+        Record a finished run which failed on `failed_hosts`.
+        """
+        self.timings.append(clock() - self._started)
+        self._started = None
+        self.failed_hosts = list(failed_hosts)
+        self.passed = not self.failed_hosts
+
+    def next_wave(self):
+        """
+        Make the script pending again for the next wave of hosts.
+        """
+        if not self.passed:
+            self.given_up_hosts.extend(self.failed_hosts)
+        self.passed = False
+        self.failed_hosts = []
+
+    def summary(self):
+        """
+        Returns a dict of the script's outcome for replies.
+        """
+        return {
+            'passed': self.passed and not self.given_up_hosts,
+            'runs': len(self.timings),
+            'timings': [round(timing, 3) for timing in self.timings],
+            'failed_hosts': self.given_up_hosts + self.failed_hosts,
+        }
+
+
+class CheckScripts(object):
+    """
+    The check scripts of a step. A script which passed is not run
+    again on later tries, only the ones which failed (or never got to
+    finish) are.
+    """
+
+    def __init__(self, scripts):
+        self.scripts = []
+        for script in scripts:
+            if script not in [check.script for check in self.scripts]:
+                self.scripts.append(CheckScript(script))
+
+    def __len__(self):
+        return len(self.scripts)
+
+    def pending(self):
+        """
+        Returns the scripts which have not passed yet.
+        """
+        return [check for check in self.scripts if not check.passed]
+
+    def all_passed(self):
+        """
+        True once every script passed.
+        """
+        return not self.pending()
+
+    def next_wave(self):
+        """
+        Make every script pending again for the next wave of hosts.
+        """
+        for check in self.scripts:
+            check.next_wave()
+
+    def summary(self):
+        """
+        Returns a dict of script -> outcome for replies.
+        """
+        return dict([
+            (check.script, check.summary()) for check in self.scripts])
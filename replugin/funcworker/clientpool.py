@@ -0,0 +1,89 @@
+# Copyright (C) 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Pool of reusable func overlord clients.
+"""
+
+import threading
+
+import func.overlord.client as fc
+
+
+class ClientPool(object):
+    """
+    Keeps up to `size` idle func overlord clients so steps against the
+    same hosts do not load certificates and the overlord config again.
+    Clients are keyed by their sorted set of hosts and async mode. When
+    the pool is full the least recently used client is dropped.
+
+    A client is handed to one caller at a time: acquire() takes it out
+    of the pool and release() puts it back. Clients which raised should
+    simply not be released.
+    """
+
+    def __init__(self, size=32):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        # (key, client) pairs, least recently used first
+        self._idle = []
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(hosts, async_mode=False):
+        """
+        Normalized pool key for a list (or ; separated string) of hosts.
+        """
+        if isinstance(hosts, basestring):
+            hosts = hosts.split(';')
+        return (tuple(sorted(set(hosts))), bool(async_mode))
+
+    def acquire(self, hosts, async_mode=False):
+        """
+        Returns an idle client for `hosts` or builds a new one.
+        """
+        key = self.key(hosts, async_mode)
+        with self._lock:
+            for index in range(len(self._idle) - 1, -1, -1):
+                if self._idle[index][0] == key:
+                    self.hits += 1
+                    return self._idle.pop(index)[1]
+            self.misses += 1
+        return fc.Client(";".join(key[0]), async=key[1])
+
+    def release(self, client, hosts, async_mode=False):
+        """
+        Puts `client` back in the pool for reuse.
+        """
+        if self.size < 1:
+            return
+        key = self.key(hosts, async_mode)
+        with self._lock:
+            self._idle.append((key, client))
+            del self._idle[:-self.size]
+
+    def stats(self):
+        """
+        Returns a dict of the pool size and hit rate.
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self._idle),
+                'capacity': self.size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': lookups and float(self.hits) / lookups or 0.0,
+            }
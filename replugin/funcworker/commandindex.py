@@ -0,0 +1,130 @@
+# Copyright (C) 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+The commands a worker config allows, checked once at startup.
+"""
+
+from collections import namedtuple
+
+from replugin.funcworker.polling import PollPolicy
+
+
+#: Everything the config says about one command.subcommand
+Subcommand = namedtuple('Subcommand', [
+    'command', 'subcommand', 'required', 'return_codes', 'poll_policy',
+    'timeout'])
+
+
+class CommandIndex(object):
+    """
+    Index of the command.subcommand pairs in a worker config. Every
+    top level dict which is not one of the `settings` sections is a
+    command mapping its subcommands to their required parameters.
+
+    The whole config is validated when the index is built, a broken
+    config raises ValueError right away instead of failing steps.
+    """
+
+    #: Top level sections which are not commands
+    settings = frozenset([
+        'return_codes', 'polling', 'timeouts', 'parser_modules'])
+
+    def __init__(self, config):
+        for section in self.settings:
+            if not isinstance(config.get(section, {}), dict):
+                raise ValueError('The %s config must be a dict.' % section)
+
+        self._commands = {}
+        for (command, subcommands) in config.items():
+            if command in self.settings or not isinstance(subcommands, dict):
+                continue
+            self._commands[command] = self._compile_command(
+                command, subcommands, config)
+
+        self._check_section(config, 'return_codes', self._subcommand_names())
+        self._check_section(config, 'polling', self._subcommand_names())
+        self._check_section(config, 'timeouts', self._commands)
+        self._check_section(config, 'parser_modules', self._commands)
+        # The tuple of commands is what error messages show
+        self.commands = tuple(sorted(self._commands.keys()))
+
+    def lookup(self, command, subcommand):
+        """
+        Returns the Subcommand for `command`.`subcommand`. Raises
+        KeyError if it is not configured.
+        """
+        try:
+            return self._commands[command][subcommand]
+        except TypeError:
+            raise KeyError(subcommand)
+
+    def __contains__(self, command):
+        try:
+            return command in self._commands
+        except TypeError:
+            return False
+
+    def _subcommand_names(self):
+        names = set()
+        for subcommands in self._commands.values():
+            names.update(subcommands.keys())
+        return names
+
+    def _check_section(self, config, section, known):
+        for key in config.get(section, {}).keys():
+            if key not in known:
+                raise ValueError(
+                    'The %s config names %s which is not configured.' % (
+                        section, key))
+
+    def _compile_command(self, command, subcommands, config):
+        timeout = config.get('timeouts', {}).get(command)
+        if timeout is not None:
+            try:
+                timeout = float(timeout)
+            except (TypeError, ValueError):
+                timeout = 0
+            if timeout <= 0:
+                raise ValueError(
+                    'The timeout of %s must be a number of seconds '
+                    'above 0.' % command)
+
+        compiled = {}
+        for (subcommand, required) in subcommands.items():
+            if not isinstance(required, list) or not all(
+                    [isinstance(x, basestring) for x in required]):
+                raise ValueError(
+                    'The parameters of %s.%s must be a list of names.' % (
+                        command, subcommand))
+
+            # Return codes are set per subcommand, 0 is the default
+            return_codes = config.get('return_codes', {}).get(
+                subcommand, [0])
+            if not isinstance(return_codes, list):
+                raise ValueError(
+                    'The return codes of %s must be a list.' % subcommand)
+
+            try:
+                poll_policy = PollPolicy.from_config(
+                    config.get('polling', {}).get(subcommand))
+            except (TypeError, ValueError), pe:
+                raise ValueError(
+                    'Invalid polling configuration for %s: %s' % (
+                        subcommand, pe))
+
+            compiled[subcommand] = Subcommand(
+                command, subcommand, tuple(required),
+                frozenset(return_codes), poll_policy, timeout)
+        return compiled
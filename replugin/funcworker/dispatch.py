@@ -0,0 +1,115 @@
+# Copyright (C) 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Running steps off the connection thread.
+"""
+
+import threading
+import traceback
+import Queue
+
+
+class StepExecutor(object):
+    """
+    Runs submitted steps on a fixed number of threads. At most
+    `max_in_flight` steps run at once, the rest wait in line.
+    """
+
+    def __init__(self, app_logger, max_in_flight):
+        if max_in_flight < 1:
+            raise ValueError('max_in_flight must be at least 1.')
+        self.app_logger = app_logger
+        self.max_in_flight = max_in_flight
+        self._queue = Queue.Queue()
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        for x in range(max_in_flight):
+            thread = threading.Thread(
+                target=self._run, name='func-step-%s' % x)
+            thread.daemon = True
+            thread.start()
+
+    def submit(self, step, *args, **kwargs):
+        """
+        Queue `step` to be called with the given arguments.
+        """
+        self._queue.put((step, args, kwargs))
+
+    def in_flight(self):
+        """
+        Number of steps currently running.
+        """
+        with self._lock:
+            return self._in_flight
+
+    def join(self):
+        """
+        Block until every submitted step has run.
+        """
+        self._queue.join()
+
+    def _run(self):
+        while True:
+            (step, args, kwargs) = self._queue.get()
+            with self._lock:
+                self._in_flight += 1
+            try:
+                step(*args, **kwargs)
+            except Exception, e:
+                self.app_logger.error(
+                    'Unhandled error while running a step: %s' % e)
+                self.app_logger.error(traceback.format_exc())
+            finally:
+                with self._lock:
+                    self._in_flight -= 1
+                self._queue.task_done()
+
+
+class Outbox(object):
+    """
+    Holds publishes made from step threads until the connection's I/O
+    loop sends them. pika connections are not thread safe, so only the
+    I/O thread may talk to the broker.
+    """
+
+    def __init__(self):
+        self.io_thread = None
+        self._queue = Queue.Queue()
+
+    def on_io_thread(self):
+        """
+        True if called from the I/O thread (or before it is known).
+        """
+        return (self.io_thread is None or
+                self.io_thread is threading.current_thread())
+
+    def put(self, method, *args, **kwargs):
+        """
+        Queue `method` to be called with the given arguments.
+        """
+        self._queue.put((method, args, kwargs))
+
+    def drain(self):
+        """
+        Call every queued method in order. Returns how many ran.
+        """
+        count = 0
+        while True:
+            try:
+                (method, args, kwargs) = self._queue.get_nowait()
+            except Queue.Empty:
+                return count
+            method(*args, **kwargs)
+            count += 1
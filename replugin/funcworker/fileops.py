@@ -19,7 +19,12 @@ File operations specific func worker
 import types
 import re
 
-from replugin.funcworker import block_bad_chars
+from func.utils import is_error
+
+from replugin.funcworker import block_bad_chars, normalize_result
+
+# Most matching lines FindInFiles replies with
+MAX_MATCHES = 1000
 
 
 def parse_target_params(params, app_logger):
@@ -31,20 +36,17 @@ def parse_target_params(params, app_logger):
     separate functions. We will try to find a parser for the subcommand,
     evaluate with the provided parameters, and finally return the result.
     """
-    try:
-        parser_name = "_parse_%s" % str(params['subcommand'])
-        parser = globals()[parser_name]
-        app_logger.debug("Found parser: %s" % parser_name)
-    except KeyError, e:
+    parser = PARSERS.get(str(params['subcommand']))
+    if parser is None:
         # There is no parser for the provided subcommand. Most likely
         # a typo. Either way, there's nothing we can do. Oh well.
         app_logger.error("No parser found for the given subcommand: %s" % (
             params['subcommand']))
-        err = ValueError("Unknown subcommand: %s - %s " % (
-            params['subcommand'],
-            str(e)))
+        err = ValueError("Unknown subcommand: %s" % (
+            params['subcommand']))
         err.subcommand = params['subcommand']
         raise err
+    app_logger.debug("Found parser: _parse_%s" % params['subcommand'])
 
     result = parser(params, app_logger)
     block_bad_chars(result[1])
@@ -293,9 +295,58 @@ def _parse_Tar(params, app_logger):
         raise TypeError('%s must be given as a parameter.' % ke)
 
 
-def process_result(result):
+# Subcommand -> parser used by parse_target_params
+PARSERS = {
+    'ChangeOwnership': _parse_ChangeOwnership,
+    'ChangePermissions': _parse_ChangePermissions,
+    'FindInFiles': _parse_FindInFiles,
+    'Move': _parse_Move,
+    'Remove': _parse_Remove,
+    'Touch': _parse_Touch,
+    'Tar': _parse_Tar,
+}
+
+
+def _process_FindInFiles(stdout):
+    """
+    Returns the lines grep matched, at most MAX_MATCHES of them, and
+    how many there were. The output is walked once without splitting
+    all of it up.
+    """
+    matches = []
+    count = 0
+    start = 0
+    while start < len(stdout):
+        end = stdout.find('\n', start)
+        if end == -1:
+            end = len(stdout)
+        if count < MAX_MATCHES:
+            matches.append(stdout[start:end])
+        count += 1
+        start = end + 1
+    return {
+        'count': count,
+        'matches': matches,
+        'truncated': count > len(matches),
+    }
+
+
+# Subcommand -> result processor used by process_result
+PROCESSORS = {
+    'FindInFiles': _process_FindInFiles,
+}
+
+
+def process_result(subcommand, result):
     """
     Process the result of the func command and return something
-    consumable by the func worker.
+    consumable by the func worker: [rc, data, stderr]. For
+    fileops:FindInFiles the data is the list of matches.
     """
-    raise NotImplementedError()
+    processor = PROCESSORS.get(subcommand)
+    if processor is None or is_error(result):
+        return normalize_result(result)
+    result = normalize_result(result)
+    if not isinstance(result[1], basestring):
+        return result
+    return [result[0], processor(result[1]), result[2]]
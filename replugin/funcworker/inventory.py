@@ -0,0 +1,112 @@
+# Copyright (C) 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Cached inventory of the minions known to the overlord.
+"""
+
+import fnmatch
+import threading
+
+import func.overlord.client as fc
+import func.CommonErrors
+
+from replugin.funcworker.timing import clock
+
+
+class MinionInventory(object):
+    """
+    Keeps the overlord's full minion list for `ttl` seconds and matches
+    host globs against it locally, the same way func matches them
+    against its certificates.
+
+    A glob matching nothing forces a refresh, in case the minion is
+    new, but at most once every `min_refresh` seconds so a typo can not
+    hammer the overlord. Group globs (@group) and multi host specs are
+    not cached and are handed to `fallback` instead.
+    """
+
+    def __init__(self, ttl, fallback, min_refresh=5):
+        self.ttl = ttl
+        self.min_refresh = min_refresh
+        self.fallback = fallback
+        self.hits = 0
+        self.misses = 0
+        self.refreshes = 0
+        self._minions = []
+        self._names = set()
+        self._fetched = None
+        self._lock = threading.Lock()
+
+    def lookup(self, glob, app_logger):
+        """
+        Look up the minions matching `glob`. Returns a tuple of
+        (minions, unmatched) like lookup_glob.
+        """
+        if glob.startswith('@') or ';' in glob:
+            return self.fallback(glob, app_logger)
+
+        with self._lock:
+            refreshed = False
+            if self._expired(self.ttl):
+                self._refresh(app_logger)
+                refreshed = True
+            minions = self._match(glob)
+            if not minions and self._expired(self.min_refresh):
+                # The minion may be brand new
+                app_logger.debug(
+                    "No cached minion matches %s, refreshing" % glob)
+                self._refresh(app_logger)
+                refreshed = True
+                minions = self._match(glob)
+            if refreshed:
+                self.misses += 1
+            else:
+                self.hits += 1
+
+        if not minions:
+            return ([], glob)
+        return (minions, None)
+
+    def stats(self):
+        """
+        Returns a dict of the cache counters.
+        """
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'refreshes': self.refreshes,
+                'minions': len(self._minions),
+            }
+
+    def _expired(self, age):
+        return self._fetched is None or clock() - self._fetched >= age
+
+    def _match(self, glob):
+        if glob in self._names:
+            return [glob]
+        return fnmatch.filter(self._minions, glob)
+
+    def _refresh(self, app_logger):
+        app_logger.debug("Refreshing the minion inventory")
+        try:
+            minions = list(fc.Client('*').list_minions())
+        except func.CommonErrors.Func_Client_Exception:
+            # No minions at all
+            minions = []
+        self._minions = minions
+        self._names = set(minions)
+        self._fetched = clock()
+        self.refreshes += 1
@@ -0,0 +1,289 @@
+# Copyright (C) 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Worker metrics in the Prometheus text format.
+"""
+
+import threading
+
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+
+def _labels(names, values):
+    """
+    Returns the {name="value",...} part of a sample line.
+    """
+    if not names:
+        return ''
+    return '{%s}' % ','.join([
+        '%s="%s"' % (name, str(value).replace('\\', '\\\\').replace(
+            '"', '\\"').replace('\n', '\\n'))
+        for (name, value) in zip(names, values)])
+
+
+class Counter(object):
+    """
+    A count which only goes up, kept per set of label values.
+    """
+
+    kind = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, labels=(), amount=1):
+        """
+        Adds `amount` to the count of the label values `labels`.
+        """
+        with self._lock:
+            key = tuple(labels)
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, labels=()):
+        """
+        Returns the count of the label values `labels`.
+        """
+        with self._lock:
+            return self._values.get(tuple(labels), 0)
+
+    def samples(self):
+        with self._lock:
+            return [(self.name + _labels(self.labels, key), value)
+                    for (key, value) in sorted(self._values.items())]
+
+
+class Gauge(object):
+    """
+    A value read from `function` whenever the metrics are collected.
+    """
+
+    kind = 'gauge'
+
+    def __init__(self, name, help, function):
+        self.name = name
+        self.help = help
+        self.function = function
+
+    def samples(self):
+        return [(self.name, self.function())]
+
+
+class CounterReader(Gauge):
+    """
+    A count which only goes up, kept elsewhere and read from
+    `function` whenever the metrics are collected.
+    """
+
+    kind = 'counter'
+
+
+class Histogram(object):
+    """
+    Counts observed values into cumulative `buckets`, kept per set of
+    label values.
+    """
+
+    kind = 'histogram'
+
+    def __init__(self, name, help, buckets, labels=()):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(sorted(buckets))
+        self.labels = tuple(labels)
+        # label values -> [bucket counts, count, sum]
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, labels=()):
+        """
+        Records `value` for the label values `labels`.
+        """
+        with self._lock:
+            entry = self._values.setdefault(
+                tuple(labels), [[0] * len(self.buckets), 0, 0.0])
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[0][index] += 1
+            entry[1] += 1
+            entry[2] += value
+
+    def count(self, labels=()):
+        """
+        Returns how many values were observed for `labels`.
+        """
+        with self._lock:
+            return self._values.get(tuple(labels), [None, 0])[1]
+
+    def samples(self):
+        samples = []
+        names = self.labels + ('le',)
+        with self._lock:
+            for (key, (buckets, count, total)) in sorted(
+                    self._values.items()):
+                for bound, bucket in zip(self.buckets, buckets):
+                    samples.append((
+                        self.name + '_bucket' + _labels(
+                            names, key + (repr(float(bound)),)),
+                        bucket))
+                samples.append((
+                    self.name + '_bucket' + _labels(names, key + ('+Inf',)),
+                    count))
+                samples.append((
+                    self.name + '_count' + _labels(self.labels, key),
+                    count))
+                samples.append((
+                    self.name + '_sum' + _labels(self.labels, key), total))
+        return samples
+
+
+class MetricsRegistry(object):
+    """
+    The metrics of a worker, rendered together for scraping.
+    """
+
+    def __init__(self):
+        self._metrics = []
+
+    def add(self, metric):
+        """
+        Registers `metric` and returns it.
+        """
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        """
+        Returns every metric in the Prometheus text format.
+        """
+        lines = []
+        for metric in self._metrics:
+            lines.append('# HELP %s %s' % (metric.name, metric.help))
+            lines.append('# TYPE %s %s' % (metric.name, metric.kind))
+            for (name, value) in metric.samples():
+                lines.append('%s %s' % (name, repr(float(value))))
+        return '\n'.join(lines) + '\n'
+
+
+class MetricsServer(object):
+    """
+    Serves the metrics of `registry` over HTTP on `address`:`port`
+    from a daemon thread. Any path answers with the metrics.
+    """
+
+    def __init__(self, registry, port, address='127.0.0.1'):
+        class Handler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                body = registry.render()
+                self.send_response(200)
+                self.send_header(
+                    'Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                # Scrapes are not worth a line on stderr each
+                pass
+
+        self.server = HTTPServer((address, port), Handler)
+        self.port = self.server.server_address[1]
+        self._thread = None
+
+    def start(self):
+        """
+        Starts serving in the background.
+        """
+        self._thread = threading.Thread(
+            target=self.server.serve_forever, name='func-metrics')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stops serving.
+        """
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class WorkerMetrics(MetricsRegistry):
+    """
+    The metrics a FuncWorker keeps. `in_flight` returns the number of
+    steps running, `client_pool_stats` and `inventory_stats` the
+    stats() of its ClientPool and MinionInventory.
+    """
+
+    def __init__(self, in_flight, client_pool_stats=None,
+                 inventory_stats=None):
+        MetricsRegistry.__init__(self)
+        self.steps = self.add(Counter(
+            'funcworker_steps_total',
+            'Steps processed by command, subcommand and final status.',
+            ('command', 'subcommand', 'status')))
+        self.step_seconds = self.add(Histogram(
+            'funcworker_step_seconds',
+            'Seconds from queueing a step to its final reply.',
+            (0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, 3600),
+            ('command', 'subcommand')))
+        self.job_polls = self.add(Histogram(
+            'funcworker_job_polls',
+            'Status polls until an async func job finished.',
+            (1, 2, 3, 5, 10, 20, 50, 100)))
+        self.lookup_seconds = self.add(Histogram(
+            'funcworker_glob_lookup_seconds',
+            'Seconds spent looking up the host globs of a step.',
+            (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)))
+        self.missing_hosts = self.add(Counter(
+            'funcworker_missing_hosts_total',
+            'Host globs which matched no minion.'))
+        self.retries = self.add(Counter(
+            'funcworker_retries_total',
+            'Tries run after the first one of a step.'))
+        self.in_flight = self.add(Gauge(
+            'funcworker_steps_in_flight',
+            'Steps running right now.',
+            in_flight))
+        if client_pool_stats is not None:
+            self.add(Gauge(
+                'funcworker_client_pool_size',
+                'Idle func clients kept for reuse.',
+                lambda: client_pool_stats()['size']))
+            self.add(CounterReader(
+                'funcworker_client_pool_hits_total',
+                'Func clients taken from the pool.',
+                lambda: client_pool_stats()['hits']))
+            self.add(CounterReader(
+                'funcworker_client_pool_misses_total',
+                'Func clients made because the pool had none.',
+                lambda: client_pool_stats()['misses']))
+        if inventory_stats is not None:
+            for (key, help) in (
+                    ('hits', 'Host globs matched in the minion cache.'),
+                    ('misses', 'Host globs the minion cache could not '
+                               'match.'),
+                    ('refreshes', 'Minion cache refreshes.')):
+                self.add(CounterReader(
+                    'funcworker_minion_cache_%s_total' % key, help,
+                    # key is bound now, not when the counter is read
+                    lambda key=key: inventory_stats()[key]))
+            self.add(Gauge(
+                'funcworker_minion_cache_minions',
+                'Minions in the minion cache.',
+                lambda: inventory_stats()['minions']))
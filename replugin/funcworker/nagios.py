@@ -19,6 +19,10 @@ Nagios specific func worker
 import types
 import re
 
+from func.utils import is_error
+
+from replugin.funcworker import block_bad_chars, normalize_result
+
 
 def parse_target_params(params, app_logger):
     """Parse the parameters provided by the FSM, `params`. Return the
@@ -28,22 +32,20 @@ The sub-parsers for each possible subcommand are broken into their own
 separate functions. We will try to find a parser for the subcommand,
 evaluate with the provided parameters, and finally return the result.
     """
-    try:
-        parser_name = "_parse_%s" % str(params['subcommand'])
-        parser = globals()[parser_name]
-        app_logger.debug("Found parser: %s" % parser_name)
-    except KeyError, e:
+    parser = PARSERS.get(str(params['subcommand']))
+    if parser is None:
         # There is no parser for the provided subcommand. Most likely
         # a typo. Either way, there's nothing we can do. Oh well.
         app_logger.error("No parser found for the given subcommand: %s" % (
             params['subcommand']))
-        err = ValueError("Unknown subcommand: %s - %s " % (
-            params['subcommand'],
-            str(e)))
+        err = ValueError("Unknown subcommand: %s" % (
+            params['subcommand']))
         err.subcommand = params['subcommand']
         raise err
+    app_logger.debug("Found parser: _parse_%s" % params['subcommand'])
 
     result = parser(params, app_logger)
+    block_bad_chars(result[1])
     return result
 
 
@@ -154,7 +156,58 @@ the func method it calls can vary depending on intended result.
     return (_params, _method_args)
 
 
-def process_result(result):
+# Subcommand -> parser used by parse_target_params
+PARSERS = {
+    'ScheduleDowntime': _parse_ScheduleDowntime,
+}
+
+
+# An external command written by the func nagios module, such as
+# "[1400000000] SCHEDULE_HOST_DOWNTIME;web1;1400000000;1400001800;..."
+EXTERNAL_COMMAND = re.compile(r'^(?:\[\d+\] )?([A-Z_]+);(.*)$')
+
+
+def _process_ScheduleDowntime(commands):
+    """Returns the downtime each of the nagios external `commands`
+scheduled. Commands which can not be read are kept as they are."""
+    scheduled = []
+    for command in commands:
+        match = EXTERNAL_COMMAND.match(str(command).strip())
+        if match is None:
+            scheduled.append({'command': str(command)})
+            continue
+        (name, args) = match.groups()
+        fields = args.split(';')
+        entry = {'command': name, 'host': fields[0]}
+        if name == 'SCHEDULE_SVC_DOWNTIME':
+            entry['service'] = fields[1]
+            fields = fields[1:]
+        try:
+            entry['start'] = int(fields[1])
+            entry['end'] = int(fields[2])
+        except (IndexError, ValueError):
+            pass
+        scheduled.append(entry)
+    return {'scheduled': scheduled}
+
+
+# Subcommand -> result processor used by process_result
+PROCESSORS = {
+    'ScheduleDowntime': _process_ScheduleDowntime,
+}
+
+
+def process_result(subcommand, result):
     """Process the result of the func command and return something
-consumable by the func worker."""
-    pass
+consumable by the func worker: [rc, data, stderr]. For
+nagios:ScheduleDowntime the func nagios module returns the external
+commands it wrote, the data lists the downtime they scheduled."""
+    processor = PROCESSORS.get(subcommand)
+    if processor is None or is_error(result):
+        return normalize_result(result)
+    if isinstance(result, types.StringTypes):
+        result = [result]
+    if (isinstance(result, list) and result and
+            all([isinstance(x, types.StringTypes) for x in result])):
+        return [0, processor(result), '']
+    return normalize_result(result)
@@ -0,0 +1,94 @@
+# Copyright (C) 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Registry of the special parameter parsers.
+"""
+
+import pkgutil
+
+
+class ParserRegistry(object):
+    """
+    Maps (command, subcommand) to the special parameter parser to use,
+    see README.parser. Parser modules are found and imported once by
+    discover(), lookups afterwards are plain dict lookups.
+
+    A command without a parser module uses the generic parser. A
+    command with one only supports the subcommands in its PARSERS,
+    and its process_result (if any) turns the results into replies.
+    """
+
+    def __init__(self, app_logger):
+        self.app_logger = app_logger
+        self._modules = {}
+        self._parsers = {}
+
+    def discover(self, commands, package_name, modules={}):
+        """
+        Register the parser modules for `commands`. A command's parser
+        module is the one named in `modules` (command -> module name),
+        or else the module of the package `package_name` named like the
+        command.
+        """
+        package = __import__(package_name, fromlist=['__path__'])
+        available = set([
+            name for (loader, name, ispkg)
+            in pkgutil.iter_modules(package.__path__)])
+        for command in commands:
+            if command in modules:
+                module_name = modules[command]
+            elif command in available:
+                module_name = '%s.%s' % (package_name, command)
+            else:
+                continue
+            module = __import__(module_name, fromlist=['PARSERS'])
+            if hasattr(module, 'parse_target_params'):
+                self.register(command, module)
+
+    def register(self, command, module):
+        """
+        Use `module` as the parser module of `command`.
+        """
+        parsers = getattr(module, 'PARSERS', {})
+        self.app_logger.debug('Special parameter parsers for %s: %s' % (
+            command, ", ".join(sorted(parsers.keys()))))
+        self._modules[command] = module
+        for subcommand in parsers.keys():
+            self._parsers[(command, subcommand)] = module.parse_target_params
+
+    def result_processor(self, command, subcommand):
+        """
+        Returns a callable turning one host's raw func result for
+        `command`.`subcommand` into [rc, data, stderr], or None if the
+        command's parser module has no process_result.
+        """
+        module = self._modules.get(command)
+        process = getattr(module, 'process_result', None)
+        if process is None:
+            return None
+        return lambda result: process(str(subcommand), result)
+
+    def lookup(self, command, subcommand):
+        """
+        Returns the parser for `command`.`subcommand`, or None if the
+        generic parser applies. Raises ValueError for subcommands the
+        command's parser module does not know.
+        """
+        parser = self._parsers.get((command, str(subcommand)))
+        if parser is None and command in self._modules:
+            err = ValueError('Unknown subcommand: %s' % subcommand)
+            err.subcommand = subcommand
+            raise err
+        return parser
@@ -0,0 +1,127 @@
+# Copyright (C) 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Size limits, compression and chunking of step results.
+"""
+
+import base64
+import json
+import zlib
+
+
+class ResultPayload(object):
+    """
+    Keeps the results of a step bounded on their way to the logs and
+    the reply.
+
+    The stdout and stderr of every host are cut to `max_output` bytes,
+    keeping the start and the end of the output. With `compress` the
+    reply data is sent as base64 encoded zlib compressed JSON. Reply
+    data larger than `chunk_size` bytes is sent as a series of chunks
+    ahead of the final reply. 0 turns a limit off.
+    """
+
+    def __init__(self, max_output=1048576, compress=False, chunk_size=0):
+        if max_output < 0 or chunk_size < 0:
+            raise ValueError('Result size limits can not be negative.')
+        self.max_output = max_output
+        self.compress = compress
+        self.chunk_size = chunk_size
+
+    def cap(self, text):
+        """
+        Returns `text` cut to max_output bytes. The middle is replaced
+        by a note of how many bytes were cut.
+        """
+        if (not self.max_output or not isinstance(text, basestring) or
+                len(text) <= self.max_output):
+            return text
+        head = self.max_output // 2
+        tail = self.max_output - head
+        return '%s\n... [%s bytes cut] ...\n%s' % (
+            text[:head], len(text) - self.max_output, text[-tail:])
+
+    def cap_results(self, host_results):
+        """
+        Cuts the stdout and stderr of every [rc, stdout, stderr] entry
+        of `host_results` in place. Returns `host_results`.
+        """
+        for host, result in host_results.items():
+            host_results[host] = [result[0]] + [
+                self.cap(item) for item in result[1:]]
+        return host_results
+
+    def summarize(self, host_results):
+        """
+        Returns a text of `host_results` for the logs: the number of
+        hosts, how many returned each return code and the results of
+        the first hosts. It is cut to max_output bytes as a whole, and
+        only the hosts fitting in are turned into text at all.
+        """
+        codes = {}
+        for result in host_results.values():
+            try:
+                codes[result[0]] = codes.get(result[0], 0) + 1
+            except TypeError:
+                # Not a return code
+                codes['other'] = codes.get('other', 0) + 1
+        shown = []
+        size = 0
+        for host in sorted(host_results.keys()):
+            if self.max_output and size >= self.max_output:
+                break
+            shown.append('%s: %s' % (host, host_results[host]))
+            size += len(shown[-1])
+        text = '%s hosts, return codes %s. %s' % (
+            len(host_results), codes, '; '.join(shown))
+        if len(shown) < len(host_results):
+            text += ' ... and %s more hosts' % (
+                len(host_results) - len(shown))
+        return self.cap(text)
+
+    def encode(self, data):
+        """
+        Returns a tuple of (encoding, bodies) for reply `data`. Without
+        compression or chunking the encoding is None and the only body
+        is `data` itself. Otherwise the bodies are pieces of a string
+        and encoding names how to decode them once joined.
+        """
+        if not self.compress and not self.chunk_size:
+            return (None, [data])
+        body = json.dumps(data)
+        encoding = 'json'
+        if self.compress:
+            body = base64.b64encode(zlib.compress(body))
+            encoding = 'json+zlib+base64'
+        if not self.chunk_size or len(body) <= self.chunk_size:
+            if encoding == 'json':
+                # Small enough, no need to encode it at all
+                return (None, [data])
+            return (encoding, [body])
+        return (encoding, [body[index:index + self.chunk_size]
+                           for index in range(
+                               0, len(body), self.chunk_size)])
+
+
+def decode(encoding, bodies):
+    """
+    Joins reply `bodies` sent with `encoding` back into the data.
+    """
+    body = ''.join(bodies)
+    if encoding == 'json+zlib+base64':
+        body = zlib.decompress(base64.b64decode(body))
+    elif encoding != 'json':
+        raise ValueError('Unknown result encoding %s' % encoding)
+    return json.loads(body)
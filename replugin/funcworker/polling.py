@@ -0,0 +1,274 @@
+# Copyright (C) 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Polling policies, deadlines and tracking for async func jobs.
+"""
+
+import random
+import threading
+
+import func.jobthing
+
+from replugin.funcworker.timing import clock
+
+
+class PollPolicy(object):
+    """
+    Describes how long to wait between job_status polls of an async
+    func job. The first wait is short so quick jobs return quickly,
+    every following wait grows by `factor` until it reaches `maximum`.
+    Each wait is spread by +/- `jitter` (a fraction) so jobs started
+    together do not poll the overlord in lock step.
+    """
+
+    #: Keys which may be set for a subcommand in the 'polling' config
+    options = ('first', 'factor', 'maximum', 'jitter')
+
+    def __init__(self, first=0.25, factor=2.0, maximum=30.0, jitter=0.1):
+        if first <= 0 or maximum <= 0:
+            raise ValueError('Poll intervals must be greater than 0.')
+        if factor < 1:
+            raise ValueError('The poll backoff factor can not be below 1.')
+        if not 0 <= jitter < 1:
+            raise ValueError('Poll jitter must be between 0 and 1.')
+        self.first = float(first)
+        self.factor = float(factor)
+        self.maximum = float(maximum)
+        self.jitter = float(jitter)
+
+    @classmethod
+    def from_config(cls, config):
+        """
+        Build a policy from a 'polling' config entry such as
+        {"first": 5, "maximum": 60}. Missing keys use the defaults.
+        """
+        if not config:
+            return cls()
+        for key in config.keys():
+            if key not in cls.options:
+                raise ValueError(
+                    'Unknown polling option %s. Valid options: %s' % (
+                        key, ", ".join(cls.options)))
+        return cls(**dict([(str(k), v) for k, v in config.items()]))
+
+    def delays(self):
+        """
+        Generator of the seconds to wait before each following poll.
+        """
+        delay = min(self.first, self.maximum)
+        while True:
+            spread = 1 + random.uniform(-self.jitter, self.jitter)
+            yield min(delay * spread, self.maximum)
+            delay = min(delay * self.factor, self.maximum)
+
+    def __repr__(self):
+        return 'PollPolicy(first=%s, factor=%s, maximum=%s, jitter=%s)' % (
+            self.first, self.factor, self.maximum, self.jitter)
+
+
+class Deadline(object):
+    """
+    The point in time a step has to be done by, `seconds` from now.
+    Without `seconds` the deadline never passes.
+    """
+
+    def __init__(self, seconds=None):
+        self.seconds = seconds
+        self._at = None
+        if seconds is not None:
+            self._at = clock() + seconds
+
+    def remaining(self):
+        """
+        Seconds left, or None if there is no deadline.
+        """
+        if self._at is None:
+            return None
+        return max(0.0, self._at - clock())
+
+    def expired(self):
+        """
+        True once the deadline has passed.
+        """
+        return self._at is not None and clock() >= self._at
+
+    def within(self, seconds):
+        """
+        Returns a Deadline `seconds` from now, but no later than this
+        one.
+        """
+        deadline = Deadline(seconds)
+        if self._at is not None and (
+                deadline._at is None or self._at < deadline._at):
+            deadline.seconds = self.seconds
+            deadline._at = self._at
+        return deadline
+
+    def clamp(self, seconds):
+        """
+        Returns `seconds` cut down to the time left.
+        """
+        remaining = self.remaining()
+        if remaining is None:
+            return seconds
+        return min(seconds, remaining)
+
+
+class TrackedJob(object):
+    """
+    An async func job registered with a JobTracker.
+    """
+
+    def __init__(self, client, job_id, policy, done=None, progress=None):
+        self.client = client
+        self.job_id = job_id
+        self.polls = 0
+        self.due = clock()
+        self._delays = policy.delays()
+        self._done = done
+        self._progress = progress
+        self._results = None
+        self._error = None
+        self._finished = threading.Event()
+
+    def wait(self, timeout=None):
+        """
+        Block until the job is finished or `timeout` seconds passed.
+        Returns True if the job is finished.
+        """
+        self._finished.wait(timeout)
+        return self._finished.is_set()
+
+    def result(self):
+        """
+        Wait for the job and return its results. Errors raised while
+        polling the job are raised again here.
+        """
+        self.wait()
+        if self._error is not None:
+            raise self._error
+        return self._results
+
+    def _reschedule(self, now):
+        self.due = now + self._delays.next()
+
+    def _finish(self, results=None, error=None):
+        self._results = results
+        self._error = error
+        self._finished.set()
+        if self._done is not None:
+            self._done.put(self)
+
+
+class JobTracker(object):
+    """
+    Polls the status of every registered async func job from a single
+    thread. The jobs whose PollPolicy says they are due are polled,
+    and waiters of finished jobs are woken. The thread then sleeps
+    until the next job is due, but never longer than `interval`
+    seconds. It exits while there is nothing left to track.
+    """
+
+    def __init__(self, app_logger, interval=0.25):
+        self.app_logger = app_logger
+        self.interval = interval
+        self._jobs = set()
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+
+    def register(self, client, job_id, policy, done=None, progress=None):
+        """
+        Start tracking `job_id`, polled through `client` as described
+        by `policy`. Returns the TrackedJob to wait on. If a Queue is
+        given as `done` the job is put on it once finished, so callers
+        can wait on many jobs at once. `progress` is called with the
+        partial results of every poll of an unfinished job.
+        """
+        job = TrackedJob(client, job_id, policy, done, progress)
+        with self._lock:
+            self._jobs.add(job)
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name='func-job-tracker')
+                self._thread.daemon = True
+                self._thread.start()
+        self._wakeup.set()
+        return job
+
+    def abandon(self, job):
+        """
+        Stop polling `job`. Its waiters are not woken.
+        """
+        self.app_logger.debug("Abandoning job %s" % job.job_id)
+        self._forget(job)
+
+    def outstanding(self):
+        """
+        Number of jobs which have not finished yet.
+        """
+        with self._lock:
+            return len(self._jobs)
+
+    def _run(self):
+        while True:
+            self._wakeup.clear()
+            with self._lock:
+                if not self._jobs:
+                    self._thread = None
+                    return
+                now = clock()
+                due = [job for job in self._jobs if job.due <= now]
+            for job in due:
+                self._poll(job)
+            with self._lock:
+                next_due = min([job.due for job in self._jobs] or [None])
+            wait = self.interval
+            if next_due is not None:
+                wait = max(0, min(wait, next_due - clock()))
+            self._wakeup.wait(wait)
+
+    def _poll(self, job):
+        try:
+            (status, results) = job.client.job_status(job.job_id)
+        except Exception, e:
+            self.app_logger.error(
+                "Polling job %s failed: %s" % (job.job_id, e))
+            self._forget(job)
+            job._finish(error=e)
+            return
+
+        job.polls += 1
+        if status == func.jobthing.JOB_ID_FINISHED:
+            self.app_logger.debug("Job %s finished after %s polls" % (
+                job.job_id, job.polls))
+            self._forget(job)
+            job._finish(results=results)
+        else:
+            job._reschedule(clock())
+            self.app_logger.debug(
+                "Waiting for JOB_ID_FINISHED on job %s. Status: %s" % (
+                    job.job_id, status))
+            if job._progress is not None and results:
+                try:
+                    job._progress(results)
+                except Exception, e:
+                    self.app_logger.error(
+                        "Reporting progress of job %s failed: %s" % (
+                            job.job_id, e))
+
+    def _forget(self, job):
+        with self._lock:
+            self._jobs.discard(job)
@@ -0,0 +1,87 @@
+# Copyright (C) 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Progress messages for steps running on many hosts.
+"""
+
+import threading
+
+from replugin.funcworker.timing import clock
+
+
+class ProgressReporter(object):
+    """
+    Collects the hosts whose results arrived and hands them to `send`
+    as compact progress messages. Hosts arriving within `interval`
+    seconds of the last message wait for the next one, so a step on
+    thousands of hosts sends a few messages instead of thousands. An
+    `interval` of 0 turns progress messages off.
+    """
+
+    def __init__(self, send, interval, total):
+        self.send = send
+        self.interval = interval
+        self.total = total
+        self.sent = 0
+        # host -> True if it succeeded
+        self._reported = {}
+        self._pending = {}
+        self._last = None
+        self._lock = threading.Lock()
+
+    def update(self, succeeded, failed):
+        """
+        Note the latest outcome of the given hosts and send a message
+        if one is due. Hosts are only reported again if their outcome
+        changed.
+        """
+        if self.interval <= 0:
+            return
+        with self._lock:
+            for (hosts, outcome) in ((succeeded, True), (failed, False)):
+                for host in hosts:
+                    if self._reported.get(host) != outcome:
+                        self._pending[host] = outcome
+                    else:
+                        self._pending.pop(host, None)
+            if not self._pending:
+                return
+            now = clock()
+            if self._last is not None and now - self._last < self.interval:
+                return
+            self._last = now
+            message = self._message()
+        self.send(message)
+
+    def _message(self):
+        succeeded = []
+        failed = []
+        for host, outcome in self._pending.items():
+            self._reported[host] = outcome
+            if outcome:
+                succeeded.append(host)
+            else:
+                failed.append(host)
+        self._pending = {}
+        self.sent += 1
+        return {
+            'status': 'progress',
+            'data': {
+                'succeeded': sorted(succeeded),
+                'failed': sorted(failed),
+                'done': len(self._reported),
+                'total': self.total,
+            },
+        }
@@ -16,12 +16,15 @@
 Puppet specific func worker
 """
 
+import itertools
 import types
 import re
 
 from datetime import datetime as dt
 
-from replugin.funcworker import block_bad_chars
+from func.utils import is_error
+
+from replugin.funcworker import block_bad_chars, normalize_result
 
 NOW = dt.now()
 
@@ -34,20 +37,17 @@ The sub-parsers for each possible subcommand are broken into their own
 separate functions. We will try to find a parser for the subcommand,
 evaluate with the provided parameters, and finally return the result.
     """
-    try:
-        parser_name = "_parse_%s" % str(params['subcommand'])
-        parser = globals()[parser_name]
-        app_logger.debug("Found parser: %s" % parser_name)
-    except KeyError, e:
+    parser = PARSERS.get(str(params['subcommand']))
+    if parser is None:
         # There is no parser for the provided subcommand. Most likely
         # a typo. Either way, there's nothing we can do. Oh well.
         app_logger.error("No parser found for the given subcommand: %s" % (
             params['subcommand']))
-        err = ValueError("Unknown subcommand: %s - %s " % (
-            params['subcommand'],
-            str(e)))
+        err = ValueError("Unknown subcommand: %s" % (
+            params['subcommand']))
         err.subcommand = params['subcommand']
         raise err
+    app_logger.debug("Found parser: _parse_%s" % params['subcommand'])
 
     result = parser(params, app_logger)
     block_bad_chars(result[1])
@@ -188,7 +188,79 @@ def _parse_Disable(params, app_logger):
     return (_params, _method_args)
 
 
-def process_result(result):
+# Subcommand -> parser used by parse_target_params
+PARSERS = {
+    'Run': _parse_Run,
+    'Enable': _parse_Enable,
+    'Disable': _parse_Disable,
+}
+
+
+# Lines of a puppet agent run, such as
+# "Notice: /Stage[main]/Foo/File[/etc/foo]/content: content changed ..."
+REPORT_LINE = re.compile(
+    r'^(info|notice|warning|err(?:or)?): '
+    r'(?:(/Stage\[[^\n]*?\])(?:/[a-z_]+)?: )?(.*)$',
+    re.M | re.I)
+FINISHED_RUN = re.compile(r'Finished catalog run in ([0-9.]+) seconds')
+CONFIG_VERSION = re.compile(r"Applying configuration version '([^']*)'")
+
+
+def _process_Run(stdout, stderr):
+    """Sum up the output of puppet agent --test in one pass over
+stdout and stderr: the resources changed, the errors, how many
+warnings there were, the configuration version applied and how long
+the run took."""
+    summary = {
+        'changes': 0,
+        'changed': [],
+        'errors': [],
+        'warnings': 0,
+        'version': None,
+        'seconds': None,
+    }
+    changed = set()
+    matches = itertools.chain(
+        REPORT_LINE.finditer(stdout), REPORT_LINE.finditer(stderr))
+    for match in matches:
+        (level, resource, message) = match.groups()
+        level = level.lower()
+        if level.startswith('err'):
+            summary['errors'].append(
+                resource and '%s: %s' % (resource, message) or message)
+        elif level == 'warning':
+            summary['warnings'] += 1
+        elif resource is not None and level == 'notice':
+            summary['changes'] += 1
+            changed.add(resource)
+        elif level == 'notice':
+            finished = FINISHED_RUN.search(message)
+            if finished:
+                summary['seconds'] = float(finished.group(1))
+            elif 'administratively disabled' in message:
+                summary['disabled'] = True
+        elif level == 'info':
+            version = CONFIG_VERSION.search(message)
+            if version:
+                summary['version'] = version.group(1)
+    summary['changed'] = sorted(changed)
+    return summary
+
+
+# Subcommand -> result processor used by process_result
+PROCESSORS = {
+    'Run': _process_Run,
+}
+
+
+def process_result(subcommand, result):
     """Process the result of the func command and return something
-consumable by the func worker."""
-    raise NotImplementedError
+consumable by the func worker: [rc, data, stderr]. For puppet:Run the
+data sums up the run instead of holding all of its output."""
+    processor = PROCESSORS.get(subcommand)
+    if processor is None or is_error(result):
+        return normalize_result(result)
+    result = normalize_result(result)
+    if not isinstance(result[1], basestring):
+        return result
+    return [result[0], processor(result[1], str(result[2])), result[2]]
@@ -0,0 +1,126 @@
+# Copyright (C) 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Timing the stages of a step.
+"""
+
+import ctypes
+import ctypes.util
+import os
+import sys
+import threading
+
+from contextlib import contextmanager
+
+
+class _Timespec(ctypes.Structure):
+    _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+
+def _monotonic_clock():
+    """
+    Returns a function giving the seconds of CLOCK_MONOTONIC through
+    clock_gettime of the C library (librt on older glibc), or None if
+    there is none to call.
+    """
+    # The CLOCK_MONOTONIC id differs between systems
+    clock_id = sys.platform == 'darwin' and 6 or 1
+    for name in ('c', 'rt'):
+        path = ctypes.util.find_library(name)
+        if path is None:
+            continue
+        try:
+            clock_gettime = ctypes.CDLL(path, use_errno=True).clock_gettime
+        except (OSError, AttributeError):
+            continue
+        clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(_Timespec)]
+        clock_gettime.restype = ctypes.c_int
+
+        def monotonic(clock_gettime=clock_gettime):
+            timespec = _Timespec()
+            if clock_gettime(clock_id, ctypes.byref(timespec)) != 0:
+                errno = ctypes.get_errno()
+                raise OSError(errno, os.strerror(errno))
+            return timespec.tv_sec + timespec.tv_nsec * 1e-9
+
+        try:
+            monotonic()
+        except OSError:
+            continue
+        return monotonic
+    return None
+
+
+def _elapsed_clock():
+    """
+    Returns the seconds os.times counts in clock ticks since a fixed
+    point.
+    """
+    return os.times()[4]
+
+
+#: Seconds from a fixed point which never jump, unlike time.time when
+#: the wall clock is set. Python 2 has no time.monotonic, so this is
+#: clock_gettime(CLOCK_MONOTONIC), or else the coarser os.times.
+clock = _monotonic_clock() or _elapsed_clock
+
+
+class StageTimer(object):
+    """
+    Adds up the seconds a step spends in each of its stages, such as
+    host lookups or waiting on func jobs. A stage entered several
+    times (every try, every wave) sums up all of them. The clock
+    starts when the timer is made.
+    """
+
+    def __init__(self):
+        self._start = clock()
+        self._stages = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def stage(self, name):
+        """
+        Context manager adding the time spent in its block to `name`.
+        """
+        start = clock()
+        try:
+            yield
+        finally:
+            self.add(name, clock() - start)
+
+    def add(self, name, seconds):
+        """
+        Adds `seconds` to the stage `name`.
+        """
+        with self._lock:
+            self._stages[name] = self._stages.get(name, 0.0) + seconds
+
+    def elapsed(self):
+        """
+        Seconds since the timer was made.
+        """
+        return clock() - self._start
+
+    def summary(self):
+        """
+        Returns a dict of the seconds spent in each stage and in total,
+        rounded to milliseconds.
+        """
+        with self._lock:
+            summary = dict([(name, round(seconds, 3))
+                            for name, seconds in self._stages.items()])
+        summary['total'] = round(self.elapsed(), 3)
+        return summary
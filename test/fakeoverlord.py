@@ -0,0 +1,198 @@
+# Copyright (C) 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+In-process stand-in for a func overlord and its minions.
+"""
+
+import fnmatch
+import itertools
+import random
+import threading
+import time
+
+import func.jobthing
+import func.CommonErrors
+
+
+class FakeOverlord(object):
+    """
+    Pretends to be the func overlord of `minions`. Use client() in place
+    of func.overlord.client.Client:
+
+        overlord = FakeOverlord(['web%s' % x for x in range(100)],
+                                latency=(0.01, 0.5), failure_rate=0.02)
+        with mock.patch('func.overlord.client.Client', overlord.client):
+            ...
+
+    Every module call (client.yumcmd.update(...), client.command.run(...)
+    and so on) runs on each targeted minion. A minion answers after
+    `latency` seconds: a number, a (low, high) range picked from
+    uniformly, or a callable given a random.Random. It fails (return
+    code 1) with the chance `failure_rate`, and writes `output_size`
+    bytes of stdout. `seed` makes runs repeatable.
+
+    Methods listed in `canned` ("module.method" or a whole "module")
+    answer with the value given there instead, or what it returns when
+    called with the host and the call's arguments.
+    """
+
+    def __init__(self, minions, latency=0, failure_rate=0.0,
+                 output_size=0, seed=None, canned={}):
+        self.minions = list(minions)
+        self._names = set(self.minions)
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.output_size = output_size
+        self.canned = canned
+        self.random = random.Random(seed)
+        # (server_spec, module, method, args) of every module call
+        self.calls = []
+        self.polls = 0
+        self._jobs = {}
+        self._job_ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def client(self, server_spec, async=False, **kwargs):
+        """
+        Returns a FakeClient for `server_spec`, like func's Client.
+        """
+        return FakeClient(self, server_spec, async)
+
+    def match(self, server_spec):
+        """
+        Returns the minions matching the ; separated globs of
+        `server_spec`, raising Func_Client_Exception like func if a
+        glob matches nothing.
+        """
+        found = []
+        for glob in server_spec.split(';'):
+            if glob in self._names:
+                found.append(glob)
+                continue
+            matched = fnmatch.filter(self.minions, glob)
+            if not matched:
+                raise func.CommonErrors.Func_Client_Exception(
+                    'Can not find any host matching "%s"' % glob)
+            found.extend(matched)
+        return found
+
+    def run(self, server_spec, module, method, args):
+        """
+        Starts `module`.`method` on the minions of `server_spec`.
+        Returns the job id.
+        """
+        hosts = self.match(server_spec)
+        now = time.time()
+        with self._lock:
+            self.calls.append((server_spec, module, method, args))
+            job = {}
+            for host in hosts:
+                job[host] = (now + self._latency(),
+                             self._result(host, module, method, args))
+            job_id = 'job-%s' % self._job_ids.next()
+            self._jobs[job_id] = job
+        return job_id
+
+    def job_status(self, job_id):
+        """
+        Returns (status, results) of `job_id` like func: the results of
+        the minions done so far, finished once all of them are.
+        """
+        now = time.time()
+        with self._lock:
+            self.polls += 1
+            job = self._jobs[job_id]
+            results = dict([
+                (host, result) for (host, (done, result)) in job.items()
+                if done <= now])
+        if len(results) == len(job):
+            return (func.jobthing.JOB_ID_FINISHED, results)
+        elif results:
+            return (func.jobthing.JOB_ID_ASYNC_PARTIAL, results)
+        return (func.jobthing.JOB_ID_RUNNING, {})
+
+    def wait(self, job_id):
+        """
+        Blocks until every minion of `job_id` is done and returns the
+        results.
+        """
+        with self._lock:
+            done = max([done for (done, result)
+                        in self._jobs[job_id].values()] or [0])
+        time.sleep(max(0, done - time.time()))
+        return self.job_status(job_id)[1]
+
+    def _latency(self):
+        if callable(self.latency):
+            return self.latency(self.random)
+        if isinstance(self.latency, tuple):
+            return self.random.uniform(*self.latency)
+        return self.latency
+
+    def _result(self, host, module, method, args):
+        if self.random.random() < self.failure_rate:
+            return [1, '', '%s failed' % host]
+        for name in ('%s.%s' % (module, method), module):
+            if name in self.canned:
+                if callable(self.canned[name]):
+                    return self.canned[name](host, args)
+                return self.canned[name]
+        return [0, 'x' * self.output_size, '']
+
+
+class FakeClient(object):
+    """
+    A func Client talking to a FakeOverlord. Module calls return a
+    job id when `async`, or else wait for the results.
+    """
+
+    def __init__(self, overlord, server_spec, async=False):
+        self.overlord = overlord
+        self.server_spec = server_spec
+        self.async = async
+
+    def list_minions(self):
+        return self.overlord.match(self.server_spec)
+
+    def job_status(self, job_id):
+        return self.overlord.job_status(job_id)
+
+    def __getattr__(self, module):
+        if module.startswith('_'):
+            raise AttributeError(module)
+        return FakeModule(self, module)
+
+
+class FakeModule(object):
+    """
+    A func module of a FakeClient, every attribute being a method.
+    """
+
+    def __init__(self, client, name):
+        self._client = client
+        self._name = name
+
+    def __getattr__(self, method):
+        if method.startswith('_'):
+            raise AttributeError(method)
+
+        def call(*args):
+            client = self._client
+            job_id = client.overlord.run(
+                client.server_spec, self._name, method, args)
+            if client.async:
+                return job_id
+            return client.overlord.wait(job_id)
+        return call
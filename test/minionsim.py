@@ -0,0 +1,242 @@
+# Copyright (C) 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Local XML-RPC simulator of a func overlord and its fleet of minions.
+
+Run as its own process (python -m test.minionsim --minions 100) it
+serves a FakeOverlord with canned answers for command, service,
+yumcmd, rpms and nagios on a localhost port, printing the port once
+it listens. MinionSimulator starts and stops such a process, and its
+client() stands in for func.overlord.client.Client so every call the
+worker makes goes over the wire.
+
+The protocol is its own, not func's: one plain XML-RPC server plays
+the overlord, taking the server spec and async flag with every call,
+where func's overlord fans calls out to each minion over certmaster's
+SSL XML-RPC. func's own client can not talk to it, and the timings it
+gives are of a stand-in hop (serialization plus a localhost round
+trip), not of func on the wire.
+"""
+
+import optparse
+import os
+import subprocess
+import sys
+import time
+import xmlrpclib
+
+from SimpleXMLRPCServer import SimpleXMLRPCServer
+from SocketServer import ThreadingMixIn
+
+import func.CommonErrors
+
+from .fakeoverlord import FakeOverlord
+
+
+def _rpm(host, args):
+    return [['bash', '0', '4.2.46', '30.el7', 'x86_64'],
+            ['yum', '0', '3.4.3', '158.el7', 'noarch']]
+
+
+def _downtime(host, args):
+    now = int(time.time())
+    return ['[%s] SCHEDULE_HOST_DOWNTIME;%s;%s;%s;1;0;%s;func;Downtime' % (
+        now, args[0], now, now + 60 * args[-1], 60 * args[-1])]
+
+
+#: Canned answers of the simulated func modules
+CANNED = {
+    'command.run': lambda host, args: [0, '%s ran %s' % (host, args[0]), ''],
+    'service': 0,
+    'yumcmd': 'Complete!',
+    'rpms.inventory': _rpm,
+    'rpms.glob': _rpm,
+    'rpms.verify': [],
+    'nagios': _downtime,
+}
+
+
+class ThreadedXMLRPCServer(ThreadingMixIn, SimpleXMLRPCServer):
+    daemon_threads = True
+
+
+class OverlordService(object):
+    """
+    The XML-RPC face of a FakeOverlord. Module calls come in as
+    "module.method" with the server spec and async flag in front of the
+    method's own arguments.
+    """
+
+    def __init__(self, overlord):
+        self.overlord = overlord
+
+    def _dispatch(self, name, params):
+        try:
+            if name == 'list_minions':
+                return self.overlord.match(*params)
+            elif name == 'job_status':
+                return list(self.overlord.job_status(*params))
+            (module, method) = name.split('.', 1)
+            (server_spec, async) = params[:2]
+            job_id = self.overlord.run(
+                server_spec, module, method, tuple(params[2:]))
+            if async:
+                return job_id
+            return self.overlord.wait(job_id)
+        except func.CommonErrors.Func_Client_Exception, e:
+            raise xmlrpclib.Fault(1, str(e))
+
+
+def serve(minions, port=0, **overlord_kwargs):
+    """
+    Serves a FakeOverlord of `minions` on localhost until killed.
+    Prints the port once it listens.
+    """
+    overlord_kwargs.setdefault('canned', CANNED)
+    server = ThreadedXMLRPCServer(
+        ('127.0.0.1', port), logRequests=False, allow_none=True)
+    server.register_instance(OverlordService(
+        FakeOverlord(minions, **overlord_kwargs)))
+    print server.server_address[1]
+    sys.stdout.flush()
+    server.serve_forever()
+
+
+class SimulatedClient(object):
+    """
+    A func Client whose calls go to a simulator at `url`.
+    """
+
+    def __init__(self, url, server_spec, async=False):
+        self.url = url
+        self.server_spec = server_spec
+        self.async = async
+
+    def _call(self, name, *params):
+        # A proxy per call, xmlrpclib proxies are not thread safe
+        proxy = xmlrpclib.ServerProxy(self.url, allow_none=True)
+        try:
+            return getattr(proxy, name)(*params)
+        except xmlrpclib.Fault, fault:
+            raise func.CommonErrors.Func_Client_Exception(fault.faultString)
+
+    def list_minions(self):
+        return self._call('list_minions', self.server_spec)
+
+    def job_status(self, job_id):
+        return tuple(self._call('job_status', job_id))
+
+    def __getattr__(self, module):
+        if module.startswith('_'):
+            raise AttributeError(module)
+        return SimulatedModule(self, module)
+
+
+class SimulatedModule(object):
+    """
+    A func module of a SimulatedClient, every attribute being a method.
+    """
+
+    def __init__(self, client, name):
+        self._client = client
+        self._name = name
+
+    def __getattr__(self, method):
+        if method.startswith('_'):
+            raise AttributeError(method)
+
+        def call(*args):
+            return self._client._call(
+                '%s.%s' % (self._name, method),
+                self._client.server_spec, self._client.async, *args)
+        return call
+
+
+class MinionSimulator(object):
+    """
+    Runs the simulator for `minions` minions named host00000.example.com
+    and so on in a child process:
+
+        with MinionSimulator(100, latency=0.05) as simulator:
+            with mock.patch('func.overlord.client.Client',
+                            simulator.client):
+                ...
+
+    `latency` and `failure_rate` are handed to the FakeOverlord.
+    """
+
+    def __init__(self, minions, latency=0, failure_rate=0.0):
+        self.minions = minions
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.url = None
+        self._process = None
+
+    def start(self):
+        """
+        Starts the simulator and waits for it to listen.
+        """
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.pathsep.join(sys.path)
+        self._process = subprocess.Popen(
+            [sys.executable, '-m', 'test.minionsim',
+             '--minions', str(self.minions),
+             '--latency', str(self.latency),
+             '--failure-rate', str(self.failure_rate)],
+            stdout=subprocess.PIPE, env=env,
+            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        port = self._process.stdout.readline().strip()
+        if not port:
+            self._process.wait()
+            raise RuntimeError('The minion simulator did not start.')
+        self.url = 'http://127.0.0.1:%s/' % port
+        return self
+
+    def stop(self):
+        """
+        Stops the simulator.
+        """
+        if self._process is not None:
+            self._process.terminate()
+            self._process.wait()
+            self._process = None
+
+    def client(self, server_spec, async=False, **kwargs):
+        """
+        Returns a client of the simulator, like func's Client.
+        """
+        return SimulatedClient(self.url, server_spec, async)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--minions', type='int', default=1)
+    parser.add_option('--port', type='int', default=0)
+    parser.add_option('--latency', type='float', default=0)
+    parser.add_option('--failure-rate', type='float', default=0)
+    (options, args) = parser.parse_args()
+    serve(['host%05d.example.com' % x for x in range(options.minions)],
+          options.port, latency=options.latency,
+          failure_rate=options.failure_rate)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,249 @@
+# Copyright (C) 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+End to end benchmarks of the worker against a fake overlord.
+"""
+
+import func.jobthing
+import func.CommonErrors
+import logging
+import mock
+import os
+import time
+
+from contextlib import nested
+from nose.plugins.attrib import attr
+
+from . import TestCase
+from .fakeoverlord import FakeOverlord
+from .minionsim import MinionSimulator
+
+from replugin import funcworker
+
+log = logging.getLogger(__name__)
+
+
+MQ_CONF = {
+    'server': '127.0.0.1',
+    'port': 5672,
+    'vhost': '/',
+    'user': 'guest',
+    'password': 'guest',
+}
+
+
+def cpu_time():
+    """
+    User and system seconds used by this process so far.
+    """
+    times = os.times()
+    return times[0] + times[1]
+
+
+class TestFakeOverlord(TestCase):
+
+    def test_async_job(self):
+        """
+        Verify minions answer once their latency passed.
+        """
+        overlord = FakeOverlord(
+            ['web1', 'web2', 'db1'],
+            latency=lambda rng: 0.05, output_size=3, seed=1)
+        client = overlord.client('web*', async=True)
+        self.assertEqual(client.list_minions(), ['web1', 'web2'])
+
+        job_id = client.yumcmd.update()
+        self.assertEqual(client.job_status(job_id),
+                         (func.jobthing.JOB_ID_RUNNING, {}))
+        time.sleep(0.06)
+        self.assertEqual(client.job_status(job_id), (
+            func.jobthing.JOB_ID_FINISHED,
+            {'web1': [0, 'xxx', ''], 'web2': [0, 'xxx', '']}))
+        self.assertEqual(overlord.calls, [('web*', 'yumcmd', 'update', ())])
+        self.assertEqual(overlord.polls, 2)
+
+    def test_failures_and_unknown_hosts(self):
+        """
+        Verify failure_rate fails minions and unknown hosts raise.
+        """
+        overlord = FakeOverlord(['web1', 'web2'], failure_rate=1)
+        results = overlord.client('web1;web2').command.run('true')
+        self.assertEqual(results, {
+            'web1': [1, '', 'web1 failed'], 'web2': [1, '', 'web2 failed']})
+        self.assertRaises(
+            func.CommonErrors.Func_Client_Exception,
+            overlord.client('db*').list_minions)
+
+
+def run_step(client, host_count):
+    """
+    Run yumcmd.Update on host*.example.com with func clients made by
+    `client`. Prints and returns the final reply, wall seconds and
+    CPU seconds of the worker.
+    """
+    app_logger = mock.MagicMock('logging.Logger').__call__()
+    output = mock.MagicMock('logging.Logger').__call__()
+
+    with nested(
+            mock.patch('func.overlord.client.Client', client),
+            mock.patch('pika.SelectConnection'),
+            mock.patch('replugin.funcworker.FuncWorker.notify'),
+            mock.patch('replugin.funcworker.FuncWorker.send')):
+        worker = funcworker.FuncWorker(
+            MQ_CONF,
+            logger=app_logger,
+            config_file='test/benchmark_yumcmd.json',
+            output_dir='/tmp/logs/')
+        channel = mock.MagicMock()
+        worker._on_open(mock.MagicMock())
+        worker._on_channel_open(channel)
+
+        body = {
+            'parameters': {
+                'command': 'yumcmd',
+                'subcommand': 'Update',
+                'hosts': ['host*.example.com'],
+                'max_failures': '5%',
+            }
+        }
+        properties = mock.MagicMock(
+            'pika.spec.BasicProperties',
+            correlation_id=host_count,
+            reply_to='me')
+
+        start = time.time()
+        start_cpu = cpu_time()
+        worker.process(
+            channel, mock.MagicMock(), properties, body, output)
+        worker._executor.join()
+        elapsed = time.time() - start
+        cpu = cpu_time() - start_cpu
+        reply = worker.send.call_args[0][2]
+        messages = worker.send.call_count
+
+    log.info("%s hosts: %s in %.3f seconds, %.3f CPU seconds, %s messages",
+             host_count, reply['status'], elapsed, cpu, messages)
+    return (reply, elapsed, cpu)
+
+
+@attr('benchmark')
+class TestWorkerBenchmarks(TestCase):
+    """
+    Benchmarks of whole steps, from process() to the final reply,
+    against a FakeOverlord of 1, 100 and 5000 minions.
+    """
+
+    def _run(self, host_count, **overlord_kwargs):
+        """
+        Run yumcmd.Update on `host_count` fake minions. Returns the
+        final reply, wall seconds and CPU seconds.
+        """
+        overlord = FakeOverlord(
+            ['host%05d.example.com' % x for x in range(host_count)],
+            seed=host_count, **overlord_kwargs)
+        result = run_step(overlord.client, host_count)
+        log.info("The fake overlord answered %s polls", overlord.polls)
+        return result
+
+    def test_1_host(self):
+        """
+        Benchmark: a step on 1 host finishes right after its job.
+        """
+        (reply, elapsed, cpu) = self._run(1, latency=0.05)
+        self.assertEqual(reply['status'], 'completed')
+        self.assertEqual(reply['data'], [0, '', ''])
+        assert elapsed < 1
+
+    def test_100_hosts(self):
+        """
+        Benchmark: a step on 100 hosts with spread out latencies.
+        """
+        (reply, elapsed, cpu) = self._run(
+            100, latency=(0.01, 0.3), failure_rate=0.02, output_size=1024)
+        self.assertEqual(reply['status'], 'completed')
+        self.assertEqual(len(reply['hosts']['succeeded']) +
+                         len(reply['hosts']['failed']), 100)
+        assert elapsed < 2
+
+    def test_5000_hosts(self):
+        """
+        Benchmark: a step on 5000 hosts stays cheap for the worker.
+        """
+        (reply, elapsed, cpu) = self._run(
+            5000, latency=(0.01, 0.5), failure_rate=0.01, output_size=256)
+        self.assertEqual(reply['status'], 'completed')
+        self.assertEqual(len(reply['results']), 5000)
+        assert elapsed < 3
+        assert cpu < 2
+
+
+class TestWireBenchmarks(TestCase):
+    """
+    Benchmarks of whole steps against the XML-RPC minion simulator,
+    so func calls pay for serialization and a localhost round trip.
+    The simulator's protocol is a stand-in, not func's own.
+    """
+
+    def _run(self, host_count, **simulator_kwargs):
+        with MinionSimulator(host_count, **simulator_kwargs) as simulator:
+            return run_step(simulator.client, host_count)
+
+    def test_simulated_modules(self):
+        """
+        Verify the simulator answers the func modules the worker uses.
+        """
+        with MinionSimulator(2) as simulator:
+            client = simulator.client('host00000.example.com')
+            self.assertEqual(client.command.run('uptime'), {
+                'host00000.example.com': [
+                    0, 'host00000.example.com ran uptime', '']})
+            self.assertEqual(
+                client.service.restart('httpd').values(), [0])
+            self.assertEqual(
+                client.yumcmd.install('bash').values(), ['Complete!'])
+            self.assertEqual(
+                client.rpms.inventory().values()[0][0][0], 'bash')
+            self.assertTrue('SCHEDULE_HOST_DOWNTIME' in client.nagios.
+                            schedule_host_downtime('web1', 30).values()[0][0])
+
+            client = simulator.client('host*', async=True)
+            self.assertEqual(len(client.list_minions()), 2)
+            job_id = client.yumcmd.update()
+            self.assertEqual(client.job_status(job_id)[0],
+                             func.jobthing.JOB_ID_FINISHED)
+            self.assertRaises(
+                func.CommonErrors.Func_Client_Exception,
+                simulator.client('db*').list_minions)
+
+    @attr('benchmark')
+    def test_1_host(self):
+        """
+        Benchmark: a step on 1 simulated host over XML-RPC.
+        """
+        (reply, elapsed, cpu) = self._run(1, latency=0.05)
+        self.assertEqual(reply['status'], 'completed')
+        self.assertEqual(reply['data'], [0, 'Complete!', ''])
+        assert elapsed < 1
+
+    @attr('benchmark')
+    def test_1000_hosts(self):
+        """
+        Benchmark: a step on 1000 simulated hosts over XML-RPC.
+        """
+        (reply, elapsed, cpu) = self._run(
+            1000, latency=0.2, failure_rate=0.01)
+        self.assertEqual(reply['status'], 'completed')
+        self.assertEqual(len(reply['results']), 1000)
+        assert elapsed < 5
@@ -0,0 +1,79 @@
+# Copyright (C) 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Unittests for check script state.
+"""
+
+from . import TestCase
+
+from replugin.funcworker.checkscripts import CheckScripts
+
+
+class TestCheckScripts(TestCase):
+
+    def test_only_failing_scripts_are_pending(self):
+        """
+        Verify scripts which passed are no longer pending.
+        """
+        checks = CheckScripts(['a', 'b', 'a'])
+        self.assertEqual(len(checks), 2)
+        self.assertFalse(checks.all_passed())
+
+        (a, b) = checks.pending()
+        a.start()
+        a.finish([])
+        b.start()
+        b.finish(['host1'])
+        self.assertEqual(checks.pending(), [b])
+
+        b.start()
+        b.finish([])
+        self.assertTrue(checks.all_passed())
+
+    def test_summary(self):
+        """
+        Verify the summary reports every run of every script.
+        """
+        checks = CheckScripts(['a', 'b'])
+        (a, b) = checks.pending()
+        a.start()
+        a.finish(['host1', 'host2'])
+
+        summary = checks.summary()
+        self.assertEqual(summary['a']['passed'], False)
+        self.assertEqual(summary['a']['runs'], 1)
+        self.assertEqual(len(summary['a']['timings']), 1)
+        self.assertEqual(summary['a']['failed_hosts'], ['host1', 'host2'])
+        self.assertEqual(summary['b'], {
+            'passed': False, 'runs': 0, 'timings': [], 'failed_hosts': []})
+
+    def test_next_wave(self):
+        """
+        Verify every script runs again for the next wave and hosts it
+        never passed on stay reported.
+        """
+        checks = CheckScripts(['a'])
+        (a,) = checks.pending()
+        a.start()
+        a.finish(['host1'])
+        checks.next_wave()
+        self.assertEqual(checks.pending(), [a])
+
+        a.start()
+        a.finish([])
+        self.assertTrue(checks.all_passed())
+        self.assertEqual(checks.summary()['a']['passed'], False)
+        self.assertEqual(checks.summary()['a']['failed_hosts'], ['host1'])
+        self.assertEqual(checks.summary()['a']['runs'], 2)
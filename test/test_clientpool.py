@@ -0,0 +1,81 @@
+# Copyright (C) 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Unittests for the func client pool.
+"""
+
+import mock
+
+from . import TestCase
+
+from replugin.funcworker.clientpool import ClientPool
+
+
+@mock.patch('func.overlord.client.Client')
+class TestClientPool(TestCase):
+
+    def test_clients_are_reused_by_host_set(self, fc):
+        """
+        Verify released clients are reused for the same host set.
+        """
+        pool = ClientPool(4)
+        client = pool.acquire(['b', 'a', 'a'], async_mode=True)
+        fc.assert_called_once_with('a;b', async=True)
+        pool.release(client, 'a;b', async_mode=True)
+
+        self.assertIs(pool.acquire(['a', 'b'], async_mode=True), client)
+        self.assertEqual(fc.call_count, 1)
+        # A different async mode is a different client
+        pool.acquire(['a', 'b'])
+        self.assertEqual(fc.call_count, 2)
+
+        self.assertEqual(pool.stats(), {
+            'size': 0, 'capacity': 4, 'hits': 1, 'misses': 2,
+            'hit_rate': 1 / 3.0})
+
+    def test_clients_are_not_shared(self, fc):
+        """
+        Verify a client is handed to one caller until released.
+        """
+        fc.side_effect = lambda *args, **kwargs: mock.MagicMock()
+        pool = ClientPool(4)
+        first = pool.acquire(['a'])
+        second = pool.acquire(['a'])
+        self.assertIsNot(first, second)
+
+    def test_least_recently_used_is_evicted(self, fc):
+        """
+        Verify the oldest idle client is dropped when the pool is full.
+        """
+        fc.side_effect = lambda *args, **kwargs: mock.MagicMock()
+        pool = ClientPool(2)
+        clients = {}
+        for host in ('a', 'b', 'c'):
+            clients[host] = pool.acquire([host])
+        for host in ('a', 'b', 'c'):
+            pool.release(clients[host], [host])
+
+        self.assertEqual(pool.stats()['size'], 2)
+        self.assertIs(pool.acquire(['c']), clients['c'])
+        self.assertIs(pool.acquire(['b']), clients['b'])
+        self.assertIsNot(pool.acquire(['a']), clients['a'])
+
+    def test_size_zero_disables_pooling(self, fc):
+        """
+        Verify nothing is kept when the pool size is 0.
+        """
+        pool = ClientPool(0)
+        pool.release(pool.acquire(['a']), ['a'])
+        self.assertEqual(pool.stats()['size'], 0)
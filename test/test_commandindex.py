@@ -0,0 +1,83 @@
+# Copyright (C) 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Unittests for the command index.
+"""
+
+import glob
+import json
+
+from . import TestCase
+
+from replugin.funcworker.commandindex import CommandIndex
+
+
+class TestCommandIndex(TestCase):
+
+    def test_shipped_configs(self):
+        """
+        Verify every config shipped with the worker compiles.
+        """
+        for config_file in glob.glob('conf/*.json') + glob.glob('test/*.json'):
+            with open(config_file, 'r') as config:
+                CommandIndex(json.load(config))
+
+    def test_lookup(self):
+        """
+        Verify subcommands carry their settings and defaults.
+        """
+        index = CommandIndex(json.load(open('conf/puppet.json', 'r')))
+
+        self.assertEqual(index.commands, ('puppet',))
+        self.assertTrue('puppet' in index)
+        self.assertFalse('queue' in index)
+        self.assertFalse('return_codes' in index)
+        self.assertFalse(['puppet'] in index)
+
+        run = index.lookup('puppet', 'Run')
+        self.assertEqual(run.required, ('noop', 'enable', 'server', 'tags'))
+        self.assertEqual(run.return_codes, frozenset([0, 2]))
+        self.assertEqual(run.poll_policy.first, 5)
+        self.assertEqual(run.timeout, 1800)
+        self.assertRaises(KeyError, index.lookup, 'puppet', 'run')
+        self.assertRaises(KeyError, index.lookup, 'yumcmd', 'Install')
+
+    def test_defaults(self):
+        """
+        Verify subcommands without settings get the defaults.
+        """
+        index = CommandIndex({'queue': 'q', 'rpms': {'inventory': []}})
+
+        inventory = index.lookup('rpms', 'inventory')
+        self.assertEqual(inventory.required, ())
+        self.assertEqual(inventory.return_codes, frozenset([0]))
+        self.assertEqual(inventory.poll_policy.first, 0.25)
+        self.assertEqual(inventory.timeout, None)
+
+    def test_broken_configs(self):
+        """
+        Verify broken configs are refused when the index is built.
+        """
+        for config in (
+                {'rpms': {'inventory': 'flatten'}},
+                {'rpms': {'inventory': [1]}},
+                {'rpms': {'inventory': []}, 'return_codes': {'grep': [0]}},
+                {'rpms': {'inventory': []}, 'return_codes': {'inventory': 0}},
+                {'rpms': {'inventory': []},
+                 'polling': {'inventory': {'fast': True}}},
+                {'rpms': {'inventory': []}, 'timeouts': {'yumcmd': 10}},
+                {'rpms': {'inventory': []}, 'timeouts': {'rpms': -1}},
+                {'rpms': {'inventory': []}, 'timeouts': []}):
+            self.assertRaises(ValueError, CommandIndex, config)
@@ -0,0 +1,112 @@
+# Copyright (C) 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Unittests for running steps off the connection thread.
+"""
+
+import mock
+import threading
+
+from . import TestCase
+
+from replugin.funcworker.dispatch import Outbox, StepExecutor
+
+
+class TestStepExecutor(TestCase):
+
+    def setUp(self):
+        self.app_logger = mock.MagicMock('logging.Logger').__call__()
+
+    def test_in_flight_is_bounded(self):
+        """
+        Verify no more than max_in_flight steps run at once.
+        """
+        executor = StepExecutor(self.app_logger, 2)
+        lock = threading.Lock()
+        running = [0]
+        peak = [0]
+
+        def step(x):
+            with lock:
+                running[0] += 1
+                peak[0] = max(peak[0], running[0])
+            threading.Event().wait(0.02)
+            with lock:
+                running[0] -= 1
+
+        for x in range(6):
+            executor.submit(step, x)
+        executor.join()
+
+        self.assertEqual(peak[0], 2)
+        self.assertEqual(executor.in_flight(), 0)
+
+    def test_errors_are_logged(self):
+        """
+        Verify a failing step is logged and does not stop the executor.
+        """
+        executor = StepExecutor(self.app_logger, 1)
+        done = []
+
+        def broken():
+            raise KeyError('oops')
+
+        executor.submit(broken)
+        executor.submit(done.append, True)
+        executor.join()
+
+        self.assertEqual(done, [True])
+        assert self.app_logger.error.call_count >= 1
+
+    def test_max_in_flight_must_be_positive(self):
+        """
+        Verify an executor without threads can not be created.
+        """
+        self.assertRaises(ValueError, StepExecutor, self.app_logger, 0)
+
+
+class TestOutbox(TestCase):
+
+    def test_drain_from_io_thread(self):
+        """
+        Verify queued calls run in order when drained.
+        """
+        outbox = Outbox()
+        method = mock.MagicMock()
+        outbox.put(method, 'first', exchange='')
+        outbox.put(method, 'second', exchange='')
+
+        self.assertEqual(method.call_count, 0)
+        self.assertEqual(outbox.drain(), 2)
+        self.assertEqual(method.call_args_list, [
+            mock.call('first', exchange=''),
+            mock.call('second', exchange='')])
+        self.assertEqual(outbox.drain(), 0)
+
+    def test_on_io_thread(self):
+        """
+        Verify only the recorded I/O thread counts as the I/O thread.
+        """
+        outbox = Outbox()
+        assert outbox.on_io_thread()
+        outbox.io_thread = threading.current_thread()
+        assert outbox.on_io_thread()
+
+        seen = []
+        thread = threading.Thread(
+            target=lambda: seen.append(outbox.on_io_thread()))
+        thread.start()
+        thread.join()
+        self.assertEqual(seen, [False])
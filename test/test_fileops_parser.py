@@ -16,11 +16,17 @@
 Unittests for the special fileops parser
 """
 
+import logging
 import mock
+import time
 import replugin.funcworker.fileops as fileops
 
+from nose.plugins.attrib import attr
+
 from . import TestCase
 
+log = logging.getLogger(__name__)
+
 
 class TestFileOpsParser(TestCase):
 
@@ -434,9 +440,13 @@ class TestFileOpsParser(TestCase):
         with self.assertRaises(TypeError):
             fileops._parse_Tar(params, self.app_logger)
 
-    @mock.patch('replugin.funcworker.fileops._parse_Touch')
-    def test_good_parse_target_params(self, fileops_Touch):
+    def test_good_parse_target_params(self):
         """fileops:Touch: Test looking up a special parser passes"""
+        fileops_Touch = mock.MagicMock()
+        parsers = mock.patch.dict(
+            fileops.PARSERS, {'Touch': fileops_Touch})
+        parsers.start()
+        self.addCleanup(parsers.stop)
         fileops_Touch.return_value = ({}, [])
 
         params = {
@@ -448,9 +458,13 @@ class TestFileOpsParser(TestCase):
         self.app_logger.debug.assert_called_once_with("Found parser: _parse_Touch")
         self.app_logger.reset_mock()
 
-    @mock.patch('replugin.funcworker.fileops._parse_Touch')
-    def test_dangerous_parse_target_params(self, fileops_Touch):
+    def test_dangerous_parse_target_params(self):
         """fileops:Touch: Verify that if bad shell chars return it's blocked"""
+        fileops_Touch = mock.MagicMock()
+        parsers = mock.patch.dict(
+            fileops.PARSERS, {'Touch': fileops_Touch})
+        parsers.start()
+        self.addCleanup(parsers.stop)
         for bad_data in ([';'], ['&&'], ['|'], ['$'], ['>'], ['<']):
             fileops_Touch.reset_mock()
             fileops_Touch.return_value = ({}, bad_data)
@@ -464,9 +478,13 @@ class TestFileOpsParser(TestCase):
                 (_params_result, _method_args) = fileops.parse_target_params(
                      params, self.app_logger)
 
-    @mock.patch('replugin.funcworker.fileops._parse_Touch')
-    def test_bad_parse_target_params(self, fileops_enable):
+    def test_bad_parse_target_params(self):
         """fileops:NotTouch: Invalid subcommands raise while looking for parser"""
+        fileops_enable = mock.MagicMock()
+        parsers = mock.patch.dict(
+            fileops.PARSERS, {'Touch': fileops_enable})
+        parsers.start()
+        self.addCleanup(parsers.stop)
         fileops_enable.return_value = ({}, [])
 
         params = {
@@ -480,12 +498,78 @@ class TestFileOpsParser(TestCase):
 
     def test_good_process_result(self):
         """fileops:ProcessResult: Test processing fileops command results"""
-        # TODO: Implement the process_result function
-        with self.assertRaises(NotImplementedError):
-            fileops.process_result(None)
+        result = fileops.process_result(
+            'FindInFiles', [0, '/tmp/a:test\n/tmp/b:test two\n', ''])
+        self.assertEqual(result, [0, {
+            'count': 2,
+            'matches': ['/tmp/a:test', '/tmp/b:test two'],
+            'truncated': False}, ''])
+
+        # Only MAX_MATCHES lines are kept
+        with mock.patch('replugin.funcworker.fileops.MAX_MATCHES', 2):
+            result = fileops.process_result(
+                'FindInFiles', [0, 'a\nb\nc', ''])
+        self.assertEqual(result[1], {
+            'count': 3, 'matches': ['a', 'b'], 'truncated': True})
+
+        # Other subcommands are left alone
+        self.assertEqual(
+            fileops.process_result('Touch', [0, '', '']), [0, '', ''])
 
     def test_bad_process_result(self):
         """fileops:ProcessResult: Test processing fileops command results failure"""
-        # TODO: Implement the process_result function
-        with self.assertRaises(NotImplementedError):
-            fileops.process_result(None)
+        # grep found nothing
+        result = fileops.process_result('FindInFiles', [1, '', ''])
+        self.assertEqual(result, [1, {
+            'count': 0, 'matches': [], 'truncated': False}, ''])
+        result = fileops.process_result(
+            'FindInFiles', ['REMOTE_ERROR', 'OSError', 'gone'])
+        self.assertEqual(result, [1, '', 'OSError, gone'])
+
+
+@attr('benchmark')
+class TestFileOpsParserScaling(TestCase):
+    """
+    Benchmarks guarding against slow checks of long path lists.
+    """
+
+    def setUp(self):
+        self.app_logger = mock.MagicMock('logging.Logger').__call__()
+
+    def _parse(self, subcommand, count, **params):
+        """
+        Parse `subcommand` over `count` paths, checking them for unsafe
+        chars. Returns the seconds it took.
+        """
+        params.update({
+            'hosts': ['testhost.example.com'],
+            'command': 'fileops',
+            'subcommand': subcommand,
+            'path': ['/srv/app/releases/%08d/app.log' % x
+                     for x in range(count)],
+        })
+        start = time.time()
+        (update, cmd) = fileops.parse_target_params(params, self.app_logger)
+        elapsed = time.time() - start
+        self.assertEqual(len(cmd), 1)
+
+        # The last path being unsafe is caught as well
+        params['path'][-1] += ';reboot'
+        self.assertRaises(
+            TypeError, fileops.parse_target_params, params, self.app_logger)
+
+        log.info("Checked %s %s paths in %.3f seconds (%d paths/s)",
+                 count, subcommand, elapsed, count / max(elapsed, 0.000001))
+        return elapsed
+
+    def test_find_in_files_100k_paths(self):
+        """
+        Benchmark: checking FindInFiles over 100k paths stays fast.
+        """
+        assert self._parse('FindInFiles', 100000, regexp='ERROR') < 1
+
+    def test_remove_100k_paths(self):
+        """
+        Benchmark: checking Remove over 100k paths stays fast.
+        """
+        assert self._parse('Remove', 100000, recursive=True) < 1
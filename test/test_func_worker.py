@@ -16,18 +16,29 @@
 Unittests.
 """
 
+import json
 import func
+import logging
 import pika
 import mock
+import threading
+import time
 
 from contextlib import nested
+from nose.plugins.attrib import attr
 
 from . import TestCase
 
 from replugin import funcworker
+from replugin.funcworker.payload import decode
+from replugin.funcworker.polling import Deadline
+
+from .fakeoverlord import FakeOverlord
+from .minionsim import CANNED
 
 from func.minion.codes import FuncException
 
+log = logging.getLogger(__name__)
 
 MQ_CONF = {
     'server': '127.0.0.1',
@@ -59,6 +70,7 @@ class TestFuncWorker(TestCase):
         self.channel = mock.MagicMock('pika.spec.Channel')
         self.channel.basic_consume = mock.Mock('basic_consume')
         self.channel.basic_ack = mock.Mock('basic_ack')
+        self.channel.basic_qos = mock.Mock('basic_qos')
         self.channel.basic_publish = mock.Mock('basic_publish')
 
         self.basic_deliver = mock.MagicMock()
@@ -87,6 +99,7 @@ class TestFuncWorker(TestCase):
         self.channel.reset_mock()
         self.channel.basic_consume.reset_mock()
         self.channel.basic_ack.reset_mock()
+        self.channel.basic_qos.reset_mock()
         self.channel.basic_publish.reset_mock()
 
         self.basic_deliver.reset_mock()
@@ -111,6 +124,27 @@ class TestFuncWorker(TestCase):
         # Log should happen as an error
         self.assertEqual(self.logger.error.call_count, 1)
 
+    def _check_job_status(self, fc, results, check_rcs):
+        """
+        Make job_status answer the command job with `results` and each
+        poll of a check script job with the next return code from
+        `check_rcs`. The last return code repeats.
+        """
+        check_rcs = list(check_rcs)
+        fc().command.run.return_value = 'checkjob'
+
+        def job_status(job_id):
+            if job_id == 'checkjob':
+                if len(check_rcs) > 1:
+                    rc = check_rcs.pop(0)
+                else:
+                    rc = check_rcs[0]
+                return (func.jobthing.JOB_ID_FINISHED,
+                        {'127.0.0.1': [rc, 'check out', '']})
+            return (func.jobthing.JOB_ID_FINISHED, {'127.0.0.1': results})
+
+        fc().job_status.side_effect = job_status
+
     def test_command_params(self, fc):
         """
         Verify that if params are missing proper responses occur.
@@ -136,6 +170,7 @@ class TestFuncWorker(TestCase):
                 self.properties,
                 body,
                 self.logger)
+            worker._executor.join()
             self._assert_error_conditions(
                 worker, 'Params dictionary not passed')
 
@@ -171,6 +206,7 @@ class TestFuncWorker(TestCase):
                     self.properties,
                     body,
                     self.logger)
+                worker._executor.join()
 
                 self._assert_error_conditions(
                     worker, 'This worker only handles')
@@ -210,6 +246,7 @@ class TestFuncWorker(TestCase):
                     self.properties,
                     body,
                     self.logger)
+                worker._executor.join()
 
                 self._assert_error_conditions(
                     worker, 'Requested subcommand for')
@@ -249,6 +286,7 @@ class TestFuncWorker(TestCase):
                     self.properties,
                     body,
                     self.logger)
+                worker._executor.join()
 
                 self._assert_error_conditions(
                     worker, 'This worker requires hosts to be a list of hosts')
@@ -294,6 +332,7 @@ class TestFuncWorker(TestCase):
                     self.properties,
                     body,
                     self.logger)
+                worker._executor.join()
 
                 self._assert_error_conditions(
                     worker, 'Func error raised.')
@@ -307,14 +346,14 @@ class TestFuncWorker(TestCase):
         """
         results = ['First', 'Second', 'Third']
 
-        # The output from job_status ...
-        fc().job_status.return_value = (
-            func.jobthing.JOB_ID_FINISHED,
-            {'127.0.0.1': results, '127.0.0.2': results})
-
 
         for config_file, cmd, sub, rargs in CONFIG_FILES:
             for hosts in (['127.0.0.1'], ['127.0.0.2', '127.0.0.3']):
+                # Every host resolves and answers through job_status
+                fc().list_minions.return_value = hosts
+                fc().job_status.return_value = (
+                    func.jobthing.JOB_ID_FINISHED,
+                    dict([(host, results) for host in hosts]))
                 with nested(
                         mock.patch('pika.SelectConnection'),
                         mock.patch('replugin.funcworker.FuncWorker.notify'),
@@ -350,11 +389,23 @@ class TestFuncWorker(TestCase):
                         self.properties,
                         body,
                         self.logger)
+                    worker._executor.join()
 
                     assert worker.send.call_count == 2  # start then success
-                    assert worker.send.call_args[0][2] == {
-                        'status': 'completed', 'data': [0, 'First, Second, Third', ''],
+                    # Every host's result is replied by host
+                    normalized = [0, 'First, Second, Third', '']
+                    expected = {
+                        'status': 'completed',
+                        'results': dict(
+                            [(host, normalized) for host in hosts]),
+                        'hosts': {'succeeded': hosts, 'failed': []},
                     }
+                    if len(hosts) == 1:
+                        # and a single host's as the legacy data list
+                        expected['data'] = normalized
+                    reply = worker.send.call_args[0][2]
+                    assert 'total' in reply.pop('timings')
+                    assert reply == expected
 
                     # Notification should succeed
                     assert worker.notify.call_count == 1
@@ -386,14 +437,14 @@ class TestFuncWorker(TestCase):
         """
         results = 'Stuff worked'
 
-        # The output from job_status ...
-        fc().job_status.return_value = (
-            func.jobthing.JOB_ID_FINISHED,
-            {'127.0.0.1': results, '127.0.0.2': results})
-
 
         for config_file, cmd, sub, rargs in CONFIG_FILES:
             for hosts in (['127.0.0.1'], ['127.0.0.2', '127.0.0.3']):
+                # Every host resolves and answers through job_status
+                fc().list_minions.return_value = hosts
+                fc().job_status.return_value = (
+                    func.jobthing.JOB_ID_FINISHED,
+                    dict([(host, results) for host in hosts]))
                 with nested(
                         mock.patch('pika.SelectConnection'),
                         mock.patch('replugin.funcworker.FuncWorker.notify'),
@@ -429,11 +480,23 @@ class TestFuncWorker(TestCase):
                         self.properties,
                         body,
                         self.logger)
+                    worker._executor.join()
 
                     assert worker.send.call_count == 2  # start then success
-                    assert worker.send.call_args[0][2] == {
-                        'status': 'completed', 'data': [0, 'Stuff worked', ''],
+                    # Every host's result is replied by host
+                    normalized = [0, 'Stuff worked', '']
+                    expected = {
+                        'status': 'completed',
+                        'results': dict(
+                            [(host, normalized) for host in hosts]),
+                        'hosts': {'succeeded': hosts, 'failed': []},
                     }
+                    if len(hosts) == 1:
+                        # and a single host's as the legacy data list
+                        expected['data'] = normalized
+                    reply = worker.send.call_args[0][2]
+                    assert 'total' in reply.pop('timings')
+                    assert reply == expected
 
                     # Notification should succeed
                     assert worker.notify.call_count == 1
@@ -458,6 +521,51 @@ class TestFuncWorker(TestCase):
                     fc.call_count = 0
                     self._reset_mocks()
 
+    def test_result_without_return_code(self, fc):
+        """
+        Verify a host result whose first item can not be a return code,
+        like the rows rpms.inventory answers with, fails the host.
+        """
+        overlord = FakeOverlord(['web1'], canned=CANNED)
+        fc.side_effect = overlord.client
+
+        with nested(
+                mock.patch('pika.SelectConnection'),
+                mock.patch('replugin.funcworker.FuncWorker.notify'),
+                mock.patch('replugin.funcworker.FuncWorker.send')):
+            worker = funcworker.FuncWorker(
+                MQ_CONF,
+                logger=self.app_logger,
+                config_file='conf/rpms.json',
+                output_dir='/tmp/logs/')
+
+            worker._on_open(self.connection)
+            worker._on_channel_open(self.channel)
+
+            body = {
+                'parameters': {
+                    'command': 'rpms',
+                    'subcommand': 'inventory',
+                    'hosts': ['web1'],
+                    'flatten': True,
+                }
+            }
+            worker.process(
+                self.channel,
+                self.basic_deliver,
+                self.properties,
+                body,
+                self.logger)
+            worker._executor.join()
+
+            self._assert_error_conditions(
+                worker, 'FuncWorker failed trying to execute rpms.inventory')
+            reply = worker.send.call_args[0][2]
+            self.assertEqual(reply['hosts'], {
+                'succeeded': [], 'failed': ['web1']})
+            self.assertEqual(
+                overlord.calls, [('web1', 'rpms', 'inventory', (True,))])
+
     def test_return_codes_are_honored(self, fc):
         """
         When a return code section exists, honor it.
@@ -472,6 +580,7 @@ class TestFuncWorker(TestCase):
         fc().job_status.return_value = (
             func.jobthing.JOB_ID_FINISHED,
             {'127.0.0.1': results})
+        fc().list_minions.return_value = ['127.0.0.1']
 
         with nested(
                 mock.patch('pika.SelectConnection'),
@@ -508,10 +617,15 @@ class TestFuncWorker(TestCase):
                 self.properties,
                 body,
                 self.logger)
+            worker._executor.join()
 
             assert worker.send.call_count == 2  # start then success
-            self.assertEqual(worker.send.call_args[0][2], {
+            reply = worker.send.call_args[0][2]
+            assert 'total' in reply.pop('timings')
+            self.assertEqual(reply, {
                 'status': 'completed', 'data': results,
+                'results': {'127.0.0.1': results},
+                'hosts': {'succeeded': ['127.0.0.1'], 'failed': []},
             })
 
             # Notification should succeed
@@ -543,14 +657,14 @@ class TestFuncWorker(TestCase):
             "stderr here"
         ]
 
-        # The output from job_status ...
-        fc().job_status.return_value = (
-            func.jobthing.JOB_ID_FINISHED,
-            {'127.0.0.1': results, '127.0.0.2': results})
-
 
         for config_file, cmd, sub, rargs in CONFIG_FILES:
             for hosts in (['127.0.0.1'], ['127.0.0.2', '127.0.0.3']):
+                # Every host resolves and answers through job_status
+                fc().list_minions.return_value = hosts
+                fc().job_status.return_value = (
+                    func.jobthing.JOB_ID_FINISHED,
+                    dict([(host, results) for host in hosts]))
                 with nested(
                         mock.patch('pika.SelectConnection'),
                         mock.patch('replugin.funcworker.FuncWorker.notify'),
@@ -586,11 +700,23 @@ class TestFuncWorker(TestCase):
                         self.properties,
                         body,
                         self.logger)
+                    worker._executor.join()
 
                     assert worker.send.call_count == 2  # start then success
-                    assert worker.send.call_args[0][2] == {
-                        'status': 'completed', 'data': results,
+                    # Every host's result is replied by host
+                    normalized = results
+                    expected = {
+                        'status': 'completed',
+                        'results': dict(
+                            [(host, normalized) for host in hosts]),
+                        'hosts': {'succeeded': hosts, 'failed': []},
                     }
+                    if len(hosts) == 1:
+                        # and a single host's as the legacy data list
+                        expected['data'] = normalized
+                    reply = worker.send.call_args[0][2]
+                    assert 'total' in reply.pop('timings')
+                    assert reply == expected
 
                     # Notification should succeed
                     assert worker.notify.call_count == 1
@@ -629,6 +755,7 @@ class TestFuncWorker(TestCase):
         # The output from job_status ...
         fc().job_status.return_value = (
             func.jobthing.JOB_ID_FINISHED, {'127.0.0.1': results})
+        fc().list_minions.return_value = ['127.0.0.1']
 
         for config_file, cmd, sub, rargs in CONFIG_FILES:
             with nested(
@@ -666,6 +793,7 @@ class TestFuncWorker(TestCase):
                     self.properties,
                     body,
                     self.logger)
+                worker._executor.join()
 
                 self._assert_error_conditions(
                     worker, 'FuncWorker failed trying to execute %s.%s' % (
@@ -674,21 +802,879 @@ class TestFuncWorker(TestCase):
             fc.reset_mock()
             self._reset_mocks()
 
-    def test_good_with_eventually_working_check_script(self, fc):
+    def test_partial_failure_reports_each_host(self, fc):
         """
-        When test scripts return non 0 tries should execute.
+        Verify that when one host of a fan-out fails the step fails and
+        every host is reported in the reply.
+        """
+        fc().job_status.return_value = (
+            func.jobthing.JOB_ID_FINISHED, {
+                '127.0.0.1': [0, 'stdout here', ''],
+                '127.0.0.2': [1, '', 'stderr here'],
+                '127.0.0.3': ['REMOTE_ERROR', 'socket.error', 'refused'],
+            })
+        fc().list_minions.return_value = [
+            '127.0.0.1', '127.0.0.2', '127.0.0.3']
+
+        with nested(
+                mock.patch('pika.SelectConnection'),
+                mock.patch('replugin.funcworker.FuncWorker.notify'),
+                mock.patch('replugin.funcworker.FuncWorker.send')):
+            worker = funcworker.FuncWorker(
+                MQ_CONF,
+                logger=self.app_logger,
+                config_file='conf/yumcmd.json',
+                output_dir='/tmp/logs/')
+
+            worker._on_open(self.connection)
+            worker._on_channel_open(self.channel)
+
+            body = {
+                'parameters': {
+                    'command': 'yumcmd',
+                    'subcommand': 'Update',
+                    'hosts': ['127.0.0.1', '127.0.0.2', '127.0.0.3'],
+                }
+            }
+
+            # Execute the call
+            worker.process(
+                self.channel,
+                self.basic_deliver,
+                self.properties,
+                body,
+                self.logger)
+            worker._executor.join()
+
+            self._assert_error_conditions(
+                worker, 'FuncWorker failed trying to execute yumcmd.update')
+            self.assertEqual(worker.send.call_args[0][2]['hosts'], {
+                'succeeded': ['127.0.0.1'],
+                'failed': ['127.0.0.2', '127.0.0.3'],
+            })
+
+    def test_job_runs_on_resolved_hosts(self, fc):
+        """
+        Verify the job is submitted to the hosts the globs resolved to.
+        """
+        fc().list_minions.return_value = ['web1', 'web2']
+        fc().job_status.return_value = (
+            func.jobthing.JOB_ID_FINISHED,
+            {'web1': [0, '', ''], 'web2': [0, '', '']})
+
+        with nested(
+                mock.patch('pika.SelectConnection'),
+                mock.patch('replugin.funcworker.FuncWorker.notify'),
+                mock.patch('replugin.funcworker.FuncWorker.send')):
+            worker = funcworker.FuncWorker(
+                MQ_CONF,
+                logger=self.app_logger,
+                config_file='conf/yumcmd.json',
+                output_dir='/tmp/logs/')
+
+            worker._on_open(self.connection)
+            worker._on_channel_open(self.channel)
+
+            body = {
+                'parameters': {
+                    'command': 'yumcmd',
+                    'subcommand': 'Update',
+                    'hosts': ['web*'],
+                }
+            }
+            worker.process(
+                self.channel,
+                self.basic_deliver,
+                self.properties,
+                body,
+                self.logger)
+            worker._executor.join()
+
+            fc.assert_called_with('web1;web2', async=True)
+            self.assertEqual(worker.send.call_args[0][2]['status'], 'completed')
+
+    def _run_waves(self, fc, wave_results, **params):
+        """
+        Run yumcmd.update on web1-web5 with `params`, answering the
+        job of each wave with the next entry of `wave_results`.
+        Returns the final reply.
+        """
+        fc().list_minions.return_value = [
+            'web1', 'web2', 'web3', 'web4', 'web5']
+        job_ids = ['wave%s' % x for x in range(len(wave_results))]
+        fc().yumcmd.update.side_effect = job_ids
+        fc().job_status.side_effect = lambda job_id: (
+            func.jobthing.JOB_ID_FINISHED,
+            wave_results[job_ids.index(job_id)])
+
+        with nested(
+                mock.patch('pika.SelectConnection'),
+                mock.patch('replugin.funcworker.FuncWorker.notify'),
+                mock.patch('replugin.funcworker.FuncWorker.send')):
+            worker = funcworker.FuncWorker(
+                MQ_CONF,
+                logger=self.app_logger,
+                config_file='conf/yumcmd.json',
+                output_dir='/tmp/logs/')
+
+            worker._on_open(self.connection)
+            worker._on_channel_open(self.channel)
+
+            body = {
+                'parameters': {
+                    'command': 'yumcmd',
+                    'subcommand': 'Update',
+                    'hosts': ['web*'],
+                }
+            }
+            body['parameters'].update(params)
+            worker.process(
+                self.channel,
+                self.basic_deliver,
+                self.properties,
+                body,
+                self.logger)
+            worker._executor.join()
+            return worker.send.call_args[0][2]
+
+    def test_waves_stop_when_too_many_hosts_fail(self, fc):
+        """
+        Verify hosts run in waves of batch_size and the waves stop once
+        more than max_failures hosts failed.
+        """
+        reply = self._run_waves(fc, [
+            {'web1': [0, '', ''], 'web2': [0, '', '']},
+            {'web3': [1, '', ''], 'web4': [0, '', '']},
+        ], batch_size=2, max_failures=0)
+
+        self.assertEqual(fc().yumcmd.update.call_count, 2)
+        fc.assert_any_call('web1;web2', async=True)
+        fc.assert_any_call('web3;web4', async=True)
+        self.assertEqual(reply['status'], 'failed')
+        self.assertEqual(reply['hosts'], {
+            'succeeded': ['web1', 'web2', 'web4'],
+            'failed': ['web3'],
+            'skipped': ['web5'],
+        })
+
+    def test_waves_complete_within_failure_budget(self, fc):
+        """
+        Verify a step succeeds when no more than max_failures (here a
+        percentage) of the hosts failed.
+        """
+        reply = self._run_waves(fc, [
+            {'web1': [0, '', ''], 'web2': [0, '', ''], 'web3': [1, '', '']},
+            {'web4': [0, '', ''], 'web5': [0, '', '']},
+        ], batch_size=3, max_failures='20%')
+
+        self.assertEqual(fc().yumcmd.update.call_count, 2)
+        self.assertEqual(reply['status'], 'completed')
+        self.assertEqual(reply['hosts'], {
+            'succeeded': ['web1', 'web2', 'web4', 'web5'],
+            'failed': ['web3'],
+        })
+        self.assertEqual(sorted(reply['results'].keys()), [
+            'web1', 'web2', 'web3', 'web4', 'web5'])
+        self.assertFalse('data' in reply)
+
+    def test_invalid_batch_parameters(self, fc):
+        """
+        Verify bad batch_size or max_failures values fail the step.
+        """
+        for params in ({'batch_size': 0}, {'batch_size': 'many'},
+                       {'max_failures': -1}, {'max_failures': '120%'}):
+            reply = self._run_waves(fc, [], **params)
+            self.assertEqual(reply['status'], 'failed')
+            self.assertEqual(fc().yumcmd.update.call_count, 0)
+
+    def _run_until_timeout(self, fc, config_file, job_status, **params):
+        """
+        Run yumcmd.update on web1 with `params` while job_status
+        answers polls. Returns the final reply and the worker.
+        """
+        fc().list_minions.return_value = ['web1']
+        fc().yumcmd.update.return_value = 'mainjob'
+        fc().command.run.return_value = 'checkjob'
+        fc().job_status.side_effect = job_status
+
+        with nested(
+                mock.patch('pika.SelectConnection'),
+                mock.patch('replugin.funcworker.FuncWorker.notify'),
+                mock.patch('replugin.funcworker.FuncWorker.send')):
+            worker = funcworker.FuncWorker(
+                MQ_CONF,
+                logger=self.app_logger,
+                config_file=config_file,
+                output_dir='/tmp/logs/')
+
+            worker._on_open(self.connection)
+            worker._on_channel_open(self.channel)
+
+            body = {
+                'parameters': {
+                    'command': 'yumcmd',
+                    'subcommand': 'Update',
+                    'hosts': ['web1'],
+                }
+            }
+            body['parameters'].update(params)
+            worker.process(
+                self.channel,
+                self.basic_deliver,
+                self.properties,
+                body,
+                self.logger)
+            worker._executor.join()
+            return (worker.send.call_args[0][2], worker)
+
+    def test_step_times_out_waiting_for_job(self, fc):
+        """
+        Verify a job running past the step's timeout is abandoned and
+        the step replies it timed out.
+        """
+        running = lambda job_id: (func.jobthing.JOB_ID_RUNNING, {})
+        for (config_file, params) in (
+                ('conf/yumcmd.json', {'timeout': 0.1}),
+                # The timeout may come from the conf as well
+                ('test/timeout_yumcmd.json', {})):
+            (reply, worker) = self._run_until_timeout(
+                fc, config_file, running, **params)
+
+            self.assertEqual(reply['status'], 'failed')
+            self.assertTrue(reply['timed_out'])
+            self.assertTrue('Timed out' in reply['data'])
+            self.assertEqual(worker._job_tracker.outstanding(), 0)
+
+    def test_step_times_out_waiting_for_check_scripts(self, fc):
+        """
+        Verify the timeout covers check scripts as well.
+        """
+        def job_status(job_id):
+            if job_id == 'checkjob':
+                return (func.jobthing.JOB_ID_RUNNING, {})
+            return (func.jobthing.JOB_ID_FINISHED, {'web1': [0, '', '']})
+
+        (reply, worker) = self._run_until_timeout(
+            fc, 'conf/yumcmd.json', job_status, timeout=0.3,
+            check_scripts=['neverdone'])
+
+        self.assertEqual(reply['status'], 'failed')
+        self.assertTrue(reply['timed_out'])
+        self.assertTrue('check scripts' in reply['data'])
+        self.assertEqual(worker._job_tracker.outstanding(), 0)
+
+    def test_stage_timings(self, fc):
+        """
+        Verify the time spent in each stage is replied and logged.
+        """
+        def job_status(job_id):
+            if job_id == 'checkjob':
+                return (func.jobthing.JOB_ID_RUNNING, {})
+            return (func.jobthing.JOB_ID_FINISHED, {'web1': [0, '', '']})
+
+        (reply, worker) = self._run_until_timeout(
+            fc, 'conf/yumcmd.json', job_status, timeout=0.3,
+            check_scripts=['neverdone'])
+
+        timings = reply['timings']
+        for stage in ('queued', 'parse', 'lookup', 'client', 'submit',
+                      'poll', 'results', 'check_scripts', 'total'):
+            self.assertTrue(stage in timings, stage)
+        # The check scripts ran until the step timed out
+        self.assertTrue(timings['check_scripts'] >= 0.2)
+        self.assertTrue(timings['total'] >= timings['check_scripts'])
+
+        logged = [c[0][0] for c in self.app_logger.info.call_args_list
+                  if c[0][0].startswith('Step timings: ')]
+        self.assertEqual(len(logged), 1)
+        entry = json.loads(logged[0][len('Step timings: '):])
+        self.assertEqual(entry['status'], 'failed')
+        self.assertEqual(entry['correlation_id'], '123')
+        self.assertEqual(entry['timings'], timings)
+
+    def test_metrics(self, fc):
+        """
+        Verify steps, lookups, polls and retries are counted.
+        """
+        def job_status(job_id):
+            if job_id == 'checkjob':
+                return (func.jobthing.JOB_ID_FINISHED, {'web1': [1, '', '']})
+            return (func.jobthing.JOB_ID_FINISHED, {'web1': [0, '', '']})
+
+        with mock.patch('replugin.funcworker.sleep'):
+            (reply, worker) = self._run_until_timeout(
+                fc, 'conf/yumcmd.json', job_status, tries=2,
+                check_scripts=['neverpasses'])
+        self.assertEqual(reply['status'], 'failed')
+
+        metrics = worker._metrics
+        self.assertEqual(
+            metrics.steps.value(('yumcmd', 'Update', 'failed')), 1)
+        self.assertEqual(metrics.step_seconds.count(('yumcmd', 'Update')), 1)
+        self.assertEqual(metrics.lookup_seconds.count(), 1)
+        self.assertEqual(metrics.job_polls.count(), 2)
+        self.assertEqual(metrics.retries.value(), 1)
+        self.assertEqual(metrics.missing_hosts.value(), 0)
+        self.assertEqual(worker._metrics_server, None)
+        # The client pool is always there, the minion cache is not
+        body = metrics.render()
+        self.assertTrue('funcworker_client_pool_hits_total' in body)
+        self.assertFalse('funcworker_minion_cache_hits_total' in body)
+
+    def test_invalid_timeout(self, fc):
+        """
+        Verify a timeout which is not a positive number fails the step.
+        """
+        finished = lambda job_id: (
+            func.jobthing.JOB_ID_FINISHED, {'web1': [0, '', '']})
+        for timeout in (0, -5, 'soon'):
+            (reply, worker) = self._run_until_timeout(
+                fc, 'conf/yumcmd.json', finished, timeout=timeout)
+            self.assertEqual(reply['status'], 'failed')
+            self.assertFalse('timed_out' in reply)
+
+    def test_unexpected_errors_fail_the_step(self, fc):
+        """
+        Verify errors other than FuncWorkerError still end in a failed
+        reply and notification.
+        """
+        fc().list_minions.return_value = ['web1']
+
+        with nested(
+                mock.patch('pika.SelectConnection'),
+                mock.patch('replugin.funcworker.FuncWorker.notify'),
+                mock.patch('replugin.funcworker.FuncWorker.send')):
+            worker = funcworker.FuncWorker(
+                MQ_CONF,
+                logger=self.app_logger,
+                config_file='conf/puppet.json',
+                output_dir='/tmp/logs/')
+
+            worker._on_open(self.connection)
+            worker._on_channel_open(self.channel)
+
+            body = {
+                'parameters': {
+                    'command': 'puppet',
+                    'subcommand': 'Run',
+                    'hosts': ['web1'],
+                    # block_bad_chars raises TypeError
+                    'tags': ['a;rm -rf /'],
+                }
+            }
+            worker.process(
+                self.channel,
+                self.basic_deliver,
+                self.properties,
+                body,
+                self.logger)
+            worker._executor.join()
+
+            self._assert_error_conditions(
+                worker, 'TypeError: An unsafe char was attempted.')
+            self.assertEqual(fc().command.run.call_count, 0)
+            self.assertEqual(worker._metrics.steps.value(
+                ('puppet', 'Run', 'failed')), 1)
+            self.assertEqual(self.app_logger.exception.call_count, 1)
+
+    def test_progress_is_sent_as_hosts_finish(self, fc):
+        """
+        Verify hosts are reported to reply_to while the job still runs.
+        """
+        fc().list_minions.return_value = ['web1', 'web2']
+        # modified_yumcmd.json keeps the default (quick) polling
+        fc().job_status.side_effect = [
+            (func.jobthing.JOB_ID_ASYNC_PARTIAL, {'web2': [1, '', '']}),
+            (func.jobthing.JOB_ID_FINISHED,
+             {'web1': [10, '', ''], 'web2': [1, '', '']}),
+        ]
+
+        with nested(
+                mock.patch('pika.SelectConnection'),
+                mock.patch('replugin.funcworker.FuncWorker.notify'),
+                mock.patch('replugin.funcworker.FuncWorker.send')):
+            worker = funcworker.FuncWorker(
+                MQ_CONF,
+                logger=self.app_logger,
+                config_file='test/modified_yumcmd.json',
+                output_dir='/tmp/logs/')
+
+            worker._on_open(self.connection)
+            worker._on_channel_open(self.channel)
+
+            body = {
+                'parameters': {
+                    'command': 'yumcmd',
+                    'subcommand': 'Update',
+                    'hosts': ['web*'],
+                    'max_failures': 1,
+                }
+            }
+            worker.process(
+                self.channel,
+                self.basic_deliver,
+                self.properties,
+                body,
+                self.logger)
+            worker._executor.join()
+
+            statuses = [c[0][2]['status'] for c in worker.send.call_args_list]
+            self.assertEqual(statuses, ['started', 'progress', 'completed'])
+            self.assertEqual(worker.send.call_args_list[1][0][2]['data'], {
+                'succeeded': [], 'failed': ['web2'], 'done': 1, 'total': 2})
+
+    def test_large_results_are_capped_and_chunked(self, fc):
+        """
+        Verify big outputs are cut and the reply data sent in chunks.
         """
-        # Set up the mock so the first call returns 1 and the second returns 0
-        fc_mock = fc().command.run().__getitem__
+        fc().list_minions.return_value = ['web1', 'web2']
+        fc().job_status.return_value = (
+            func.jobthing.JOB_ID_FINISHED,
+            {'web1': [0, 'x' * 5000, ''], 'web2': [0, 'ok', '']})
+
+        with nested(
+                mock.patch('pika.SelectConnection'),
+                mock.patch('replugin.funcworker.FuncWorker.notify'),
+                mock.patch('replugin.funcworker.FuncWorker.send')):
+            worker = funcworker.FuncWorker(
+                MQ_CONF,
+                logger=self.app_logger,
+                config_file='test/payload_yumcmd.json',
+                output_dir='/tmp/logs/')
+
+            worker._on_open(self.connection)
+            worker._on_channel_open(self.channel)
+
+            body = {
+                'parameters': {
+                    'command': 'yumcmd',
+                    'subcommand': 'Update',
+                    'hosts': ['web*'],
+                }
+            }
+            worker.process(
+                self.channel,
+                self.basic_deliver,
+                self.properties,
+                body,
+                self.logger)
+            worker._executor.join()
+
+            replies = [c[0][2] for c in worker.send.call_args_list]
+            chunks = [r for r in replies if r['status'] == 'chunk']
+            reply = replies[-1]
+            self.assertEqual(reply['status'], 'completed')
+            self.assertEqual(reply['encoding'], 'json+zlib+base64')
+            self.assertEqual(reply['chunks'], len(chunks))
+            self.assertFalse('data' in reply)
+            self.assertEqual(
+                [c['chunk'] for c in chunks], range(1, len(chunks) + 1))
+            self.assertEqual(reply['hosts']['succeeded'], ['web1', 'web2'])
+
+            self.assertFalse('results' in reply)
+            data = decode(reply['encoding'], [c['data'] for c in chunks])
+            self.assertEqual(data.keys(), ['results'])
+            results = data['results']
+            self.assertEqual(results['web2'], [0, 'ok', ''])
+            self.assertEqual(results['web1'][1], '%s\n... [4960 bytes cut] '
+                             '...\n%s' % ('x' * 20, 'x' * 20))
+
+    def _run_pipeline(self, fc, steps, hosts=['web*']):
+        """
+        Run `steps` as one message on `hosts` with test/pipeline.json.
+        Returns the worker, which stays patched until the test ends.
+        """
+        fc().list_minions.return_value = ['web1']
+        fc.reset_mock()
+        for target in ('pika.SelectConnection',
+                       'replugin.funcworker.FuncWorker.notify',
+                       'replugin.funcworker.FuncWorker.send'):
+            patcher = mock.patch(target)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        worker = funcworker.FuncWorker(
+            MQ_CONF,
+            logger=self.app_logger,
+            config_file='test/pipeline.json',
+            output_dir='/tmp/logs/')
+
+        worker._on_open(self.connection)
+        worker._on_channel_open(self.channel)
+
+        body = {
+            'parameters': {
+                'hosts': hosts,
+                'steps': steps,
+            }
+        }
+        worker.process(
+            self.channel,
+            self.basic_deliver,
+            self.properties,
+            body,
+            self.logger)
+        worker._executor.join()
+        return worker
+
+    def test_pipeline(self, fc):
+        """
+        Verify steps run in order on hosts looked up once, with one
+        reply holding the results of every step.
+        """
+        fc().job_status.return_value = (
+            func.jobthing.JOB_ID_FINISHED, {'web1': [0, 'out', '']})
+        worker = self._run_pipeline(fc, [
+            {'command': 'puppet', 'subcommand': 'Disable'},
+            {'command': 'service', 'subcommand': 'Stop', 'service': 'app'},
+            {'command': 'yumcmd', 'subcommand': 'Install', 'package': 'app'},
+            {'command': 'service', 'subcommand': 'Start', 'service': 'app'},
+        ])
+
+        # started, then a single reply for all steps
+        assert worker.send.call_count == 2
+        reply = worker.send.call_args[0][2]
+        self.assertEqual(reply['status'], 'completed')
+        self.assertEqual(
+            [(step['command'], step['subcommand'], step['status'])
+             for step in reply['data']], [
+                ('puppet', 'Disable', 'completed'),
+                ('service', 'Stop', 'completed'),
+                ('yumcmd', 'Install', 'completed'),
+                ('service', 'Start', 'completed')])
+        self.assertEqual(reply['data'][2]['data'], [0, 'out', ''])
+        assert worker.notify.call_args[0][2] == 'completed'
+
+        # One glob lookup and one func client for all of the steps
+        self.assertEqual(fc().list_minions.call_count, 1)
+        self.assertEqual(
+            fc.call_args_list.count(mock.call('web1', async=True)), 1)
+        fc().command.run.assert_called_once_with(
+            'puppet agent --disable --color=false')
+        fc().service.stop.assert_called_once_with('app')
+        fc().yumcmd.install.assert_called_once_with('app')
+        fc().service.start.assert_called_once_with('app')
+
+    def test_pipeline_steps_run_on_their_own_hosts(self, fc):
+        """
+        Verify steps run on the hosts their parser or their own hosts
+        name, each list of hosts being looked up once.
+        """
+        clients = {}
+
+        def client(server_spec='*', async=False, **kwargs):
+            if server_spec not in clients:
+                clients[server_spec] = mock.MagicMock()
+                clients[server_spec].list_minions.return_value = [
+                    server_spec]
+                clients[server_spec].job_status.return_value = (
+                    func.jobthing.JOB_ID_FINISHED,
+                    {server_spec: [0, '', '']})
+            return clients[server_spec]
+
+        fc.side_effect = client
+        worker = self._run_pipeline(fc, [
+            {'command': 'nagios', 'subcommand': 'ScheduleDowntime',
+             'nagios_url': 'nagios.example.com', 'minutes': 30},
+            {'command': 'service', 'subcommand': 'Stop', 'service': 'app'},
+            {'command': 'service', 'subcommand': 'Stop', 'service': 'db',
+             'hosts': ['db1']},
+            {'command': 'service', 'subcommand': 'Start', 'service': 'app'},
+        ], hosts=['web1'])
+
+        reply = worker.send.call_args[0][2]
+        self.assertEqual(reply['status'], 'completed')
+        self.assertEqual(
+            [step['hosts']['succeeded'] for step in reply['data']],
+            [['nagios.example.com'], ['web1'], ['db1'], ['web1']])
+        # Downtime for web1 is scheduled on the nagios server
+        clients['nagios.example.com'].nagios.schedule_host_downtime.\
+            assert_called_once_with('web1', 30)
+        self.assertEqual(
+            clients['web1'].nagios.schedule_host_downtime.call_count, 0)
+        clients['db1'].service.stop.assert_called_once_with('db')
+        clients['web1'].service.stop.assert_called_once_with('app')
+        clients['web1'].service.start.assert_called_once_with('app')
+        for spec in ('nagios.example.com', 'web1', 'db1'):
+            self.assertEqual(clients[spec].list_minions.call_count, 1)
+
+    def test_pipeline_stops_at_failed_step(self, fc):
+        """
+        Verify the steps after a failed one are skipped.
+        """
+        fc().service.stop.return_value = 'stopjob'
+        fc().job_status.side_effect = lambda job_id: (
+            func.jobthing.JOB_ID_FINISHED,
+            {'web1': [job_id == 'stopjob' and 1 or 0, '', '']})
+        worker = self._run_pipeline(fc, [
+            {'command': 'puppet', 'subcommand': 'Disable'},
+            {'command': 'service', 'subcommand': 'Stop', 'service': 'app'},
+            {'command': 'yumcmd', 'subcommand': 'Install', 'package': 'app'},
+        ])
+
+        self._assert_error_conditions(
+            worker, 'FuncWorker failed trying to execute service.stop')
+        reply = worker.send.call_args[0][2]
+        self.assertTrue('step 2 of 3' in reply['data'])
+        self.assertEqual(
+            [step['status'] for step in reply['steps']],
+            ['completed', 'failed', 'skipped'])
+        self.assertEqual(reply['steps'][1]['hosts']['failed'], ['web1'])
+        self.assertEqual(fc().yumcmd.install.call_count, 0)
+
+    def test_pipeline_checks_every_step_first(self, fc):
+        """
+        Verify no step runs when any of them is invalid.
+        """
+        worker = self._run_pipeline(fc, [
+            {'command': 'service', 'subcommand': 'Stop', 'service': 'app'},
+            {'command': 'yumcmd', 'subcommand': 'Install'},
+        ])
+
+        self._assert_error_conditions(
+            worker, 'Command yumcmd.Install requires the following params')
+        self.assertEqual(fc().service.stop.call_count, 0)
+
+    def test_results_are_processed_by_parser_module(self, fc):
+        """
+        Verify a parser module's process_result sums up the output,
+        unless the step asks for raw_output.
+        """
+        stdout = ("Notice: /Stage[main]/Foo/File[/etc/foo]/content: "
+                  "content changed\n"
+                  "Notice: Finished catalog run in 1.50 seconds")
+        fc().job_status.return_value = (
+            func.jobthing.JOB_ID_FINISHED, {'web1': [2, stdout, '']})
+        worker = self._run_pipeline(fc, [
+            {'command': 'puppet', 'subcommand': 'Run'},
+            {'command': 'puppet', 'subcommand': 'Run', 'raw_output': True},
+        ])
+
+        reply = worker.send.call_args[0][2]
+        self.assertEqual(reply['status'], 'completed')
+        self.assertEqual(reply['data'][0]['data'], [2, {
+            'changes': 1,
+            'changed': ['/Stage[main]/Foo/File[/etc/foo]'],
+            'errors': [],
+            'warnings': 0,
+            'version': None,
+            'seconds': 1.5,
+        }, ''])
+        self.assertEqual(reply['data'][1]['data'], [2, stdout, ''])
+
+    def test_no_hosts_matched(self, fc):
+        """
+        Verify a step fails when its globs match no hosts at all.
+        """
+        fc().list_minions.return_value = []
+
+        with nested(
+                mock.patch('pika.SelectConnection'),
+                mock.patch('replugin.funcworker.FuncWorker.notify'),
+                mock.patch('replugin.funcworker.FuncWorker.send')):
+            worker = funcworker.FuncWorker(
+                MQ_CONF,
+                logger=self.app_logger,
+                config_file='conf/yumcmd.json',
+                output_dir='/tmp/logs/')
+
+            worker._on_open(self.connection)
+            worker._on_channel_open(self.channel)
+
+            body = {
+                'parameters': {
+                    'command': 'yumcmd',
+                    'subcommand': 'Update',
+                    'hosts': ['web*'],
+                }
+            }
+            worker.process(
+                self.channel,
+                self.basic_deliver,
+                self.properties,
+                body,
+                self.logger)
+            worker._executor.join()
+
+            self._assert_error_conditions(worker, 'No hosts matched')
+
+    def test_concurrent_steps(self, fc):
+        """
+        Verify steps run on the step threads when max_in_flight is set.
+        """
+        results = [0, "stdout here", "stderr here"]
+        fc().job_status.return_value = (
+            func.jobthing.JOB_ID_FINISHED, {'127.0.0.1': results})
+        fc().list_minions.return_value = ['127.0.0.1']
+
+        # Hold every job submission until three steps are in flight
+        submitted = []
+        release = threading.Event()
+
+        def submit(*args):
+            submitted.append(args)
+            if len(submitted) == 3:
+                release.set()
+            release.wait(5)
+            return 'jobid'
+
+        fc().yumcmd.update.side_effect = submit
+
+        with nested(
+                mock.patch('pika.SelectConnection'),
+                mock.patch('replugin.funcworker.FuncWorker.notify'),
+                mock.patch('replugin.funcworker.FuncWorker.send')):
+            worker = funcworker.FuncWorker(
+                MQ_CONF,
+                logger=self.app_logger,
+                config_file='test/concurrent_yumcmd.json',
+                output_dir='/tmp/logs/')
+
+            worker._on_open(self.connection)
+            worker._on_channel_open(self.channel)
+
+            for x in range(3):
+                body = {
+                    'parameters': {
+                        'command': 'yumcmd',
+                        'subcommand': 'Update',
+                        'hosts': ['127.0.0.1'],
+                    }
+                }
+                worker.process(
+                    self.channel,
+                    self.basic_deliver,
+                    self.properties,
+                    body,
+                    self.logger)
+
+            worker._executor.join()
+
+            assert release.is_set()
+            self.assertEqual(len(submitted), 3)
+            # start then success for each step
+            self.assertEqual(worker.send.call_count, 6)
+            self.assertEqual(worker.notify.call_count, 3)
+            self.assertEqual(worker._executor.in_flight(), 0)
+
+    def test_process_does_not_block(self, fc):
+        """
+        Verify process returns while the func job is still running.
+        """
+        fc().job_status.return_value = (
+            func.jobthing.JOB_ID_FINISHED, {'127.0.0.1': [0, '', '']})
+        fc().list_minions.return_value = ['127.0.0.1']
+
+        release = threading.Event()
+        running = threading.Event()
+        step_threads = []
+
+        def submit(*args):
+            step_threads.append(threading.current_thread())
+            running.set()
+            release.wait(5)
+            return 'jobid'
+
+        fc().yumcmd.update.side_effect = submit
+
+        with nested(
+                mock.patch('pika.SelectConnection'),
+                mock.patch('replugin.funcworker.FuncWorker.notify'),
+                mock.patch('replugin.funcworker.FuncWorker.send')):
+            worker = funcworker.FuncWorker(
+                MQ_CONF,
+                logger=self.app_logger,
+                config_file='conf/yumcmd.json',
+                output_dir='/tmp/logs/')
+
+            worker._on_open(self.connection)
+            worker._on_channel_open(self.channel)
+
+            body = {
+                'parameters': {
+                    'command': 'yumcmd',
+                    'subcommand': 'Update',
+                    'hosts': ['127.0.0.1'],
+                }
+            }
+            worker.process(
+                self.channel,
+                self.basic_deliver,
+                self.properties,
+                body,
+                self.logger)
+
+            # Only the started message went out so far
+            self.assertEqual(worker.send.call_count, 1)
+            # The message is acked once its step started, through the
+            # outbox of the I/O loop
+            self.assertTrue(running.wait(5))
+            self.assertEqual(self.channel.basic_ack.call_count, 0)
+            worker._outbox.drain()
+            self.channel.basic_ack.assert_called_once_with(123)
+            release.set()
+            worker._executor.join()
+
+            self.assertEqual(worker.send.call_count, 2)
+            self.assertNotEqual(step_threads[0], threading.current_thread())
+            # The broker only hands out as many messages as can run
+            self.channel.basic_qos.assert_called_once_with(prefetch_count=1)
+
+    def test_concurrent_replies_go_through_outbox(self, fc):
+        """
+        Verify replies from step threads are only sent by the I/O loop.
+        """
+        results = [0, "stdout here", "stderr here"]
+        fc().job_status.return_value = (
+            func.jobthing.JOB_ID_FINISHED, {'127.0.0.1': results})
+        fc().list_minions.return_value = ['127.0.0.1']
+
+        with nested(
+                mock.patch('pika.SelectConnection'),
+                mock.patch('reworker.worker.Worker.notify'),
+                mock.patch('reworker.worker.Worker.send')):
+            worker = funcworker.FuncWorker(
+                MQ_CONF,
+                logger=self.app_logger,
+                config_file='test/concurrent_yumcmd.json',
+                output_dir='/tmp/logs/')
 
-        def decrement(*args):
-            def second_call(*args):
-                return 0
-            fc_mock.side_effect = second_call
-            return 1
+            worker._on_open(self.connection)
+            worker._on_channel_open(self.channel)
 
-        fc_mock.side_effect = decrement
+            body = {
+                'parameters': {
+                    'command': 'yumcmd',
+                    'subcommand': 'Update',
+                    'hosts': ['127.0.0.1'],
+                }
+            }
+            worker.process(
+                self.channel,
+                self.basic_deliver,
+                self.properties,
+                body,
+                self.logger)
+            worker._executor.join()
+
+            # Only the started message was sent from the I/O thread
+            self.assertEqual(funcworker.Worker.send.call_count, 1)
+            self.assertEqual(funcworker.Worker.notify.call_count, 0)
+
+            worker._drain_outbox()
+            self.assertEqual(funcworker.Worker.send.call_count, 2)
+            self.assertEqual(
+                funcworker.Worker.send.call_args[0][3]['status'],
+                'completed')
+            self.assertEqual(funcworker.Worker.notify.call_count, 1)
+            # And the drain is scheduled again on the I/O loop
+            worker._connection.add_timeout.assert_called_with(
+                worker.outbox_interval, worker._drain_outbox)
 
+    def test_good_with_eventually_working_check_script(self, fc):
+        """
+        When test scripts return non 0 tries should execute.
+        """
         for config_file, cmd, sub, rargs in CONFIG_FILES:
             with nested(
                     mock.patch('pika.SelectConnection'),
@@ -709,8 +1695,9 @@ class TestFuncWorker(TestCase):
                     "stderr here"
                 ]
 
-                fc().job_status.return_value = (
-                    func.jobthing.JOB_ID_FINISHED, {'127.0.0.1': results})
+                # The check script fails once, then passes
+                self._check_job_status(fc, results, [1, 0])
+                fc().list_minions.return_value = ['127.0.0.1']
 
                 target = getattr(getattr(fc(), cmd), sub.lower())
                 target.return_value = results
@@ -736,11 +1723,21 @@ class TestFuncWorker(TestCase):
                     self.properties,
                     body,
                     self.logger)
+                worker._executor.join()
 
                 assert worker.send.call_count == 2  # start then success
-                assert worker.send.call_args[0][2] == {
+                reply = worker.send.call_args[0][2]
+                check_summary = reply.pop('check_scripts')
+                assert 'total' in reply.pop('timings')
+                assert reply == {
                     'status': 'completed', 'data': results,
+                    'results': {'127.0.0.1': results},
+                    'hosts': {'succeeded': ['127.0.0.1'], 'failed': []},
                 }
+                # The check script ran on both tries
+                assert check_summary['eventuallyworks']['passed'] is True
+                assert check_summary['eventuallyworks']['runs'] == 2
+                assert len(check_summary['eventuallyworks']['timings']) == 2
 
                 # Notification should succeed
                 assert worker.notify.call_count == 1
@@ -750,9 +1747,8 @@ class TestFuncWorker(TestCase):
                 # Log should happen as info at least once
                 assert self.logger.info.call_count >= 1
 
-                # No sleeping should have occured as the check script
-                # returned 0 or wasn't provided
-                assert funcworker.sleep.call_count == 2
+                # One wait before trying again
+                assert funcworker.sleep.call_count == 1
 
                 assert fc.call_args[0][0] == '127.0.0.1'
                 # And the client should execute expected calls
@@ -768,7 +1764,6 @@ class TestFuncWorker(TestCase):
         """
         When test scripts are given they should be executed.
         """
-        fc().command.run().__getitem__.return_value = 1
 
         # Make the Func return data
         # NOTE: this causes fc's call count to ++
@@ -778,8 +1773,8 @@ class TestFuncWorker(TestCase):
             "stderr here"
         ]
 
-        fc().job_status.return_value = (
-            func.jobthing.JOB_ID_FINISHED, {'127.0.0.1': results})
+        self._check_job_status(fc, results, [1])
+        fc().list_minions.return_value = ['127.0.0.1']
 
         for config_file, cmd, sub, rargs in CONFIG_FILES:
             with nested(
@@ -818,9 +1813,15 @@ class TestFuncWorker(TestCase):
                     self.properties,
                     body,
                     self.logger)
+                worker._executor.join()
 
                 assert worker.send.call_count == 2  # start then success
                 assert worker.send.call_args[0][2]['status'] == 'failed'
+                check_summary = worker.send.call_args[0][2]['check_scripts']
+                assert check_summary['failingcheckscript']['passed'] is False
+                assert check_summary['failingcheckscript']['runs'] == 2
+                assert check_summary['failingcheckscript'][
+                    'failed_hosts'] == ['127.0.0.1']
 
                 # Notification should succeed
                 assert worker.notify.call_count == 1
@@ -830,9 +1831,8 @@ class TestFuncWorker(TestCase):
                 # Log should happen as info at least once
                 assert self.logger.info.call_count >= 1
 
-                # No sleeping should have occured as the check script
-                # returned 0 or wasn't provided
-                assert funcworker.sleep.call_count == 4
+                # Only the failing check script waits between tries
+                assert funcworker.sleep.call_count == 2
 
                 assert fc.call_args[0][0] == '127.0.0.1'
                 # And the client should execute expected calls
@@ -848,7 +1848,6 @@ class TestFuncWorker(TestCase):
         """
         When test scripts are given they should be executed.
         """
-        fc().command.run().__getitem__.return_value = 0
 
         for config_file, cmd, sub, rargs in CONFIG_FILES:
             for check_scripts in ([], ['fakescript']):
@@ -870,8 +1869,8 @@ class TestFuncWorker(TestCase):
                         "stdout here",
                         "stderr here"
                     ]
-                    fc().job_status.return_value = (
-                    func.jobthing.JOB_ID_FINISHED, {'127.0.0.1': results})
+                    self._check_job_status(fc, results, [0])
+                    fc().list_minions.return_value = ['127.0.0.1']
 
                     target = getattr(getattr(fc(), cmd), sub.lower())
                     target.return_value = results
@@ -897,11 +1896,18 @@ class TestFuncWorker(TestCase):
                         self.properties,
                         body,
                         self.logger)
+                    worker._executor.join()
 
                     assert worker.send.call_count == 2  # start then success
-                    assert worker.send.call_args[0][2] == {
+                    reply = worker.send.call_args[0][2]
+                    check_summary = reply.pop('check_scripts', {})
+                    assert 'total' in reply.pop('timings')
+                    assert reply == {
                         'status': 'completed', 'data': results,
+                        'results': {'127.0.0.1': results},
+                        'hosts': {'succeeded': ['127.0.0.1'], 'failed': []},
                     }
+                    assert sorted(check_summary.keys()) == check_scripts
 
                     # Notification should succeed
                     assert worker.notify.call_count == 1
@@ -913,11 +1919,12 @@ class TestFuncWorker(TestCase):
 
                     # No sleeping should have occured as the check script
                     # returned 0 or wasn't provided
-                    assert funcworker.sleep.call_count == 1 + len(check_scripts)
+                    assert funcworker.sleep.call_count == 0
 
                     assert fc.call_args[0][0] == '127.0.0.1'
                     # And the client should execute expected calls
-                    assert target.call_count == (1 + len(check_scripts))
+                    # Passing check scripts need no second try
+                    assert target.call_count == 1
                     target.assert_called_with(*[
                         'test_data' for x in range(len(rargs))])
 
@@ -929,7 +1936,6 @@ class TestFuncWorker(TestCase):
         """
         When test scripts are given they should be executed.
         """
-        fc().command.run().__getitem__.return_value = 1
 
         for config_file, cmd, sub, rargs in CONFIG_FILES:
             with nested(
@@ -951,8 +1957,8 @@ class TestFuncWorker(TestCase):
                     "stderr here"
                 ]
 
-                fc().job_status.return_value = (
-                    func.jobthing.JOB_ID_FINISHED, {'127.0.0.1': results})
+                self._check_job_status(fc, results, [1])
+                fc().list_minions.return_value = ['127.0.0.1']
 
                 target = getattr(getattr(fc(), cmd), sub.lower())
                 target.return_value = results
@@ -978,6 +1984,7 @@ class TestFuncWorker(TestCase):
                     self.properties,
                     body,
                     self.logger)
+                worker._executor.join()
 
                 assert worker.send.call_count == 2  # start then success
                 assert worker.send.call_args[0][2]['status'] == 'failed'
@@ -990,9 +1997,8 @@ class TestFuncWorker(TestCase):
                 # Log should happen as info at least once
                 assert self.logger.info.call_count >= 1
 
-                # No sleeping should have occured as the check script
-                # returned 0 or wasn't provided
-                assert funcworker.sleep.call_count == 4
+                # Only the failing check script waits between tries
+                assert funcworker.sleep.call_count == 2
 
                 assert fc.call_args[0][0] == '127.0.0.1'
                 # And the client should execute expected calls
@@ -1003,3 +2009,256 @@ class TestFuncWorker(TestCase):
             # Force reset
             fc.reset_mock()
             self._reset_mocks()
+
+    def test_only_failing_check_scripts_run_again(self, fc):
+        """
+        Check scripts which passed are not run again on later tries.
+        """
+        config_file, cmd, sub, rargs = CONFIG_FILES[0]
+        results = [0, "stdout here", "stderr here"]
+        # The check script job ids are the scripts themselves
+        fc().command.run.side_effect = lambda script: script
+        # flaky is still running when passes finishes, then fails once
+        check_rcs = {'passes': [0], 'flaky': [None, 1, 0]}
+
+        def job_status(job_id):
+            if job_id in check_rcs:
+                rc = check_rcs[job_id].pop(0)
+                if rc is None:
+                    return (func.jobthing.JOB_ID_RUNNING, {})
+                return (func.jobthing.JOB_ID_FINISHED,
+                        {'127.0.0.1': [rc, '', '']})
+            return (func.jobthing.JOB_ID_FINISHED, {'127.0.0.1': results})
+
+        fc().job_status.side_effect = job_status
+        fc().list_minions.return_value = ['127.0.0.1']
+
+        with nested(
+                mock.patch('pika.SelectConnection'),
+                mock.patch('replugin.funcworker.FuncWorker.notify'),
+                mock.patch('replugin.funcworker.FuncWorker.send'),
+                mock.patch('replugin.funcworker.sleep')):
+            worker = funcworker.FuncWorker(
+                MQ_CONF,
+                logger=self.app_logger,
+                config_file=config_file,
+                output_dir='/tmp/logs/')
+            target = getattr(getattr(fc(), cmd), sub.lower())
+            target.return_value = 'mainjob'
+            worker._on_open(self.connection)
+            worker._on_channel_open(self.channel)
+
+            body = {
+                'parameters': {
+                    'command': cmd,
+                    'subcommand': sub,
+                    'hosts': ['127.0.0.1'],
+                    'tries': 3,
+                    'check_scripts': ['passes', 'flaky'],
+                }
+            }
+            for key in rargs:
+                body['parameters'][key] = 'test_data'
+
+            worker.process(
+                self.channel,
+                self.basic_deliver,
+                self.properties,
+                body,
+                self.logger)
+            worker._executor.join()
+
+            reply = worker.send.call_args[0][2]
+            assert reply['status'] == 'completed'
+            assert reply['check_scripts']['passes']['runs'] == 1
+            assert reply['check_scripts']['flaky']['runs'] == 2
+            assert [c[0][0] for c in fc().command.run.call_args_list] == [
+                'passes', 'flaky', 'flaky']
+            assert target.call_count == 2
+            assert funcworker.sleep.call_count == 1
+
+
+class TestBlockBadChars(TestCase):
+
+    def test_safe_args_pass(self):
+        """
+        Verify safe strings, numbers and nested lists are let through.
+        """
+        args = ['host', ['SVC1', ('SVC2',)], {'key': 'value'}, 1, None]
+        self.assertEqual(funcworker.block_bad_chars(args), args)
+
+    def test_unsafe_chars_are_blocked(self):
+        """
+        Verify unsafe chars are found wherever they are nested.
+        """
+        for bad in (['ok', 'rm -rf /;'], [1, ['a', ['b|c']]],
+                    [{'key': 'a > b'}], [{'$key': 'value'}], 'a&b'):
+            self.assertRaises(TypeError, funcworker.block_bad_chars, bad)
+
+
+class TestHostResults(TestCase):
+
+    def test_normalize_result(self):
+        """
+        Verify every func result shape becomes [rc, stdout, stderr].
+        """
+        self.assertEqual(
+            funcworker.normalize_result([2, 'out', 'err']), [2, 'out', 'err'])
+        self.assertEqual(
+            funcworker.normalize_result('done'), [0, 'done', ''])
+        self.assertEqual(
+            funcworker.normalize_result(['a', 'b']), [0, 'a, b', ''])
+        self.assertEqual(
+            funcworker.normalize_result(
+                ['REMOTE_ERROR', 'socket.error', 'refused']),
+            [1, '', 'socket.error, refused'])
+
+    def test_evaluate_host_results(self):
+        """
+        Verify return codes are applied to every host and silent hosts fail.
+        """
+        (host_results, succeeded, failed) = funcworker.evaluate_host_results(
+            {'b.example.com': [2, '', ''], 'a.example.com': [0, '', '']},
+            [0, 2],
+            ['a.example.com', 'b.example.com', 'c.example.com'])
+
+        self.assertEqual(succeeded, ['a.example.com', 'b.example.com'])
+        self.assertEqual(failed, ['c.example.com'])
+        self.assertEqual(host_results['c.example.com'][0], None)
+
+    def test_parse_max_failures(self):
+        """
+        Verify max_failures may be a count or a percentage of the hosts.
+        """
+        self.assertEqual(funcworker.parse_max_failures(0, 10), 0)
+        self.assertEqual(funcworker.parse_max_failures('3', 10), 3)
+        self.assertEqual(funcworker.parse_max_failures('25%', 10), 2)
+        self.assertEqual(funcworker.parse_max_failures('100%', 10), 10)
+        for bad in (-1, 'lots', '101%', None):
+            self.assertRaises(
+                funcworker.FuncWorkerError,
+                funcworker.parse_max_failures, bad, 10)
+
+
+class TestExpandGlobs(TestCase):
+
+    def setUp(self):
+        self.app_logger = mock.MagicMock('logging.Logger').__call__()
+
+    def _client(self, minions, delay=0):
+        """
+        Builds a fake fc.Client class answering list_minions from
+        the `minions` dict of glob -> hosts.
+        """
+        lock = threading.Lock()
+        state = {'running': 0, 'peak': 0}
+
+        def client(glob, **kwargs):
+            if minions[glob] is None:
+                raise func.CommonErrors.Func_Client_Exception(
+                    'Cannot find any hosts that match "%s"' % glob)
+
+            def list_minions():
+                with lock:
+                    state['running'] += 1
+                    state['peak'] = max(state['peak'], state['running'])
+                threading.Event().wait(delay)
+                with lock:
+                    state['running'] -= 1
+                return minions[glob]
+            return mock.MagicMock(list_minions=list_minions)
+        return (client, state)
+
+    def test_globs_are_merged_in_order(self):
+        """
+        Verify parallel lookups are merged in the order of the globs.
+        """
+        minions = {
+            'web*': ['web2', 'web1'],
+            'db*': ['db1'],
+            'web1': ['web1'],
+            'nope*': None,
+            'gone': None,
+        }
+        (client, state) = self._client(minions, delay=0.01)
+        with mock.patch('func.overlord.client.Client', client):
+            (found, missing) = funcworker.expand_globs(
+                ['web*', 'nope*', 'db*', 'web1', 'gone'], self.app_logger, 3)
+
+        self.assertEqual(found, ['web2', 'web1', 'db1'])
+        self.assertEqual(missing, ['nope*', 'gone'])
+        assert 1 < state['peak'] <= 3
+
+    def test_lookup_errors_are_raised(self):
+        """
+        Verify unexpected func errors from a lookup reach the caller.
+        """
+        with mock.patch('func.overlord.client.Client') as client:
+            client.side_effect = FuncException('Func error raised.')
+            self.assertRaises(
+                FuncException, funcworker.expand_globs,
+                ['a', 'b', 'c'], self.app_logger, 2)
+
+    def test_lookups_time_out(self):
+        """
+        Verify lookups still running at the deadline raise a timeout.
+        """
+        inventory = mock.MagicMock()
+        inventory.lookup.side_effect = lambda glob, app_logger: (
+            time.sleep(1) or ([glob], None))
+
+        start = time.time()
+        self.assertRaises(
+            funcworker.FuncWorkerTimeout,
+            funcworker.expand_globs, ['slow1', 'slow2'], self.app_logger,
+            inventory=inventory, deadline=Deadline(0.1))
+        self.assertTrue(time.time() - start < 1)
+
+
+@attr('benchmark')
+class TestExpandGlobsScaling(TestCase):
+    """
+    Benchmarks guarding against slow host de-duplication on big fleets.
+    """
+
+    def setUp(self):
+        self.app_logger = mock.MagicMock('logging.Logger').__call__()
+
+    def _resolve(self, count):
+        """
+        Resolve overlapping globs over `count` synthetic minions and
+        return the seconds it took.
+        """
+        minions = ['host%06d.prod.example.com' % x for x in range(count)]
+        halves = {
+            '*.prod.example.com': minions,
+            'host0*': minions[:count / 2],
+            'host*': list(reversed(minions)),
+        }
+
+        def client(glob, **kwargs):
+            return mock.MagicMock(
+                list_minions=mock.MagicMock(return_value=halves[glob]))
+
+        with mock.patch('func.overlord.client.Client', client):
+            start = time.time()
+            (found, missing) = funcworker.expand_globs(
+                ['*.prod.example.com', 'host0*', 'host*'], self.app_logger)
+            elapsed = time.time() - start
+
+        self.assertEqual(found, minions)
+        self.assertEqual(missing, [])
+        log.info("Resolved %s minions in %.3f seconds", count, elapsed)
+        return elapsed
+
+    def test_resolve_10k_minions(self):
+        """
+        Benchmark: resolving 10k minions stays fast.
+        """
+        assert self._resolve(10000) < 1
+
+    def test_resolve_50k_minions(self):
+        """
+        Benchmark: resolving 50k minions stays fast.
+        """
+        assert self._resolve(50000) < 5
@@ -0,0 +1,125 @@
+# Copyright (C) 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Unittests for the minion inventory cache.
+"""
+
+import mock
+
+from . import TestCase
+
+from replugin import funcworker
+from replugin.funcworker.inventory import MinionInventory
+
+
+MINIONS = ['web1.example.com', 'web2.example.com', 'db1.example.com']
+
+
+@mock.patch('func.overlord.client.Client')
+class TestMinionInventory(TestCase):
+
+    def setUp(self):
+        self.app_logger = mock.MagicMock('logging.Logger').__call__()
+        self.fallback = mock.MagicMock(return_value=(['grouped'], None))
+
+    def test_globs_match_cached_minions(self, fc):
+        """
+        Verify globs are matched locally once the inventory is loaded.
+        """
+        fc().list_minions.return_value = MINIONS
+        inventory = MinionInventory(300, self.fallback)
+
+        self.assertEqual(
+            inventory.lookup('web*', self.app_logger),
+            (['web1.example.com', 'web2.example.com'], None))
+        self.assertEqual(
+            inventory.lookup('db1.example.com', self.app_logger),
+            (['db1.example.com'], None))
+
+        self.assertEqual(fc().list_minions.call_count, 1)
+        fc.assert_any_call('*')
+        self.assertEqual(inventory.stats(), {
+            'hits': 1, 'misses': 1, 'refreshes': 1, 'minions': 3})
+
+    def test_ttl_expiry_refreshes(self, fc):
+        """
+        Verify the inventory is loaded again once the TTL passed.
+        """
+        fc().list_minions.return_value = MINIONS
+        inventory = MinionInventory(300, self.fallback)
+
+        with mock.patch('replugin.funcworker.inventory.clock') as now:
+            now.return_value = 1000
+            inventory.lookup('web*', self.app_logger)
+            now.return_value = 1299
+            inventory.lookup('web*', self.app_logger)
+            self.assertEqual(inventory.refreshes, 1)
+            now.return_value = 1300
+            inventory.lookup('web*', self.app_logger)
+            self.assertEqual(inventory.refreshes, 2)
+
+    def test_miss_forces_refresh(self, fc):
+        """
+        Verify a glob matching nothing refreshes, but not too often.
+        """
+        fc().list_minions.return_value = MINIONS
+        inventory = MinionInventory(300, self.fallback, min_refresh=5)
+
+        with mock.patch('replugin.funcworker.inventory.clock') as now:
+            now.return_value = 1000
+            inventory.lookup('web*', self.app_logger)
+
+            # Too soon after the last refresh
+            now.return_value = 1002
+            self.assertEqual(
+                inventory.lookup('new1.example.com', self.app_logger),
+                ([], 'new1.example.com'))
+            self.assertEqual(inventory.refreshes, 1)
+
+            # The new minion shows up on the forced refresh
+            fc().list_minions.return_value = MINIONS + ['new1.example.com']
+            now.return_value = 1010
+            self.assertEqual(
+                inventory.lookup('new1.example.com', self.app_logger),
+                (['new1.example.com'], None))
+            self.assertEqual(inventory.refreshes, 2)
+
+    def test_groups_use_fallback(self, fc):
+        """
+        Verify group and multi host specs are not cached.
+        """
+        inventory = MinionInventory(300, self.fallback)
+        self.assertEqual(
+            inventory.lookup('@webservers', self.app_logger),
+            (['grouped'], None))
+        inventory.lookup('a;b', self.app_logger)
+
+        self.assertEqual(self.fallback.call_count, 2)
+        self.assertEqual(inventory.refreshes, 0)
+
+    def test_expand_globs_uses_inventory(self, fc):
+        """
+        Verify expand_globs resolves through the inventory.
+        """
+        fc().list_minions.return_value = MINIONS
+        inventory = MinionInventory(300, self.fallback)
+
+        (found, missing) = funcworker.expand_globs(
+            ['web*', 'web1.example.com', 'nope*'], self.app_logger,
+            inventory=inventory)
+
+        self.assertEqual(found, ['web1.example.com', 'web2.example.com'])
+        self.assertEqual(missing, ['nope*'])
+        self.assertEqual(fc().list_minions.call_count, 1)
@@ -0,0 +1,110 @@
+# Copyright (C) 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Unittests for worker metrics.
+"""
+
+import urllib2
+
+from . import TestCase
+
+from replugin.funcworker.metrics import (
+    Counter, Histogram, MetricsRegistry, MetricsServer, WorkerMetrics)
+
+
+class TestMetrics(TestCase):
+
+    def test_render(self):
+        """
+        Verify metrics render in the Prometheus text format.
+        """
+        registry = MetricsRegistry()
+        steps = registry.add(Counter(
+            'steps_total', 'Steps.', ('command', 'status')))
+        seconds = registry.add(Histogram('seconds', 'Seconds.', (1, 5)))
+        steps.inc(('yumcmd', 'completed'))
+        steps.inc(('yumcmd', 'completed'))
+        steps.inc(('say "hi"', 'failed'))
+        seconds.observe(0.5)
+        seconds.observe(3)
+        seconds.observe(10)
+
+        self.assertEqual(registry.render(), '\n'.join([
+            '# HELP steps_total Steps.',
+            '# TYPE steps_total counter',
+            'steps_total{command="say \\"hi\\"",status="failed"} 1.0',
+            'steps_total{command="yumcmd",status="completed"} 2.0',
+            '# HELP seconds Seconds.',
+            '# TYPE seconds histogram',
+            'seconds_bucket{le="1.0"} 1.0',
+            'seconds_bucket{le="5.0"} 2.0',
+            'seconds_bucket{le="+Inf"} 3.0',
+            'seconds_count 3.0',
+            'seconds_sum 13.5',
+        ]) + '\n')
+        self.assertEqual(steps.value(('yumcmd', 'completed')), 2)
+        self.assertEqual(seconds.count(), 3)
+
+    def test_server(self):
+        """
+        Verify the metrics are served over HTTP.
+        """
+        metrics = WorkerMetrics(lambda: 3)
+        server = MetricsServer(metrics, 0)
+        server.start()
+        self.addCleanup(server.stop)
+
+        body = urllib2.urlopen(
+            'http://127.0.0.1:%s/metrics' % server.port).read()
+        self.assertTrue('funcworker_steps_in_flight 3.0\n' in body)
+        self.assertTrue('# TYPE funcworker_step_seconds histogram' in body)
+
+    def test_client_pool_metrics(self):
+        """
+        Verify the client pool's size and counts are read on render.
+        """
+        stats = {'size': 4, 'capacity': 32, 'hits': 3, 'misses': 1,
+                 'hit_rate': 0.75}
+        metrics = WorkerMetrics(lambda: 0, lambda: stats)
+        body = metrics.render()
+        for line in ('# TYPE funcworker_client_pool_size gauge',
+                     'funcworker_client_pool_size 4.0',
+                     '# TYPE funcworker_client_pool_hits_total counter',
+                     'funcworker_client_pool_hits_total 3.0',
+                     '# TYPE funcworker_client_pool_misses_total counter',
+                     'funcworker_client_pool_misses_total 1.0'):
+            self.assertTrue(line + '\n' in body, line)
+
+        stats['size'] = 5
+        body = metrics.render()
+        self.assertTrue('funcworker_client_pool_size 5.0\n' in body)
+
+    def test_inventory_metrics(self):
+        """
+        Verify the minion cache counters are read on render, and only
+        kept when the worker has a cache.
+        """
+        stats = {'hits': 7, 'misses': 2, 'refreshes': 1, 'minions': 40}
+        body = WorkerMetrics(lambda: 0, None, lambda: stats).render()
+        for line in ('# TYPE funcworker_minion_cache_hits_total counter',
+                     'funcworker_minion_cache_hits_total 7.0',
+                     'funcworker_minion_cache_misses_total 2.0',
+                     'funcworker_minion_cache_refreshes_total 1.0',
+                     '# TYPE funcworker_minion_cache_minions gauge',
+                     'funcworker_minion_cache_minions 40.0'):
+            self.assertTrue(line + '\n' in body, line)
+
+        body = WorkerMetrics(lambda: 0).render()
+        self.assertFalse('funcworker_minion_cache' in body)
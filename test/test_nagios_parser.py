@@ -108,17 +108,42 @@ class TestNagiosParser(TestCase):
 
     def test_good_process_result(self):
         """nagios:ProcessResult: Test processing nagios command results"""
-        # TODO: Implement the process_result function
-        replugin.funcworker.nagios.process_result(None)
+        result = replugin.funcworker.nagios.process_result(
+            'ScheduleDowntime',
+            '[1400000000] SCHEDULE_HOST_DOWNTIME;web1;1400000000;'
+            '1400001800;1;0;1800;func;Downtime')
+        self.assertEqual(result, [0, {'scheduled': [{
+            'command': 'SCHEDULE_HOST_DOWNTIME', 'host': 'web1',
+            'start': 1400000000, 'end': 1400001800}]}, ''])
+
+        result = replugin.funcworker.nagios.process_result(
+            'ScheduleDowntime', [
+                '[1400000000] SCHEDULE_SVC_DOWNTIME;web1;httpd;1400000000;'
+                '1400001800;1;0;1800;func;Downtime',
+                'something else'])
+        self.assertEqual(result[1]['scheduled'], [
+            {'command': 'SCHEDULE_SVC_DOWNTIME', 'host': 'web1',
+             'service': 'httpd', 'start': 1400000000, 'end': 1400001800},
+            {'command': 'something else'}])
 
     def test_bad_process_result(self):
         """nagios:ProcessResult: Test processing nagios command results failure"""
-        # TODO: Implement the process_result function
-        replugin.funcworker.nagios.process_result(None)
+        result = replugin.funcworker.nagios.process_result(
+            'ScheduleDowntime', ['REMOTE_ERROR', 'IOError', 'no cmd file'])
+        self.assertEqual(result, [1, '', 'IOError, no cmd file'])
 
-    @mock.patch('replugin.funcworker.nagios._parse_ScheduleDowntime')
-    def test_good_parse_target_params(self, scheduledt):
+        # Other subcommands are only normalized
+        result = replugin.funcworker.nagios.process_result(
+            'silence_host', ['silenced', 'web1'])
+        self.assertEqual(result, [0, 'silenced, web1', ''])
+
+    def test_good_parse_target_params(self):
         """nagios:ParseTargetParams: Test looking up a special parser passes"""
+        scheduledt = mock.MagicMock()
+        parsers = mock.patch.dict(
+            replugin.funcworker.nagios.PARSERS, {'ScheduleDowntime': scheduledt})
+        parsers.start()
+        self.addCleanup(parsers.stop)
         scheduledt.return_value = ({}, [])
 
         params = {
@@ -131,9 +156,13 @@ class TestNagiosParser(TestCase):
         self.app_logger.debug.assert_called_once_with("Found parser: _parse_ScheduleDowntime")
         self.app_logger.reset_mock()
 
-    @mock.patch('replugin.funcworker.nagios._parse_ScheduleDowntime')
-    def test_bad_parse_target_params(self, scheduledt):
+    def test_bad_parse_target_params(self):
         """nagios:ParseTargetParams: Invalid subcommands raise while looking for parser"""
+        scheduledt = mock.MagicMock()
+        parsers = mock.patch.dict(
+            replugin.funcworker.nagios.PARSERS, {'ScheduleDowntime': scheduledt})
+        parsers.start()
+        self.addCleanup(parsers.stop)
         scheduledt.return_value = ({}, [])
 
         params = {
@@ -146,3 +175,25 @@ class TestNagiosParser(TestCase):
         with self.assertRaises(ValueError):
             (_params_result,
              _method_args) = ptp(params, self.app_logger)
+
+    def test_dangerous_parse_target_params(self):
+        """nagios:ParseTargetParams: Verify bad shell chars in nested args are blocked"""
+        scheduledt = mock.MagicMock()
+        parsers = mock.patch.dict(
+            replugin.funcworker.nagios.PARSERS, {'ScheduleDowntime': scheduledt})
+        parsers.start()
+        self.addCleanup(parsers.stop)
+        params = {
+            'command': 'nagios',
+            'subcommand': 'ScheduleDowntime'
+        }
+        ptp = replugin.funcworker.nagios.parse_target_params
+
+        # Service lists and minutes pass when they are safe
+        scheduledt.return_value = ({}, ['host', ['SVC1', 'SVC2'], 1])
+        ptp(params, self.app_logger)
+
+        for bad_data in (['host;', ['SVC'], 1], ['host', ['SVC', '$(id)'], 1]):
+            scheduledt.return_value = ({}, bad_data)
+            with self.assertRaises(TypeError):
+                ptp(params, self.app_logger)
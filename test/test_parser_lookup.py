@@ -48,6 +48,7 @@ class TestParserLookup(TestCase):
         self.channel = mock.MagicMock('pika.spec.Channel')
         self.channel.basic_consume = mock.Mock('basic_consume')
         self.channel.basic_ack = mock.Mock('basic_ack')
+        self.channel.basic_qos = mock.Mock('basic_qos')
         self.channel.basic_publish = mock.Mock('basic_publish')
 
         self.basic_deliver = mock.MagicMock()
@@ -76,6 +77,7 @@ class TestParserLookup(TestCase):
         self.channel.reset_mock()
         self.channel.basic_consume.reset_mock()
         self.channel.basic_ack.reset_mock()
+        self.channel.basic_qos.reset_mock()
         self.channel.basic_publish.reset_mock()
 
         self.basic_deliver.reset_mock()
@@ -114,6 +116,7 @@ class TestParserLookup(TestCase):
         fc().job_status.return_value = (
             func.jobthing.JOB_ID_FINISHED,
             {'nagios.example.com': results})
+        fc().list_minions.return_value = ['nagios.example.com']
 
         config_file = 'conf/nagios.json'
         # Nagios 'ScheduleDowntime' with the parameters we provided
@@ -155,10 +158,15 @@ class TestParserLookup(TestCase):
                 self.properties,
                 body,
                 self.logger)
+            worker._executor.join()
 
             assert worker.send.call_count == 2  # start then success
-            assert worker.send.call_args[0][2] == {
+            reply = worker.send.call_args[0][2]
+            assert 'total' in reply.pop('timings')
+            assert reply == {
                 'status': 'completed', 'data': results,
+                'results': {'nagios.example.com': results},
+                'hosts': {'succeeded': ['nagios.example.com'], 'failed': []},
             }
 
             # Notification should succeed
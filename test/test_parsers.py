@@ -0,0 +1,83 @@
+# Copyright (C) 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Unittests for the parser registry.
+"""
+
+import mock
+
+from . import TestCase
+
+import replugin.funcworker.nagios
+import replugin.funcworker.puppet
+from replugin.funcworker.parsers import ParserRegistry
+
+
+class TestParserRegistry(TestCase):
+
+    def setUp(self):
+        self.app_logger = mock.MagicMock('logging.Logger').__call__()
+        self.registry = ParserRegistry(self.app_logger)
+
+    def test_discover(self):
+        """
+        Verify parser modules are found for the commands which have one.
+        """
+        self.registry.discover(
+            ['puppet', 'yumcmd', 'polling', 'queue'], 'replugin.funcworker')
+
+        self.assertEqual(
+            self.registry.lookup('puppet', 'Run'),
+            replugin.funcworker.puppet.parse_target_params)
+        # No parser module means the generic parser
+        self.assertEqual(self.registry.lookup('yumcmd', 'Install'), None)
+        # Modules which are not parsers are ignored
+        self.assertEqual(self.registry.lookup('polling', 'Run'), None)
+
+    def test_unknown_subcommand(self):
+        """
+        Verify subcommands missing from a parser module raise ValueError.
+        """
+        self.registry.discover(['puppet'], 'replugin.funcworker')
+        try:
+            self.registry.lookup('puppet', 'Unable')
+            self.fail('No ValueError raised')
+        except ValueError, ve:
+            self.assertEqual(ve.subcommand, 'Unable')
+
+    def test_parser_modules(self):
+        """
+        Verify parser modules can be given for commands explicitly.
+        """
+        self.registry.discover(
+            ['monitoring'], 'replugin.funcworker',
+            {'monitoring': 'replugin.funcworker.nagios'})
+
+        self.assertEqual(
+            self.registry.lookup('monitoring', 'ScheduleDowntime'),
+            replugin.funcworker.nagios.parse_target_params)
+
+    def test_result_processor(self):
+        """
+        Verify result processors come from the parser module.
+        """
+        self.registry.discover(['puppet', 'yumcmd'], 'replugin.funcworker')
+        process = self.registry.result_processor('puppet', 'Enable')
+        self.assertEqual(process([0, 'done', '']), [0, 'done', ''])
+        self.assertTrue(
+            'changes' in self.registry.result_processor(
+                'puppet', 'Run')([0, '', ''])[1])
+        self.assertEqual(self.registry.result_processor('yumcmd', 'Install'),
+                         None)
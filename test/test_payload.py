@@ -0,0 +1,92 @@
+# Copyright (C) 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Unittests for result payload limits.
+"""
+
+from . import TestCase
+
+from replugin.funcworker.payload import ResultPayload, decode
+
+
+class TestResultPayload(TestCase):
+
+    def test_outputs_are_capped(self):
+        """
+        Verify long outputs keep their start and end.
+        """
+        payload = ResultPayload(max_output=10)
+        results = payload.cap_results({
+            'web1': [0, 'a' * 5 + 'b' * 100 + 'c' * 5, 'short'],
+        })
+        self.assertEqual(
+            results['web1'],
+            [0, 'aaaaa\n... [100 bytes cut] ...\nccccc', 'short'])
+        # 0 keeps everything
+        self.assertEqual(ResultPayload(max_output=0).cap('x' * 100), 'x' * 100)
+
+    def test_summaries_are_capped(self):
+        """
+        Verify the logged summary of many hosts stays within max_output.
+        """
+        results = dict([('web%04d' % x, [x % 2, 'y' * 100, ''])
+                        for x in range(5000)])
+        results['web9999'] = [['bash', '4.2'], '', '']
+        summary = ResultPayload(max_output=1000).summarize(results)
+        self.assertTrue(summary.startswith(
+            "5001 hosts, return codes {0: 2500, 1: 2500, 'other': 1}. "
+            "web0000: [0, '"))
+        self.assertTrue(len(summary) < 1100)
+
+        summary = ResultPayload().summarize({'web1': [0, 'ok', '']})
+        self.assertEqual(
+            summary, "1 hosts, return codes {0: 1}. web1: [0, 'ok', '']")
+
+    def test_plain_data_is_not_encoded(self):
+        """
+        Verify data is left alone without compression and chunking.
+        """
+        data = {'web1': [0, 'out', '']}
+        self.assertEqual(ResultPayload().encode(data), (None, [data]))
+        # Small data is not chunked either
+        self.assertEqual(
+            ResultPayload(chunk_size=1000).encode(data), (None, [data]))
+
+    def test_data_round_trips(self):
+        """
+        Verify compressed and chunked data decodes back to the data.
+        """
+        data = {'web%s' % x: [0, 'installed ' * 50, ''] for x in range(20)}
+        for payload in (ResultPayload(compress=True),
+                        ResultPayload(chunk_size=100),
+                        ResultPayload(compress=True, chunk_size=100)):
+            (encoding, bodies) = payload.encode(data)
+            self.assertTrue(encoding is not None)
+            self.assertTrue(max([len(body) for body in bodies]) <= (
+                payload.chunk_size or len(bodies[0])))
+            self.assertEqual(decode(encoding, bodies), data)
+
+        (encoding, bodies) = ResultPayload(compress=True).encode(data)
+        self.assertEqual(encoding, 'json+zlib+base64')
+        self.assertEqual(len(bodies), 1)
+        self.assertTrue(len(bodies[0]) < len(str(data)))
+
+    def test_bad_limits(self):
+        """
+        Verify negative limits are refused.
+        """
+        self.assertRaises(ValueError, ResultPayload, -1)
+        self.assertRaises(ValueError, ResultPayload, 10, False, -1)
+        self.assertRaises(ValueError, decode, 'rot13', ['x'])
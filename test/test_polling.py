@@ -0,0 +1,213 @@
+# Copyright (C) 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Unittests for job polling.
+"""
+
+import func
+import time
+import Queue
+import mock
+
+from . import TestCase
+
+from replugin.funcworker.polling import Deadline, JobTracker, PollPolicy
+
+from func.minion.codes import FuncException
+
+
+class TestPollPolicy(TestCase):
+
+    def test_delays_back_off_to_maximum(self):
+        """
+        Verify delays start small and grow until the maximum.
+        """
+        policy = PollPolicy(first=0.5, factor=2, maximum=3, jitter=0)
+        delays = policy.delays()
+        self.assertEqual(
+            [delays.next() for x in range(5)], [0.5, 1.0, 2.0, 3.0, 3.0])
+
+    def test_jitter_stays_in_bounds(self):
+        """
+        Verify jitter spreads delays without passing the maximum.
+        """
+        policy = PollPolicy(first=1, factor=1, maximum=1.05, jitter=0.1)
+        delays = policy.delays()
+        for x in range(100):
+            delay = delays.next()
+            assert 0.9 <= delay <= 1.05
+
+    def test_from_config(self):
+        """
+        Verify policies can be built from the config and bad ones raise.
+        """
+        self.assertEqual(PollPolicy.from_config(None).first, 0.25)
+        policy = PollPolicy.from_config({u'first': 5, u'maximum': 60})
+        self.assertEqual((policy.first, policy.maximum), (5.0, 60.0))
+
+        self.assertRaises(ValueError, PollPolicy.from_config, {'every': 1})
+        self.assertRaises(ValueError, PollPolicy.from_config, {'first': 0})
+        self.assertRaises(ValueError, PollPolicy.from_config, {'factor': 0.5})
+        self.assertRaises(ValueError, PollPolicy.from_config, {'jitter': 2})
+
+
+class TestJobTracker(TestCase):
+
+    def setUp(self):
+        self.app_logger = mock.MagicMock('logging.Logger').__call__()
+        self.policy = PollPolicy(first=0.01, maximum=0.01, jitter=0)
+
+    def test_jobs_are_polled_until_finished(self):
+        """
+        Verify every registered job is polled until it is finished.
+        """
+        tracker = JobTracker(self.app_logger, interval=0.01)
+        clients = {}
+        jobs = []
+        for job_id in ('job1', 'job2', 'job3'):
+            clients[job_id] = mock.MagicMock()
+            clients[job_id].job_status.side_effect = [
+                (func.jobthing.JOB_ID_RUNNING, {}),
+                (func.jobthing.JOB_ID_FINISHED, {job_id: [0, '', '']}),
+            ]
+            jobs.append(tracker.register(
+                clients[job_id], job_id, self.policy))
+
+        for job in jobs:
+            self.assertEqual(job.result(), {job.job_id: [0, '', '']})
+            self.assertEqual(job.polls, 2)
+            self.assertEqual(clients[job.job_id].job_status.call_count, 2)
+        self.assertEqual(tracker.outstanding(), 0)
+
+    def test_polls_finer_than_the_interval(self):
+        """
+        Verify jobs due before the interval is up are polled when due.
+        """
+        tracker = JobTracker(self.app_logger, interval=5)
+        client = mock.MagicMock()
+        client.job_status.side_effect = [
+            (func.jobthing.JOB_ID_RUNNING, {}),
+            (func.jobthing.JOB_ID_RUNNING, {}),
+            (func.jobthing.JOB_ID_FINISHED, {}),
+        ]
+
+        job = tracker.register(client, 'job1', self.policy)
+        # Three polls 0.01 seconds apart, not 5
+        self.assertTrue(job.wait(2))
+        self.assertEqual(job.polls, 3)
+
+    def test_wait_times_out(self):
+        """
+        Verify waiting on an unfinished job gives up after the timeout.
+        """
+        tracker = JobTracker(self.app_logger, interval=0.01)
+        client = mock.MagicMock()
+        client.job_status.return_value = (func.jobthing.JOB_ID_RUNNING, {})
+
+        job = tracker.register(client, 'job1', self.policy)
+        self.assertFalse(job.wait(0.05))
+        self.assertEqual(tracker.outstanding(), 1)
+
+        client.job_status.return_value = (func.jobthing.JOB_ID_FINISHED, {})
+        self.assertEqual(job.result(), {})
+
+    def test_poll_errors_are_raised_to_waiter(self):
+        """
+        Verify errors while polling are raised when asking for results.
+        """
+        tracker = JobTracker(self.app_logger, interval=0.01)
+        client = mock.MagicMock()
+        client.job_status.side_effect = FuncException('Lost the overlord')
+
+        job = tracker.register(client, 'job1', self.policy)
+        self.assertRaises(FuncException, job.result)
+        self.assertEqual(tracker.outstanding(), 0)
+
+    def test_finished_jobs_go_to_done_queue(self):
+        """
+        Verify finished jobs are put on the done queue in the order they
+        finish and abandoned jobs are no longer polled.
+        """
+        tracker = JobTracker(self.app_logger, interval=0.01)
+        done = Queue.Queue()
+        fast = mock.MagicMock()
+        fast.job_status.return_value = (func.jobthing.JOB_ID_FINISHED, {})
+        slow = mock.MagicMock()
+        slow.job_status.return_value = (func.jobthing.JOB_ID_RUNNING, {})
+
+        slow_job = tracker.register(slow, 'slow', self.policy, done)
+        fast_job = tracker.register(fast, 'fast', self.policy, done)
+        self.assertEqual(done.get(timeout=1), fast_job)
+
+        tracker.abandon(slow_job)
+        self.assertEqual(tracker.outstanding(), 0)
+        polls = slow.job_status.call_count
+        time.sleep(0.05)
+        self.assertEqual(slow.job_status.call_count, polls)
+        self.assertTrue(done.empty())
+
+
+    def test_partial_results_are_reported(self):
+        """
+        Verify partial results of unfinished jobs go to the progress
+        callback.
+        """
+        tracker = JobTracker(self.app_logger, interval=0.01)
+        client = mock.MagicMock()
+        client.job_status.side_effect = [
+            (func.jobthing.JOB_ID_ASYNC_PARTIAL, {'a': [0, '', '']}),
+            (func.jobthing.JOB_ID_FINISHED, {'a': [0, '', ''],
+                                             'b': [0, '', '']}),
+        ]
+        progress = mock.MagicMock()
+
+        job = tracker.register(client, 'job1', self.policy, progress=progress)
+        self.assertEqual(len(job.result()), 2)
+        progress.assert_called_once_with({'a': [0, '', '']})
+
+class TestDeadline(TestCase):
+
+    def test_deadline(self):
+        """
+        Verify the time left counts down and is clamped at the end.
+        """
+        deadline = Deadline(0.05)
+        self.assertFalse(deadline.expired())
+        self.assertTrue(0 < deadline.remaining() <= 0.05)
+        self.assertTrue(deadline.clamp(2) <= 0.05)
+        time.sleep(0.06)
+        self.assertTrue(deadline.expired())
+        self.assertEqual(deadline.remaining(), 0)
+        self.assertEqual(deadline.clamp(2), 0)
+
+    def test_no_deadline(self):
+        """
+        Verify a deadline without seconds never passes.
+        """
+        deadline = Deadline()
+        self.assertFalse(deadline.expired())
+        self.assertEqual(deadline.remaining(), None)
+        self.assertEqual(deadline.clamp(2), 2)
+
+    def test_within(self):
+        """
+        Verify nested deadlines end no later than the outer one.
+        """
+        outer = Deadline(0.05)
+        self.assertTrue(outer.within(10).remaining() <= 0.05)
+        self.assertTrue(outer.within(None).remaining() <= 0.05)
+        self.assertTrue(outer.within(0.01).remaining() <= 0.01)
+        self.assertEqual(Deadline().within(None).remaining(), None)
+        self.assertTrue(Deadline().within(5).remaining() <= 5)
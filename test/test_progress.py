@@ -0,0 +1,73 @@
+# Copyright (C) 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Unittests for progress messages.
+"""
+
+import mock
+import time
+
+from . import TestCase
+
+from replugin.funcworker.progress import ProgressReporter
+
+
+class TestProgressReporter(TestCase):
+
+    def test_messages_are_rate_limited(self):
+        """
+        Verify hosts arriving between messages wait for the next one.
+        """
+        send = mock.MagicMock()
+        progress = ProgressReporter(send, 0.05, 4)
+
+        progress.update(['a'], [])
+        progress.update(['b'], ['c'])
+        self.assertEqual(send.call_count, 1)
+        self.assertEqual(send.call_args[0][0], {
+            'status': 'progress',
+            'data': {'succeeded': ['a'], 'failed': [], 'done': 1, 'total': 4},
+        })
+
+        time.sleep(0.06)
+        progress.update([], ['d'])
+        self.assertEqual(send.call_count, 2)
+        self.assertEqual(send.call_args[0][0]['data'], {
+            'succeeded': ['b'], 'failed': ['c', 'd'], 'done': 4, 'total': 4})
+
+    def test_hosts_are_reported_again_when_they_change(self):
+        """
+        Verify a host is only reported again once its outcome changed.
+        """
+        send = mock.MagicMock()
+        progress = ProgressReporter(send, 0.01, 1)
+
+        progress.update([], ['a'])
+        time.sleep(0.02)
+        progress.update([], ['a'])
+        self.assertEqual(send.call_count, 1)
+
+        progress.update(['a'], [])
+        self.assertEqual(send.call_count, 2)
+        self.assertEqual(send.call_args[0][0]['data']['succeeded'], ['a'])
+
+    def test_disabled(self):
+        """
+        Verify an interval of 0 sends nothing.
+        """
+        send = mock.MagicMock()
+        progress = ProgressReporter(send, 0, 1)
+        progress.update(['a'], [])
+        self.assertEqual(send.call_count, 0)
@@ -171,9 +171,13 @@ class TestPuppetParser(TestCase):
             (update, cmd) = ppt._parse_Disable(params, self.app_logger)
             self.assertEqual(cmd, expected)
 
-    @mock.patch('replugin.funcworker.puppet._parse_Enable')
-    def test_good_parse_target_params(self, ppt_enable):
+    def test_good_parse_target_params(self):
         """puppet:Enable: Test looking up a special parser passes"""
+        ppt_enable = mock.MagicMock()
+        parsers = mock.patch.dict(
+            replugin.funcworker.puppet.PARSERS, {'Enable': ppt_enable})
+        parsers.start()
+        self.addCleanup(parsers.stop)
         ppt_enable.return_value = ({}, [])
 
         params = {
@@ -186,9 +190,13 @@ class TestPuppetParser(TestCase):
         self.app_logger.debug.assert_called_once_with("Found parser: _parse_Enable")
         self.app_logger.reset_mock()
 
-    @mock.patch('replugin.funcworker.puppet._parse_Enable')
-    def test_bad_parse_target_params(self, ppt_enable):
+    def test_bad_parse_target_params(self):
         """puppet:Enable: Invalid subcommands raise while looking for parser"""
+        ppt_enable = mock.MagicMock()
+        parsers = mock.patch.dict(
+            replugin.funcworker.puppet.PARSERS, {'Enable': ppt_enable})
+        parsers.start()
+        self.addCleanup(parsers.stop)
         ppt_enable.return_value = ({}, [])
 
         params = {
@@ -202,9 +210,13 @@ class TestPuppetParser(TestCase):
             (_params_result,
              _method_args) = ptp(params, self.app_logger)
 
-    @mock.patch('replugin.funcworker.puppet._parse_Enable')
-    def test_dangerous_parse_target_params(self, ppt_Enable):
+    def test_dangerous_parse_target_params(self):
         """fileops:Enable: Verify that if bad shell chars return it's blocked"""
+        ppt_Enable = mock.MagicMock()
+        parsers = mock.patch.dict(
+            replugin.funcworker.puppet.PARSERS, {'Enable': ppt_Enable})
+        parsers.start()
+        self.addCleanup(parsers.stop)
         for bad_data in ([';'], ['&&'], ['|'], ['$'], ['>'], ['<']):
             ppt_Enable.reset_mock()
             ppt_Enable.return_value = ({}, bad_data)
@@ -222,12 +234,56 @@ class TestPuppetParser(TestCase):
 
     def test_good_process_result(self):
         """puppet:ProcessResult: Test processing puppet command results"""
-        # TODO: Implement the process_result function
-        with self.assertRaises(NotImplementedError):
-            replugin.funcworker.puppet.process_result(None)
+        stdout = "\n".join([
+            "Info: Retrieving plugin",
+            "Info: Applying configuration version '1400000000'",
+            "Notice: /Stage[main]/Foo/File[/etc/foo]/content: content "
+            "changed '{md5}a' to '{md5}b'",
+            "Notice: /Stage[main]/Foo/File[/etc/foo]/mode: mode changed "
+            "'0600' to '0644'",
+            "Notice: /Stage[main]/Foo/Service[foo]: Triggered 'refresh' "
+            "from 1 events",
+            "Warning: Setting templatedir is deprecated.",
+            "Notice: Finished catalog run in 4.50 seconds",
+        ])
+        result = replugin.funcworker.puppet.process_result(
+            'Run', [2, stdout, ''])
+        self.assertEqual(result, [2, {
+            'changes': 3,
+            'changed': ['/Stage[main]/Foo/File[/etc/foo]',
+                        '/Stage[main]/Foo/Service[foo]'],
+            'errors': [],
+            'warnings': 1,
+            'version': '1400000000',
+            'seconds': 4.5,
+        }, ''])
+
+        # Other subcommands are left alone
+        result = replugin.funcworker.puppet.process_result(
+            'Enable', [0, 'enabled', ''])
+        self.assertEqual(result, [0, 'enabled', ''])
 
     def test_bad_process_result(self):
         """puppet:ProcessResult: Test processing puppet command results failure"""
-        # TODO: Implement the process_result function
-        with self.assertRaises(NotImplementedError):
-            replugin.funcworker.puppet.process_result(None)
+        stderr = "\n".join([
+            "Error: Could not retrieve catalog from remote server",
+            "Error: /Stage[main]/Foo/Package[bar]/ensure: change from "
+            "absent to present failed",
+        ])
+        result = replugin.funcworker.puppet.process_result(
+            'Run', [4, 'Notice: Skipping run of Puppet configuration '
+                    'client; administratively disabled', stderr])
+        self.assertEqual(result[0], 4)
+        self.assertEqual(result[1]['errors'], [
+            "Could not retrieve catalog from remote server",
+            "/Stage[main]/Foo/Package[bar]: change from absent to present "
+            "failed",
+        ])
+        self.assertEqual(result[1]['changes'], 0)
+        self.assertTrue(result[1]['disabled'])
+        self.assertEqual(result[2], stderr)
+
+        # Remote errors keep their error
+        result = replugin.funcworker.puppet.process_result(
+            'Run', ['REMOTE_ERROR', 'IOError', 'broken', 'tb'])
+        self.assertEqual(result, [1, '', 'IOError, broken, tb'])
@@ -0,0 +1,79 @@
+# Copyright (C) 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Unittests for stage timings.
+"""
+
+import mock
+import time
+
+from . import TestCase
+
+from replugin.funcworker import timing
+from replugin.funcworker.timing import StageTimer
+
+
+class TestStageTimer(TestCase):
+
+    def test_stages_add_up(self):
+        """
+        Verify a stage entered several times sums up every visit.
+        """
+        timer = StageTimer()
+        for x in range(2):
+            with timer.stage('poll'):
+                time.sleep(0.02)
+        timer.add('queued', 0.5)
+
+        summary = timer.summary()
+        self.assertTrue(0.04 <= summary['poll'] < 0.2)
+        self.assertEqual(summary['queued'], 0.5)
+        self.assertTrue(summary['total'] >= 0.04)
+
+    def test_stage_is_timed_on_errors(self):
+        """
+        Verify a stage left by an exception is still timed.
+        """
+        timer = StageTimer()
+        try:
+            with timer.stage('submit'):
+                raise ValueError('boom')
+        except ValueError:
+            pass
+        self.assertTrue('submit' in timer.summary())
+
+    def test_stages_ignore_wall_clock_changes(self):
+        """
+        Verify the wall clock being set back does not change timings.
+        """
+        timer = StageTimer()
+        with mock.patch('time.time', return_value=0):
+            with timer.stage('poll'):
+                time.sleep(0.01)
+        self.assertTrue(timer.summary()['poll'] >= 0.01)
+
+
+class TestClock(TestCase):
+
+    def test_clock_is_monotonic(self):
+        """
+        Verify the clock and its os.times fallback count up in seconds.
+        """
+        for clock in (timing.clock, timing._elapsed_clock):
+            start = clock()
+            time.sleep(0.05)
+            self.assertTrue(0.02 <= clock() - start < 1)
+        self.assertFalse(timing.clock is time.time)
+